@@ -0,0 +1,189 @@
+"""Benchmark of the upstream transports: HTTP/1.1 versus multiplexed HTTP/2.
+
+Runs a TLS stand-in index (speaking both protocols, negotiated with ALPN) which simulates a network
+round trip time: every connection setup costs two round trips (TCP and TLS handshake), every
+response one. A burst of concurrent requests for pages and files, like pip resolving a set of
+requirements, is made through the `UpstreamPool` of the proxy with and without HTTP/2, from a cold
+pool (no connections yet) and from a warm one. Reported are the wall time of the burst and the
+number of connections the index accepted.
+
+Requires the h2 package and openssl (to create the certificate).
+
+Usage: python benchmarks/bench_http2.py [--requests N] [--concurrency N] [--rtt SECONDS]
+                                        [--file-size BYTES]
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+import os
+import socket
+import ssl
+import subprocess
+import tempfile
+from threading import Condition, Thread
+import time
+from typing import List, Tuple
+
+import h2.config
+import h2.connection
+import h2.events
+
+from crane_pip.upstream import UpstreamPool
+
+PAGE = "".join(
+    f'<a href="/packages/pkg-{i}.tar.gz#sha256={i:064x}">pkg-{i}.tar.gz</a>\n' for i in range(100)
+).encode()
+FILE = b"x" * 2**18
+RTT = 0.02
+
+
+def response(path: str) -> Tuple[str, bytes]:
+    time.sleep(RTT)
+    if path.startswith("/simple/"):
+        return "text/html", PAGE
+    return "application/octet-stream", FILE
+
+
+class Http1Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        content_type, body = response(self.path)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Upstream:
+    "TLS stand-in index, serving HTTP/2 if the client offers it."
+
+    def __init__(self, cert_file: str, key_file: str) -> None:
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(cert_file, key_file)
+        self.context.set_alpn_protocols(["h2", "http/1.1"])
+        self.listener = socket.create_server(("127.0.0.1", 0), backlog=128)
+        self.url = f"https://127.0.0.1:{self.listener.getsockname()[1]}"
+        self.connections: List[str] = []
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            sock, address = self.listener.accept()
+            Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _serve(self, sock: socket.socket, address) -> None:
+        time.sleep(2 * RTT)
+        try:
+            tls = self.context.wrap_socket(sock, server_side=True)
+            protocol = tls.selected_alpn_protocol() or "http/1.1"
+            self.connections.append(protocol)
+            if protocol == "h2":
+                self._serve_h2(tls)
+            else:
+                Http1Handler(tls, address, None)
+        except OSError:
+            pass
+
+    def _serve_h2(self, tls: ssl.SSLSocket) -> None:
+        conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        cond = Condition()
+        conn.initiate_connection()
+        tls.sendall(conn.data_to_send())
+
+        def respond(stream_id: int, path: str) -> None:
+            content_type, body = response(path)
+            headers = [(":status", "200"), ("content-type", content_type)]
+            with cond:
+                conn.send_headers(stream_id, headers + [("content-length", str(len(body)))])
+                tls.sendall(conn.data_to_send())
+            while body:
+                with cond:
+                    # Respect the flow control windows of the client.
+                    size = min(conn.local_flow_control_window(stream_id), len(body))
+                    size = min(size, conn.max_outbound_frame_size)
+                    if size == 0:
+                        cond.wait()
+                        continue
+                    conn.send_data(stream_id, body[:size], end_stream=size == len(body))
+                    tls.sendall(conn.data_to_send())
+                body = body[size:]
+
+        while True:
+            data = tls.recv(65536)
+            if not data:
+                return
+            with cond:
+                events = conn.receive_data(data)
+                tls.sendall(conn.data_to_send())
+                cond.notify_all()
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    path = dict(event.headers)[":path"]
+                    Thread(target=respond, args=(event.stream_id, path), daemon=True).start()
+
+
+def burst(pool: UpstreamPool, urls: List[str], concurrency: int) -> float:
+    "Wall time of requesting all urls concurrently."
+
+    def get(url: str) -> None:
+        resp = pool.request("GET", url, headers={})
+        assert resp.status == 200 and resp.data, resp.status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(get, urls))
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    global FILE, RTT
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", "-n", type=int, default=64)
+    parser.add_argument("--concurrency", "-c", type=int, default=16)
+    parser.add_argument("--rtt", type=float, default=RTT)
+    parser.add_argument("--file-size", type=int, default=len(FILE))
+    args = parser.parse_args()
+    FILE = b"x" * args.file_size
+    RTT = args.rtt
+
+    with tempfile.TemporaryDirectory() as tmp:
+        cert_file, key_file = os.path.join(tmp, "cert.pem"), os.path.join(tmp, "key.pem")
+        subprocess.run(
+            ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+            + ["-keyout", key_file, "-out", cert_file, "-subj", "/CN=127.0.0.1"]
+            + ["-addext", "subjectAltName=IP:127.0.0.1"],
+            check=True,
+            capture_output=True,
+        )
+        os.environ["SSL_CERT_FILE"] = cert_file
+        upstream = Upstream(cert_file, key_file)
+        urls = [
+            f"{upstream.url}/simple/pkg-{i}/" if i % 2 else f"{upstream.url}/packages/pkg-{i}"
+            for i in range(args.requests)
+        ]
+
+        print(
+            f"{args.requests} requests, {args.concurrency} concurrent, rtt {RTT * 1e3:.0f} ms, "
+            f"files of {len(FILE)} bytes"
+        )
+        for name, http2 in (("HTTP/1.1", False), ("HTTP/2", True)):
+            upstream.connections = []
+            pool = UpstreamPool(http2=http2)
+            cold = burst(pool, urls, args.concurrency)
+            warm = burst(pool, urls, args.concurrency)
+            print(
+                f"{name:<9} cold {cold * 1e3:7.1f} ms   warm {warm * 1e3:7.1f} ms"
+                f"   connections {len(upstream.connections)}"
+            )
+
+
+if __name__ == "__main__":
+    main()
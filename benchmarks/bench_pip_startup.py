@@ -0,0 +1,88 @@
+"""Benchmark of `crane pip` running pip in a sub-process versus in process (`--in-process`).
+
+Runs a stand-in index serving a single small wheel and times complete `crane pip download` runs
+(a fresh `python -m crane_pip` process each: start up, proxy, pip, exit), like the many small
+`crane pip` calls of a script. Reported is the median wall time per run of both modes.
+
+Usage: python benchmarks/bench_pip_startup.py [--runs N]
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import statistics
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+import zipfile
+
+
+def make_wheel() -> bytes:
+    "A minimal wheel of the project 'pkg'."
+    files = {
+        "pkg/__init__.py": "",
+        "pkg-1.0.dist-info/METADATA": "Metadata-Version: 2.1\nName: pkg\nVersion: 1.0\n",
+        "pkg-1.0.dist-info/WHEEL": "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+    }
+    files["pkg-1.0.dist-info/RECORD"] = "".join(f"{name},,\n" for name in files)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as wheel:
+        for name, content in files.items():
+            wheel.writestr(name, content)
+    return buffer.getvalue()
+
+
+WHEEL = make_wheel()
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/simple/"):
+            body = b'<a href="/packages/pkg-1.0-py3-none-any.whl">pkg-1.0-py3-none-any.whl</a>'
+            content_type = "text/html"
+        else:
+            body, content_type = WHEEL, "application/octet-stream"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(upstream_url: str, dest: str, in_process: bool) -> float:
+    "Wall time of a crane pip download."
+    command = [sys.executable, "-m", "crane_pip", "pip", "--no-store"]
+    command += ["--fallback-url", upstream_url] + (["--in-process"] if in_process else [])
+    command += ["download", "--no-deps", "--no-cache-dir", "--disable-pip-version-check"]
+    command += ["-q", "-d", dest, "pkg"]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", "-n", type=int, default=10)
+    args = parser.parse_args()
+
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}/simple"
+
+    with tempfile.TemporaryDirectory() as dest:
+        for name, in_process in (("sub-process", False), ("in process", True)):
+            run(upstream_url, dest, in_process)  # warm up (file system caches)
+            times = [run(upstream_url, dest, in_process) for _ in range(args.runs)]
+            print(f"{name:<12} {statistics.median(times) * 1e3:7.1f} ms/run (median)")
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
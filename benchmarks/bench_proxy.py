@@ -0,0 +1,112 @@
+"""Micro-benchmark of the CPU time the proxy spends per request.
+
+Runs a stand-in upstream index, the proxy (with a store) and a sequential client in this process
+and reports the CPU time of the proxy (the time its handler threads spend handling the requests,
+so excluding the client and the upstream index) per request for:
+
+- page: a simple page fetched upstream and rewritten.
+- file (store): a 1 MB file served from the store.
+- file (upstream): a 1 MB file streamed from upstream (the store disabled).
+- head (index): a HEAD request answered from the artifact index.
+
+Usage: python benchmarks/bench_proxy.py [--requests N]
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import tempfile
+from threading import Thread
+import time
+
+import urllib3
+
+from crane_pip.links import index_id
+from crane_pip.proxy import IndexProxy, ProxyHTTPRequestHandler
+from crane_pip.store import LastKnownGoodStore
+
+FILE = b"x" * 2**20
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        if self.path.startswith("/simple/"):
+            body = "".join(
+                f'<a href="/packages/pkg-{i}.tar.gz#sha256={i:064x}">pkg-{i}.tar.gz</a>\n'
+                for i in range(100)
+            ).encode()
+            content_type = "text/html"
+        else:
+            body, content_type = FILE, "application/octet-stream"
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+# CPU seconds spent by the handler threads of the proxy.
+proxy_cpu = 0.0
+_handle_one_request = ProxyHTTPRequestHandler.handle_one_request
+
+
+def timed_handle_one_request(self) -> None:
+    global proxy_cpu
+    start = time.thread_time()
+    try:
+        _handle_one_request(self)
+    finally:
+        proxy_cpu += time.thread_time() - start
+
+
+ProxyHTTPRequestHandler.handle_one_request = timed_handle_one_request
+
+
+def measure(http: urllib3.PoolManager, method: str, url: str, n: int) -> float:
+    "CPU seconds of the proxy per request."
+    http.request(method, url)  # warm up
+    start = proxy_cpu
+    for _ in range(n):
+        resp = http.request(method, url)
+        assert resp.status == 200, resp.status
+    return (proxy_cpu - start) / n
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--requests", "-n", type=int, default=200)
+    args = parser.parse_args()
+
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}/simple"
+    upstream_host = f"127.0.0.1:{upstream.server_port}"
+    file_path = f"/files/{index_id(upstream_url)}/http/{upstream_host}/packages/pkg-1.tar.gz"
+    http = urllib3.PoolManager(maxsize=1)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as store_dir:
+        store = LastKnownGoodStore(store_dir)
+        with IndexProxy(index_url=None, port=0, fallback_urls=[upstream_url], store=store) as p:
+            base = p.proxy_address.url()
+            results["page"] = measure(http, "GET", base + "/pkg/", args.requests)
+            results["file (store)"] = measure(http, "GET", base + file_path, args.requests)
+            results["head (index)"] = measure(http, "HEAD", base + file_path, args.requests)
+        with IndexProxy(index_url=None, port=0, fallback_urls=[upstream_url]) as p:
+            base = p.proxy_address.url()
+            http.request("GET", base + "/pkg/")
+            results["file (upstream)"] = measure(http, "GET", base + file_path, args.requests)
+    upstream.shutdown()
+
+    for name, seconds in results.items():
+        print(f"{name:<16} {seconds * 1e3:8.3f} ms CPU/request")
+
+
+if __name__ == "__main__":
+    main()
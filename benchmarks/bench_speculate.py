@@ -0,0 +1,112 @@
+"""Benchmark of speculative dependency prefetching (`--speculate`) with pip's resolver.
+
+Runs a stand-in index which simulates a network round trip time per response, serving a tree of
+projects: `p0` depends on `p1` and `p2`, `p1` on `p3` and `p4`, and so on. Every project has a
+wheel with its metadata (PEP 658). Times `crane pip download p0` (resolving the whole tree) with
+and without speculation. Reported is the median wall time of the runs.
+
+Usage: python benchmarks/bench_speculate.py [--projects N] [--rtt SECONDS] [--runs N]
+"""
+
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import statistics
+import subprocess
+import sys
+import tempfile
+from threading import Thread
+import time
+import zipfile
+
+PROJECTS = 15
+RTT = 0.05
+
+
+def metadata(i: int) -> str:
+    lines = ["Metadata-Version: 2.1", f"Name: p{i}", "Version: 1.0"]
+    lines += [f"Requires-Dist: p{j}" for j in (2 * i + 1, 2 * i + 2) if j < PROJECTS]
+    return "\n".join(lines) + "\n"
+
+
+def make_wheel(i: int) -> bytes:
+    files = {
+        f"p{i}/__init__.py": "",
+        f"p{i}-1.0.dist-info/METADATA": metadata(i),
+        f"p{i}-1.0.dist-info/WHEEL": "Wheel-Version: 1.0\nRoot-Is-Purelib: true\nTag: py3-none-any",
+    }
+    files[f"p{i}-1.0.dist-info/RECORD"] = "".join(f"{name},,\n" for name in files)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as wheel:
+        for name, content in files.items():
+            wheel.writestr(name, content)
+    return buffer.getvalue()
+
+
+class Upstream(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        time.sleep(RTT)
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "simple" and len(parts) == 2 and parts[1][1:].isdigit():
+            name = f"{parts[1]}-1.0-py3-none-any.whl"
+            body = f'<a href="/packages/{name}" data-core-metadata="true">{name}</a>'.encode()
+            content_type = "text/html"
+        elif parts[0] == "packages" and parts[-1].endswith(".whl.metadata"):
+            body = metadata(int(parts[-1].split("-")[0][1:])).encode()
+            content_type = "application/octet-stream"
+        elif parts[0] == "packages" and parts[-1].endswith(".whl"):
+            body = make_wheel(int(parts[-1].split("-")[0][1:]))
+            content_type = "application/octet-stream"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run(upstream_url: str, dest: str, speculate: bool) -> float:
+    "Wall time of a crane pip download of the tree."
+    command = [sys.executable, "-m", "crane_pip", "pip", "--no-store"]
+    command += ["--fallback-url", upstream_url] + (["--speculate"] if speculate else [])
+    command += ["download", "--no-cache-dir", "--disable-pip-version-check"]
+    command += ["-q", "-d", dest, "p0"]
+    start = time.perf_counter()
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def main() -> None:
+    global PROJECTS, RTT
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--projects", "-p", type=int, default=PROJECTS)
+    parser.add_argument("--rtt", type=float, default=RTT)
+    parser.add_argument("--runs", "-n", type=int, default=3)
+    args = parser.parse_args()
+    PROJECTS, RTT = args.projects, args.rtt
+
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), Upstream)
+    Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}/simple"
+
+    print(f"{PROJECTS} projects, rtt {RTT * 1e3:.0f} ms")
+    for name, speculate in (("plain", False), ("speculate", True)):
+        times = []
+        for _ in range(args.runs):
+            with tempfile.TemporaryDirectory() as dest:
+                times.append(run(upstream_url, dest, speculate))
+        print(f"{name:<10} {statistics.median(times) * 1e3:7.1f} ms/run (median)")
+    upstream.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Replay of a recording of the proxy (`--record`) against a stand-in index, offline.
+
+The stand-in index is made up from the recording: the pages of the recorded projects link to the
+recorded files of the project (with their metadata if that was requested) and are padded to the
+recorded size, files are served with their recorded size, what was not found is not found. Every
+response of the stand-in takes the time the first request for it took in the recording (a bound on
+the time the real index took), or a fixed `--latency`.
+
+The requests are re-issued against an `IndexProxy` (with the proxy options given, a store starts
+empty) on as many connections as were recorded, each connection in the recorded order and at the
+recorded pace: sped up by `--speed`, or as fast as possible with `--speed 0`. Reported are the
+latency distributions per endpoint and the requests whose status differs from the recording.
+
+Usage: python benchmarks/replay.py RECORDING [--speed X] [--latency SECONDS] [proxy options]
+"""
+
+import argparse
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import math
+import tempfile
+from threading import Thread
+import time
+from typing import Dict, List, NamedTuple, Tuple, Union
+from urllib.parse import quote, unquote
+
+import urllib3
+
+from crane_pip.argparser import add_proxy_arguments, proxy_kwargs
+from crane_pip.links import index_id, is_files_path, to_proxy_path
+from crane_pip.proxy import IndexProxy, profile_endpoint, split_selector
+from crane_pip.recording import Record, read_recording
+from crane_pip.simple import normalize_name, parse_filename
+from crane_pip.store import LastKnownGoodStore
+
+CHUNK = b"x" * 2**16
+
+
+class StandIn:
+    """The stand-in index of a recording, served under /simple (pages) and /packages (files).
+
+    Arguments:
+    ----------
+    records: List[Record]
+        The recording.
+    latency: float | None
+        Seconds every response takes. None for the recorded durations.
+    """
+
+    def __init__(self, records: List[Record], latency: Union[float, None]) -> None:
+        # Stand-in path -> (status, size) and the seconds it takes.
+        self.responses: Dict[str, Tuple[int, int]] = {}
+        self.latency: Dict[str, float] = {}
+        projects: Dict[str, Dict[str, bool]] = defaultdict(dict)
+        for record in records:
+            path = self.path(record.path)
+            if path is None:
+                continue
+            status, size = self.responses.get(path, (record.status, 0))
+            self.responses[path] = (status, max(size, record.size))
+            self.latency.setdefault(path, record.duration if latency is None else latency)
+            if path.startswith("/packages/") and record.status == 200:
+                filename = path[len("/packages/") :]
+                metadata = filename.endswith(".metadata")
+                if metadata:
+                    filename = filename[: -len(".metadata")]
+                info = parse_filename(filename)
+                if info:
+                    files = projects[normalize_name(info.name)]
+                    files[filename] = metadata or files.get(filename, False)
+        self.pages = {}
+        for path, (status, size) in self.responses.items():
+            if path.startswith("/simple") and status == 200:
+                project = normalize_name(path[len("/simple") :].strip("/"))
+                self.pages[path] = self._page(projects.get(project, {}), size, project, projects)
+
+    @staticmethod
+    def path(recorded: str) -> Union[str, None]:
+        "Path on the stand-in of a recorded request. None for those answered by the proxy itself."
+        try:
+            path, _ = split_selector(recorded)
+        except ValueError:
+            return None
+        if is_files_path(path):
+            return "/packages/" + unquote(path.rstrip("/").rsplit("/", 1)[-1])
+        if path.startswith("/_crane/"):
+            return None
+        return "/simple" + path.partition("?")[0]
+
+    @staticmethod
+    def _page(files: Dict[str, bool], size: int, project: str, projects) -> bytes:
+        if project:
+            metadata = ' data-core-metadata="true"'
+            anchors = [
+                f'<a href="/packages/{quote(f)}"{metadata if m else ""}>{f}</a>\n'
+                for f, m in files.items()
+            ]
+        else:
+            anchors = [f'<a href="{name}/">{name}</a>\n' for name in projects]
+        anchors.insert(0, "<html><body>\n")
+        length = sum(map(len, anchors))
+        while length < size:
+            i = len(anchors)
+            anchors.append(f'<a href="/packages/pad-{i}.tar.gz">pad-{i}.tar.gz</a>\n')
+            length += len(anchors[-1])
+        return ("".join(anchors) + "</body></html>\n").encode()
+
+    def handler(self):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                path = unquote(self.path)
+                time.sleep(stand_in.latency.get(path, 0.0))
+                status, size = stand_in.responses.get(path, (404, 0))
+                body = stand_in.pages.get(path)
+                if status != 200:
+                    self.send_response(status)
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                page = path.startswith("/simple")
+                content_type = "text/html" if page else "application/octet-stream"
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body) if body is not None else size))
+                self.end_headers()
+                if self.command == "HEAD":
+                    return
+                if body is not None:
+                    self.wfile.write(body)
+                    return
+                while size > 0:
+                    self.wfile.write(CHUNK[:size])
+                    size -= len(CHUNK)
+
+            do_HEAD = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class Result(NamedTuple):
+    record: Record
+    status: int
+    latency: float
+
+
+def replay(
+    records: List[Record], proxy_url: str, upstream_url: str, speed: float
+) -> Tuple[List[Result], float]:
+    "Replay the records against the proxy. The results and the wall time."
+    index_url = f"{upstream_url}/simple"
+    connections: Dict[str, List[Record]] = defaultdict(list)
+    for record in records:
+        connections[record.connection].append(record)
+    results: List[Result] = []
+    t0 = records[0].t
+    start = time.perf_counter()
+
+    def target(record: Record) -> str:
+        path = record.path
+        if is_files_path(path.partition("?")[0]):
+            filename = StandIn.path(path)[len("/packages/") :]  # type: ignore
+            url = f"{upstream_url}/packages/{quote(filename)}"
+            return to_proxy_path(url, index_id(index_url), index_url)
+        return path
+
+    def run(connection: List[Record]) -> None:
+        pool = urllib3.connection_from_url(proxy_url, maxsize=1, block=True)
+        for record in connection:
+            if speed:
+                time.sleep(max(0.0, (record.t - t0) / speed - (time.perf_counter() - start)))
+            headers = {"Accept": record.accept, "Accept-Encoding": record.accept_encoding}
+            sent = time.perf_counter()
+            try:
+                resp = pool.request(
+                    record.method,
+                    target(record),
+                    headers={k: v for k, v in headers.items() if v},
+                    preload_content=False,
+                    retries=False,
+                )
+                for _ in resp.stream(2**16, decode_content=False):
+                    pass
+                resp.release_conn()
+                status = resp.status
+            except urllib3.exceptions.HTTPError:
+                status = 0
+            results.append(Result(record, status, time.perf_counter() - sent))
+
+    threads = [Thread(target=run, args=(c,)) for c in connections.values()]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results, time.perf_counter() - start
+
+
+def percentile(values: List[float], q: float) -> float:
+    "Nearest-rank percentile of sorted values."
+    return values[max(0, math.ceil(q / 100 * len(values)) - 1)]
+
+
+def report(results: List[Result], wall_time: float) -> None:
+    by_endpoint: Dict[str, List[float]] = defaultdict(list)
+    for result in results:
+        endpoint = profile_endpoint(result.record.method, result.record.path)
+        by_endpoint[endpoint].append(result.latency)
+        by_endpoint["all"].append(result.latency)
+    print(f"{'endpoint':<28} {'count':>6} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for endpoint, latencies in sorted(by_endpoint.items(), key=lambda e: e[0] == "all"):
+        latencies.sort()
+        columns = [percentile(latencies, q) * 1e3 for q in (50, 90, 99, 100)]
+        print(f"{endpoint:<28} {len(latencies):>6}" + "".join(f" {c:>8.1f}" for c in columns))
+    mismatches = [r for r in results if r.status != r.record.status]
+    print(f"wall time {wall_time:.2f} s, {len(mismatches)} responses with another status")
+    for result in mismatches[:10]:
+        print(f"  {result.record.method} {result.record.path}: {result.status}")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("recording")
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--latency", type=float, help="(Default: the recorded durations)")
+    add_proxy_arguments(parser)
+    args = parser.parse_args()
+
+    records = read_recording(args.recording)
+    if not records:
+        parser.error("The recording holds no requests.")
+    upstream = ThreadingHTTPServer(("127.0.0.1", 0), StandIn(records, args.latency).handler())
+    Thread(target=upstream.serve_forever, daemon=True).start()
+    upstream_url = f"http://127.0.0.1:{upstream.server_port}"
+
+    kwargs = proxy_kwargs(args)
+    kwargs["fallback_urls"] = [f"{upstream_url}/simple"]
+    with tempfile.TemporaryDirectory() as tmp:
+        if kwargs.get("store"):
+            kwargs["store"] = LastKnownGoodStore(tmp)
+        with IndexProxy(index_url=None, port=0, **kwargs) as proxy:
+            proxy_url = proxy.proxy_address.url()
+            results, wall_time = replay(records, proxy_url, upstream_url, args.speed)
+    upstream.shutdown()
+    report(results, wall_time)
+
+
+if __name__ == "__main__":
+    main()
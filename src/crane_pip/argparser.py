@@ -1,4 +1,5 @@
 import argparse
+from typing import Any, Dict
 
 root_parser = argparse.ArgumentParser(allow_abbrev=False)
 subparser = root_parser.add_subparsers(title="commands", dest="command")
@@ -12,3 +13,154 @@ def entrypoint_crane(args) -> int:
 root_parser.set_defaults(entrypoint_command=entrypoint_crane)
 
 # Subparsers for indiviual commands are added in their respective module: '.cmd_{command_name}'
+
+
+def add_proxy_arguments(parser: argparse.ArgumentParser, store_options: bool = True) -> None:
+    """Add the arguments configuring the index proxy, shared by the commands launching one.
+
+    The `store_options` are those configuring the use of the last-known-good store."""
+    parser.add_argument(
+        "--fallback-url",
+        action="append",
+        default=[],
+        help="Index url to fall back on for packages not found in the crane index. Can be given "
+        "multiple times for mirrors. (Default: as registered with the index, otherwise PyPI)",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        help="Seconds to wait for a connection to an index. (Default: as registered with the "
+        "index, otherwise 10)",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        help="Seconds to wait for data from an index. (Default: as registered with the index, "
+        "otherwise 60)",
+    )
+    parser.add_argument(
+        "--hedge-after",
+        type=float,
+        help="Also request from the next fallback mirror if an index did not respond within this "
+        "many seconds. The first response is used. (Default: no hedging)",
+    )
+    parser.add_argument(
+        "--warm-up",
+        action="store_true",
+        help="Validate the tokens and open the connections to all indexes when the proxy starts, "
+        "concurrently. The time it took is reported.",
+    )
+    parser.add_argument(
+        "--warm-up-project",
+        action="append",
+        default=[],
+        metavar="PROJECT",
+        help="Fetch the page of the project during the warm-up. Can be given multiple times. "
+        "(Implies --warm-up)",
+    )
+    parser.add_argument(
+        "--http2",
+        action="store_true",
+        help="Request the https indexes over HTTP/2 if they support it, multiplexing concurrent "
+        "requests over one connection per index. Requires the h2 package. (pip install h2)",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the handling of the requests and the authentication, per endpoint. Written "
+        "when the proxy stops and on SIGUSR1.",
+    )
+    parser.add_argument(
+        "--profiler",
+        choices=("sample", "cprofile"),
+        default="sample",
+        help="How to --profile: by sampling the stacks (low overhead), written as collapsed stacks "
+        "for flamegraphs, or with cProfile, written as pstats files. (Default: sample)",
+    )
+    parser.add_argument(
+        "--profile-dir",
+        default=".",
+        help="Directory the profiles are written to. (Default: the working directory)",
+    )
+    parser.add_argument(
+        "--speculate",
+        action="store_true",
+        help="Prefetch the dependencies of the packages served in the background, ahead of the "
+        "resolver: their pages and metadata.",
+    )
+    parser.add_argument(
+        "--speculate-files",
+        action="store_true",
+        help="Also prefetch the best matching files of the dependencies, into the store. "
+        "(Implies --speculate)",
+    )
+    parser.add_argument(
+        "--record",
+        metavar="FILE",
+        help="Record the requests to the proxy (appended to the file), to replay them in "
+        "benchmarks: the paths, timing, status and sizes. No bodies nor credentials.",
+    )
+    if not store_options:
+        return
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only serve pages and files from the last-known-good store. No requests are made to "
+        "the indexes and no authentication is performed. (An option of the proxy: pip or uv "
+        "still ask the proxy. For uv's own offline mode set UV_OFFLINE=1.)",
+    )
+    mode.add_argument(
+        "--stale-if-error",
+        action="store_true",
+        help="Serve pages and files from the last-known-good store if the indexes or the "
+        "authentication fail.",
+    )
+    parser.add_argument(
+        "--no-store",
+        action="store_true",
+        help="Do not persist the responses in the last-known-good store.",
+    )
+    parser.add_argument(
+        "--store-max-size",
+        type=float,
+        metavar="GIB",
+        help="Size of the last-known-good store: beyond it the least recently used responses are "
+        "removed. 0 for no limit. (Default: $CRANE_STORE_MAX_SIZE or 5)",
+    )
+
+
+def proxy_kwargs(args: argparse.Namespace) -> Dict[str, Any]:
+    "Keyword arguments for the IndexProxy as specified by the arguments of `add_proxy_arguments`."
+    # Imported here as the proxy is not needed by every command.
+    from .proxy import ProxyMode
+    from .store import LastKnownGoodStore
+
+    kwargs: Dict[str, Any] = {
+        "fallback_urls": args.fallback_url,
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout,
+        "hedge_after": args.hedge_after,
+        "warm_up": args.warm_up,
+        "warm_up_projects": args.warm_up_project,
+        "http2": args.http2,
+        "profile": args.profiler if args.profile else None,
+        "profile_dir": args.profile_dir,
+        "speculate": "files" if args.speculate_files else "pages" if args.speculate else None,
+        "record": args.record,
+    }
+    if "offline" not in args:
+        return kwargs
+    if args.offline:
+        mode = ProxyMode.OFFLINE
+    elif args.stale_if_error:
+        mode = ProxyMode.STALE_IF_ERROR
+    else:
+        mode = ProxyMode.ONLINE
+    kwargs["mode"] = mode
+    if args.no_store:
+        kwargs["store"] = None
+    else:
+        max_size = None if args.store_max_size is None else int(args.store_max_size * 2**30)
+        kwargs["store"] = LastKnownGoodStore(max_size=max_size)
+    return kwargs
@@ -0,0 +1,172 @@
+from collections import OrderedDict
+import json
+from threading import Lock
+import time
+from typing import Dict, Iterable, List, Mapping, NamedTuple, Tuple, Union
+
+from .db import MetadataStore
+from .simple import SimpleFile
+
+
+class ArtifactRecord(NamedTuple):
+    "What the proxy knows about a file in its /files/ namespace."
+
+    path: str
+    filename: str
+    hashes: Dict[str, str]
+    size: Union[int, None] = None
+    content_type: Union[str, None] = None
+    # Time (epoch) the record was last confirmed by a page or a download.
+    updated: float = 0.0
+
+
+class ArtifactIndex:
+    """Index of the artifacts known to the proxy and of the recent 404s of the indexes.
+
+    Artifact records are populated from the simple pages (name, hashes, and the size if listed)
+    and from downloads (size and content type). Fresh records let the proxy answer HEAD requests
+    without going upstream.
+
+    The 404s are remembered per index and path, such that for `not_found_ttl` seconds a resource
+    missing in the private index is directly requested from the next index (no token handling, no
+    upstream request).
+
+    With a metadata database the artifact records are persisted, such that they survive restarts
+    and are shared by the proxies using the same store. Records are kept in memory once looked up,
+    the `max_records` most recently used. The 404s are only kept in memory, at most
+    `max_not_found` of them: when more are recorded the oldest are forgotten.
+    """
+
+    max_age = 24 * 3600.0
+    not_found_ttl = 300.0
+    max_records = 100_000
+    max_not_found = 10_000
+
+    def __init__(self, db: Union[MetadataStore, None] = None) -> None:
+        self.db = db
+        self._lock = Lock()
+        self._records: "OrderedDict[str, ArtifactRecord]" = OrderedDict()
+        # (index url, path) -> expiry time. In the order of expiry.
+        self._not_found: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+
+    def record_page(self, files: Iterable[SimpleFile]) -> None:
+        "Record the files listed on a (rewritten) page. The urls are paths of the proxy."
+        now = time.time()
+        records = []
+        with self._lock:
+            for file in files:
+                old = self._records.get(file.url)
+                record = ArtifactRecord(
+                    path=file.url,
+                    filename=file.filename,
+                    hashes=file.hashes or (old.hashes if old else {}),
+                    size=file.size if file.size is not None else (old.size if old else None),
+                    content_type=old.content_type if old else None,
+                    updated=now,
+                )
+                self._remember(record)
+                records.append(record)
+        self._persist(records)
+
+    def record_download(self, path: str, headers: Mapping[str, str]) -> None:
+        "Record the size and content type of a file served by the proxy."
+        lower = {k.lower(): v for k, v in headers.items()}
+        if "content-length" not in lower or "content-encoding" in lower:
+            return
+        size = int(lower["content-length"])
+        content_type = lower.get("content-type", "application/octet-stream")
+        old = self._lookup(path)
+        if (
+            old
+            and (old.size, old.content_type) == (size, content_type)
+            and time.time() - old.updated < self.max_age / 2
+        ):
+            # Nothing new, spare the write (eg. on every store hit).
+            return
+        record = ArtifactRecord(
+            path=path,
+            filename=old.filename if old else path.rsplit("/", 1)[-1],
+            hashes=old.hashes if old else {},
+            size=size,
+            content_type=content_type,
+            updated=time.time(),
+        )
+        with self._lock:
+            self._remember(record)
+        self._persist([record])
+
+    def get(self, path: str) -> Union[ArtifactRecord, None]:
+        "The fresh record of the path. None if unknown or outdated."
+        record = self._lookup(path)
+        if record and time.time() - record.updated < self.max_age:
+            return record
+        return None
+
+    def _remember(self, record: ArtifactRecord) -> None:
+        "Keep the record in memory as the most recently used one. (Under the lock.)"
+        self._records[record.path] = record
+        self._records.move_to_end(record.path)
+        while len(self._records) > self.max_records:
+            self._records.popitem(last=False)
+
+    def _lookup(self, path: str) -> Union[ArtifactRecord, None]:
+        with self._lock:
+            record = self._records.get(path)
+            if record is not None:
+                self._records.move_to_end(path)
+        if record is None and self.db is not None:
+            rows = self.db.execute(
+                "SELECT filename, hashes, size, content_type, updated"
+                " FROM artifacts WHERE path = ?",
+                (path,),
+            )
+            if rows:
+                filename, hashes, size, content_type, updated = rows[0]
+                record = ArtifactRecord(
+                    path, filename, json.loads(hashes), size, content_type, updated
+                )
+                with self._lock:
+                    if path not in self._records:
+                        self._remember(record)
+        return record
+
+    def _persist(self, records: List[ArtifactRecord]) -> None:
+        "Write the records to the database in a single transaction."
+        if self.db is None or not records:
+            return
+        with self.db.transaction() as conn:
+            conn.executemany(
+                "INSERT OR REPLACE INTO artifacts"
+                " (path, filename, hashes, size, content_type, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                [
+                    (r.path, r.filename, json.dumps(r.hashes), r.size, r.content_type, r.updated)
+                    for r in records
+                ],
+            )
+
+    def record_not_found(self, index_url: str, path: str) -> None:
+        now = time.monotonic()
+        with self._lock:
+            self._not_found.pop((index_url, path), None)
+            self._not_found[(index_url, path)] = now + self.not_found_ttl
+            # The oldest expire first: drop those expired and those beyond the maximum.
+            while self._not_found:
+                key, expires = next(iter(self._not_found.items()))
+                if expires >= now and len(self._not_found) <= self.max_not_found:
+                    break
+                del self._not_found[key]
+
+    def is_not_found(self, index_url: str, path: str) -> bool:
+        "Did the index recently respond with a 404 for the path?"
+        expires = self._not_found.get((index_url, path))
+        if expires is None:
+            return False
+        if expires < time.monotonic():
+            with self._lock:
+                self._not_found.pop((index_url, path), None)
+            return False
+        return True
+
+    def forget_not_found(self, index_url: str, path: str) -> None:
+        with self._lock:
+            self._not_found.pop((index_url, path), None)
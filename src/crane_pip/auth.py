@@ -2,8 +2,9 @@
 from datetime import datetime, timedelta
 import time
 import logging
+import os
 import urllib3
-from typing import Dict
+from typing import Dict, Tuple, Union
 import webbrowser
 from urllib.parse import urlencode
 from .config import ServerConfig, server_configs
@@ -11,6 +12,9 @@ from .cache import CraneTokens, token_cache
 
 logger = logging.getLogger(__name__)
 
+# Requests to the crane server may not stall the start up of crane.
+TOKEN_REQUEST_TIMEOUT = urllib3.Timeout(connect=10.0, read=30.0)
+
 
 class ExpiredTokens(Exception):
     "Error raised when expired tokens were attempted to get used."
@@ -54,15 +58,22 @@ class AuthorizationPendingFailed(RequestError):
     pass
 
 
+class MissingSecret(Exception):
+    "The secret of a non-interactive grant is not available in the environment or file."
+
+    pass
+
+
 def _fetch_token(grant_type: str, grant_key: str, crane_config: ServerConfig) -> CraneTokens:
     """Fetch tokens based on the specified grant_type.
 
     Arguments:
     ----------
-    grant_type: "refresh_token" | "device_code"
+    grant_type: "refresh_token" | "device_code" | "client_credentials" | "token_exchange"
         Which grant type are we performing?
     grant_key: str
-        Refresh tokens incase grant_type == "refresh_token". Else the device_code.
+        Refresh tokens incase grant_type == "refresh_token", the device_code, the client secret or
+        the token to exchange.
     crane_config: ServerConfig
         Configs
 
@@ -97,6 +108,16 @@ def _fetch_token(grant_type: str, grant_key: str, crane_config: ServerConfig) ->
                 "device_code": grant_key,
             }
         )
+    elif grant_type == "client_credentials":
+        payload.update({"grant_type": "client_credentials", "client_secret": grant_key})
+    elif grant_type == "token_exchange":
+        payload.update(
+            {
+                "grant_type": "urn:ietf:params:oauth:grant-type:token-exchange",
+                "subject_token": grant_key,
+                "subject_token_type": "urn:ietf:params:oauth:token-type:jwt",
+            }
+        )
     else:
         raise TypeError(f"Unknonw grant_type: {grant_type}.")
 
@@ -108,6 +129,7 @@ def _fetch_token(grant_type: str, grant_key: str, crane_config: ServerConfig) ->
         url=crane_config.token_url,
         headers=headers,
         body=payload,
+        timeout=TOKEN_REQUEST_TIMEOUT,
     )
 
     try:
@@ -124,16 +146,20 @@ def _fetch_token(grant_type: str, grant_key: str, crane_config: ServerConfig) ->
             raise AuthorizationPendingFailed(
                 f"Authorization failed. Reason: {content['error_description']}"
             )
+        raise FailedTokenRequest(f"Token request failed: {content['error']}")
 
     now = datetime.now()
-    if content["refresh_expires_in"] == 0:
+    if "refresh_token" not in content:
+        # Eg. the client credentials grant: new tokens are requested with the grant again.
+        refresh_token_exp_time: Union[datetime, None] = now
+    elif content.get("refresh_expires_in", 0) == 0:
         refresh_token_exp_time = None
     else:
         refresh_token_exp_time = now + timedelta(seconds=content["refresh_expires_in"])
 
     return CraneTokens(
         access_token=content["access_token"],
-        refresh_token=content["refresh_token"],
+        refresh_token=content.get("refresh_token", ""),
         access_token_exp_time=now + timedelta(seconds=content["expires_in"]),
         refresh_token_exp_time=refresh_token_exp_time,
     )
@@ -151,6 +177,42 @@ def refresh(tokens: CraneTokens, crane_config: ServerConfig) -> CraneTokens:
     )
 
 
+def read_secret(crane_config: ServerConfig) -> str:
+    """The secret of the non-interactive grant: from the environment variable, else the file."""
+    if crane_config.secret_env and os.environ.get(crane_config.secret_env):
+        return os.environ[crane_config.secret_env].strip()
+    if crane_config.secret_file:
+        try:
+            with open(crane_config.secret_file, "r") as f:
+                secret = f.read().strip()
+        except OSError as e:
+            raise MissingSecret(f"Cannot read the secret file: {e}")
+        if secret:
+            return secret
+    raise MissingSecret(
+        f"No secret for the {crane_config.grant} grant: set the environment variable "
+        f"{crane_config.secret_env or '(none configured)'} "
+        f"or fill the file {crane_config.secret_file or '(none configured)'}."
+    )
+
+
+def fetch_service_tokens(crane_config: ServerConfig) -> CraneTokens:
+    """Fetch tokens with the non-interactive grant of the config. A single request, no polling.
+
+    Exceptions:
+    -----------
+    MissingSecret:
+        The secret of the grant is not available.
+    FailedTokenRequest / AuthorizationPendingFailed:
+        The crane server refused the request.
+    """
+    return _fetch_token(
+        grant_type=crane_config.grant,
+        grant_key=read_secret(crane_config),
+        crane_config=crane_config,
+    )
+
+
 def _request_device_code(crane_config) -> Dict:
     """Request a device code login. Reponsd with the content of the response."""
 
@@ -158,7 +220,11 @@ def _request_device_code(crane_config) -> Dict:
     payload = urlencode({"client_id": crane_config.client_id, "scope": "openid offline_access"})
     headers = {"Content-Type": "application/x-www-form-urlencoded"}
     response = urllib3.request(
-        method="POST", url=crane_config.device_url, body=payload, headers=headers
+        method="POST",
+        url=crane_config.device_url,
+        body=payload,
+        headers=headers,
+        timeout=TOKEN_REQUEST_TIMEOUT,
     )
 
     # breakpoint()
@@ -253,27 +319,43 @@ def get_access_token(crane_url: str) -> str:
         Incase there are no configurations found for the url which are needed if we want
         to request new tokens using the refresh token.
     """
-    tokens = token_cache[crane_url]
-    crane_config = server_configs[crane_url]
-
-    if not server_configs:
+    crane_config = server_configs.get(crane_url)
+    if not crane_config:
         raise UnregisterdServer(
-            "url = {crane_url} is not registed. "
+            f"url = {crane_url} is not registed. "
             "Please registed the crane server 'register' command."
         )
+    if crane_config.grant == "external":
+        return read_secret(crane_config)
 
-    if not tokens:
+    tokens = token_cache.get(crane_url)
+    if not tokens and crane_config.is_interactive():
         raise NoTokenCache(
             f"No authentication tokens are cached for {crane_url}."
             " Please authenticate first using the authenticate function."
         )
 
-    if not tokens.access_token_expired():
+    if tokens and not tokens.access_token_expired():
         return tokens.access_token
-    if tokens.expired_but_can_refresh():
-        new_tokens = refresh(tokens, crane_config)
-        token_cache[crane_url] = new_tokens
-        return new_tokens.access_token
+    # Another crane process might be refreshing (or have refreshed) the tokens.
+    with token_cache.exclusive():
+        tokens = token_cache.get(crane_url)
+        if tokens and not tokens.access_token_expired():
+            return tokens.access_token
+        if tokens and tokens.expired_but_can_refresh():
+            try:
+                new_tokens = refresh(tokens, crane_config)
+            except RequestError:
+                if crane_config.is_interactive():
+                    raise
+                # Eg. the refresh token was revoked: the grant gets new ones.
+                new_tokens = fetch_service_tokens(crane_config)
+            token_cache[crane_url] = new_tokens
+            return new_tokens.access_token
+        if not crane_config.is_interactive():
+            new_tokens = fetch_service_tokens(crane_config)
+            token_cache[crane_url] = new_tokens
+            return new_tokens.access_token
     raise ExpiredTokens
 
 
@@ -281,8 +363,13 @@ def authenticate(crane_url: str) -> str:
     """Authenticate with the device flow if necessary and return the access token.
 
     Preferable the token is first checked if present in the cache or if it can get refreshed.
+    Servers registered with a non-interactive grant never start the device flow.
     """
 
+    crane_config = server_configs.get(crane_url)
+    if crane_config and not crane_config.is_interactive():
+        return get_access_token(crane_url)
+
     token = token_cache.get(crane_url)
     if not token or token.is_expired():
         new_tokens = perform_device_auth_flow(crane_url)
@@ -290,3 +377,35 @@ def authenticate(crane_url: str) -> str:
         return new_tokens.access_token
 
     return get_access_token(crane_url)
+
+
+def login(crane_url: str) -> None:
+    """Authenticate anew, regardless of the cached tokens, and cache the new tokens.
+
+    For when the cached tokens are no longer accepted, eg. revoked by the identity provider. Running
+    proxies pick the new tokens up on reload, they need no restart."""
+    crane_config = server_configs.get(crane_url)
+    if not crane_config:
+        raise UnregisterdServer(
+            f"url = {crane_url} is not registed. "
+            "Please registed the crane server 'register' command."
+        )
+    if crane_config.grant == "external":
+        # Nothing to cache: the access token is read from the environment or file on every use.
+        read_secret(crane_config)
+        return
+    if crane_config.is_interactive():
+        token_cache[crane_url] = perform_device_auth_flow(crane_url)
+    else:
+        token_cache[crane_url] = fetch_service_tokens(crane_config)
+
+
+def reload_credentials() -> None:
+    "Reload the registered configs and the cached tokens from disk."
+    server_configs.reload()
+    token_cache.reload()
+
+
+def credentials_version() -> Tuple[int, int]:
+    "Changes whenever other crane processes changed the registered configs or cached tokens."
+    return server_configs.db.data_version(), token_cache.db.data_version()
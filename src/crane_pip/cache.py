@@ -3,12 +3,20 @@
 from __future__ import annotations
 
 from collections import UserDict
+from contextlib import contextmanager
 from datetime import datetime
 import os
-import json
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Dict, TYPE_CHECKING, Union
+from typing import Dict, Iterator, TYPE_CHECKING, Union
+
+from .db import MetadataStore
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None  # type: ignore
+    import msvcrt
 
 
 @dataclass
@@ -71,7 +79,7 @@ else:
 class TokenCache(TypedUserDict):
     """Dictionary with the cached crane server tokens. Key = crane server url,
 
-    Setting an item also writes away the the in-memory cached state to disk.
+    Setting (or deleting) an item also writes that item away to the metadata database on disk.
 
     Other modules should interact with the configs via the token_cache object
     and do not directly access this class! Else multiple in-memory states will get out of sync.
@@ -79,31 +87,69 @@ class TokenCache(TypedUserDict):
 
     cache_dir = os.path.join(Path.home(), ".cache", "crane", "python")
     os.makedirs(cache_dir, exist_ok=True)
+    db_file = os.path.join(cache_dir, "crane.db")
+    # Flat json cache of older versions. Imported into the database once.
     token_cache_file = os.path.join(cache_dir, "tokens.json")
 
     def __init__(self):
-        if not os.path.isfile(self.token_cache_file):
-            with open(self.token_cache_file, "w") as f:
-                f.write(json.dumps({}))
-            self.data = {}
-        else:
-            with open(self.token_cache_file, "r") as f:
-                raw_data = json.load(f)
-                self.data = {url: CraneTokens.from_json(tokens) for url, tokens in raw_data.items()}
+        self.db = MetadataStore(self.db_file)
+        self.db.import_legacy_json("tokens", self.token_cache_file)
+        self.reload()
+
+    def reload(self) -> None:
+        "Reload the in-memory state from disk. (Tokens might be updated by other crane processes.)"
+        self.data = {
+            url: CraneTokens.from_json(tokens)
+            for url, tokens in self.db.read_table("tokens").items()
+        }
+
+    @contextmanager
+    def exclusive(self) -> Iterator[TokenCache]:
+        """Hold the refresh lock of the token database (shared by all crane processes and threads)
+        and reload.
+
+        Used around token refreshes, such that a refresh token is not used by multiple crane
+        processes (eg. workers of the proxy) at once. The lock is a lock file next to the
+        database, not a transaction of it: a refresh waits on the identity provider, meanwhile
+        the database stays writable for others. The new tokens are written in a transaction of
+        their own."""
+        with _file_lock(self.db_file + ".lock"):
+            self.reload()
+            yield self
 
     def __setitem__(self, key: str, item: CraneTokens) -> None:
         self.data[key] = item
-        self._write()
+        self.db.write_entry("tokens", key, item.to_json())
 
     def __delitem__(self, key) -> None:
         del self.data[key]
-        self._write()
+        self.db.delete_entry("tokens", key)
 
-    def _write(self):
-        "Write current in memory state of the cache to disk"
-        to_write = {url: tokens.to_json() for url, tokens in self.data.items()}
-        with open(self.token_cache_file, "w") as f:
-            f.write(json.dumps(to_write))
+
+@contextmanager
+def _file_lock(path: str) -> Iterator[None]:
+    "Exclusive lock on the file, waiting for it. Every open of the file locks on its own."
+    with open(path, "a+b") as f:
+        if fcntl is not None:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            # Locks the first byte, also when the file is empty.
+            f.seek(0)
+            while True:
+                try:
+                    # Gives up after 10 attempts of a second.
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
 
 
 token_cache = TokenCache()
@@ -1,7 +1,8 @@
 import sys
 from difflib import get_close_matches
 from .argparser import subparser
-from .config import ServerConfig, server_configs
+from .auth import login
+from .config import GRANTS, ServerConfig, server_configs
 
 ### 'crane index'
 # Parser for the crane pip command (not to be confused with the pip command itself)
@@ -38,7 +39,45 @@ register_parser.add_argument(
 )
 register_parser.add_argument("client-id", help="Client-id that the crane client should use.")
 register_parser.add_argument("token-url", help="Url to request access/refresh tokens from.")
-register_parser.add_argument("device-url", help="Url to request the device code from.")
+register_parser.add_argument(
+    "device-url", help="Url to request the device code from. (Unused by the other grants.)"
+)
+register_parser.add_argument(
+    "--fallback-url",
+    action="append",
+    default=[],
+    help="Index url to fall back on for packages not found in the crane index (default: PyPI). "
+    "Can be given multiple times to register mirrors, the fastest healthy one is used.",
+)
+register_parser.add_argument(
+    "--grant",
+    choices=GRANTS,
+    default="device_code",
+    help="How to get tokens. 'device_code' (default) lets you log in with a browser. For CI "
+    "and services: 'client_credentials' with a client secret, 'token_exchange' with a token "
+    "(eg. the OIDC token of a CI job) or 'external' for an access token as is. Their secret "
+    "is read from --secret-env or --secret-file.",
+)
+register_parser.add_argument(
+    "--secret-env",
+    metavar="NAME",
+    help="Environment variable with the secret of the --grant.",
+)
+register_parser.add_argument(
+    "--secret-file",
+    metavar="PATH",
+    help="File with the secret of the --grant. (If the environment variable is not set.)",
+)
+register_parser.add_argument(
+    "--connect-timeout",
+    type=float,
+    help="Seconds to wait for a connection to the index. (Default: 10)",
+)
+register_parser.add_argument(
+    "--read-timeout",
+    type=float,
+    help="Seconds to wait for data from the index. (Default: 60)",
+)
 
 
 def entrypoint_register(args) -> int:
@@ -47,10 +86,21 @@ def entrypoint_register(args) -> int:
     # TODO maybe add some argument checking... Like is the url actually a resource protected by
     # a crane server.
 
+    if args.grant != "device_code" and not (args.secret_env or args.secret_file):
+        register_parser.error(f"--grant {args.grant} requires --secret-env or --secret-file")
+
     # Positional arguments containing a `-` can only be accessed through the internal dict.
     ns = args.__dict__
     server_configs[args.url] = ServerConfig(
-        client_id=ns["client-id"], token_url=ns["token-url"], device_url=ns["device-url"]
+        client_id=ns["client-id"],
+        token_url=ns["token-url"],
+        device_url=ns["device-url"],
+        grant=args.grant,
+        secret_env=args.secret_env,
+        secret_file=args.secret_file,
+        fallback_urls=args.fallback_url,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
     )
 
     return 0
@@ -89,6 +139,18 @@ def entrypoint_list(args) -> int:
             device_url=server_configs[u].device_url,
         )
         print(filled_in_template)
+        if not server_configs[u].is_interactive():
+            print(f"    grant: {server_configs[u].grant}")
+        if server_configs[u].secret_env:
+            print(f"    secret-env: {server_configs[u].secret_env}")
+        if server_configs[u].secret_file:
+            print(f"    secret-file: {server_configs[u].secret_file}")
+        if server_configs[u].fallback_urls:
+            print(f"    fallback-urls: {' '.join(server_configs[u].fallback_urls)}")
+        if server_configs[u].connect_timeout is not None:
+            print(f"    connect-timeout: {server_configs[u].connect_timeout}")
+        if server_configs[u].read_timeout is not None:
+            print(f"    read-timeout: {server_configs[u].read_timeout}")
     return 0
 
 
@@ -120,3 +182,30 @@ def entrypoint_remove(args) -> int:
 
 
 remove_parser.set_defaults(entrypoint_command=entrypoint_remove)
+
+
+### 'crane index login'
+login_parser = subsubparser.add_parser(
+    "login",
+    help="Authenticate anew with a registered crane index.",
+    description="Authenticate anew with a registered crane index, regardless of the cached tokens. "
+    "Eg. when the tokens were revoked. Running proxies ('crane serve') pick the new tokens up "
+    "without a restart.",
+)
+
+login_parser.add_argument("url", help="Index url to authenticate with.")
+
+
+def entrypoint_login(args) -> int:
+    if args.url not in server_configs:
+        sys.stderr.write(f'Index not found: "{args.url}"\n')
+        known_indexes = list(server_configs.keys())
+        close_match = get_close_matches(word=args.url, possibilities=known_indexes, n=1)
+        if close_match:
+            sys.stderr.write(f'Did you mean: "{close_match[0]}"?\n')
+        return 1
+    login(args.url)
+    return 0
+
+
+login_parser.set_defaults(entrypoint_command=entrypoint_login)
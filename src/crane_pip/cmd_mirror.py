@@ -0,0 +1,373 @@
+"""Static mirror of the packages of requirement/lock files, for installs without proxy or network.
+
+The mirror is a directory with a PEP 503 (html) and PEP 691 (json) simple index and the files:
+
+    <directory>/simple/index.html, index.json                root page
+    <directory>/simple/<project>/index.html, index.json      project pages
+    <directory>/files/<filename>                             files
+    <directory>/.crane-mirror.json                           manifest: sha256 and size per file
+
+pip can use it directly (`--index-url file:///<directory>/simple`, or `--no-index --find-links
+<directory>/files`) or it can be served by any static file server.
+
+Updates are incremental: the new version of the mirror is built next to the old one, in which the
+unchanged files and project pages are hardlinks to those of the old version. Only new files are
+downloaded and only the pages of changed projects are written. Then the new version replaces the
+old one, which is left as is if anything failed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+import html
+import json
+import os
+import shutil
+import sys
+import tempfile
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Union
+from urllib.parse import quote
+
+import urllib3
+from pip._vendor.packaging.tags import Tag, sys_tags
+
+from .argparser import add_proxy_arguments, proxy_kwargs, subparser
+from .cmd_prefetch import resolve_files
+from .lockfiles import LockFileError, PinnedPackage, read_lock_file
+from .proxy import IndexProxy, ProxyAddress
+from .simple import SimpleFile, parse_filename
+
+mirror_parser = subparser.add_parser(
+    "mirror",
+    help="Build a static index (PEP 503/691) with the files of requirement/lock files.",
+    description="Resolve the packages pinned in requirements.txt, pylock.toml, poetry.lock or "
+    "uv.lock files from the crane index and PyPI and write their files with a static simple "
+    "index to a directory, for pip to install from without proxy or authentication. An existing "
+    "mirror in the directory is updated incrementally.",
+)
+mirror_parser.add_argument("directory", help="Directory of the mirror.")
+mirror_parser.add_argument(
+    "files", nargs="+", help="requirements.txt, pylock.toml, poetry.lock or uv.lock files."
+)
+mirror_parser.add_argument(
+    "--index-url",
+    "-i",
+    help="Url of a registered crane index to resolve the packages from. (Default: only PyPI)",
+)
+mirror_parser.add_argument(
+    "--jobs", "-j", type=int, default=8, help="Number of parallel downloads. (Default: 8)"
+)
+mirror_parser.add_argument(
+    "--all-platforms",
+    action="store_true",
+    help="Mirror the files for all platforms. By default only the best matching wheel for this "
+    "interpreter (or else the sdist) is mirrored.",
+)
+add_proxy_arguments(mirror_parser, store_options=False)
+
+MANIFEST = ".crane-mirror.json"
+
+
+class MirrorError(Exception):
+    pass
+
+
+class MirrorResult(NamedTuple):
+    "Outcome of a mirror update."
+
+    projects: int = 0
+    # Projects of which the pages were (re)written.
+    rewritten: int = 0
+    downloaded: int = 0
+    # Files linked from the previous version of the mirror.
+    unchanged: int = 0
+    failed: int = 0
+    downloaded_bytes: int = 0
+    # Was the mirror replaced by the new version? (Not if anything failed.)
+    updated: bool = False
+
+
+def entrypoint_mirror(args) -> int:
+    "Entry point of the 'crane mirror' command"
+    packages: List[PinnedPackage] = []
+    try:
+        for file in args.files:
+            packages += read_lock_file(file)
+    except LockFileError as e:
+        sys.stderr.write(f"{e}\n")
+        return 1
+
+    supported_tags = None if args.all_platforms else list(sys_tags())
+    with IndexProxy(index_url=args.index_url, port=0, **proxy_kwargs(args)) as p:
+        try:
+            result = mirror(packages, p.proxy_address, args.directory, args.jobs, supported_tags)
+        except MirrorError as e:
+            sys.stderr.write(f"{e}\n")
+            return 1
+
+    print(
+        f"Mirrored {result.projects} projects ({result.rewritten} pages written): "
+        f"{result.downloaded} files downloaded ({result.downloaded_bytes / 1e6:.1f} MB), "
+        f"{result.unchanged} unchanged, {result.failed} failed."
+    )
+    if not result.updated:
+        print(f"{args.directory} was not updated.")
+        return 1
+    return 0
+
+
+mirror_parser.set_defaults(entrypoint_command=entrypoint_mirror)
+
+
+def read_manifest(directory: str) -> Dict[str, Dict[str, Union[str, int]]]:
+    """The files (name -> sha256 and size) of the mirror in the directory.
+
+    Empty if there is no mirror yet. Raises MirrorError for a directory that is not a mirror."""
+    if not os.path.exists(directory):
+        return {}
+    manifest = os.path.join(directory, MANIFEST)
+    if not os.path.exists(manifest):
+        if os.listdir(directory):
+            raise MirrorError(f"{directory} is not empty and not a mirror.")
+        return {}
+    try:
+        with open(manifest) as f:
+            return json.load(f)["files"]
+    except (OSError, ValueError, KeyError) as e:
+        raise MirrorError(f"Invalid manifest of the mirror {directory}: {e}")
+
+
+def mirror(
+    packages: Sequence[PinnedPackage],
+    proxy_address: ProxyAddress,
+    directory: str,
+    jobs: int = 8,
+    supported_tags: Union[Sequence[Tag], None] = None,
+) -> MirrorResult:
+    """Update the mirror in the directory to the files of the pinned packages, resolved and
+    downloaded through the proxy.
+
+    Arguments:
+    ----------
+    packages: Sequence[PinnedPackage]
+        The packages to mirror. Files of other packages are not kept.
+    proxy_address: ProxyAddress
+        Address of the proxy to resolve and download the files with.
+    directory: str
+        Directory of the mirror. Created if it does not exist.
+    jobs: int
+        Number of parallel page fetches and downloads.
+    supported_tags: Sequence[Tag] | None
+        Tags of the target interpreter, see `cmd_prefetch.select_files`. None for all platforms.
+    """
+    previous = read_manifest(directory)
+    base_url = proxy_address.url()
+    http = urllib3.PoolManager(maxsize=jobs)
+    selected, failed = resolve_files(packages, http, base_url, jobs, supported_tags)
+
+    directory = os.path.abspath(directory)
+    parent, name = os.path.split(directory)
+    os.makedirs(parent, exist_ok=True)
+    new = tempfile.mkdtemp(dir=parent, prefix=f".{name}-")
+    try:
+        os.chmod(new, 0o755)
+        os.makedirs(os.path.join(new, "files"))
+        files: Dict[str, Dict[str, Union[str, int]]] = {}
+
+        # Files of the previous version are linked, the others downloaded.
+        to_download: Dict[str, SimpleFile] = {}
+        for file in (f for project_files in selected.values() for f in project_files):
+            if file.filename in files or file.filename in to_download:
+                continue
+            if os.path.basename(file.filename) != file.filename or file.filename.startswith("."):
+                print(f"Skipping the file with an invalid name: {file.filename}")
+                failed += 1
+                continue
+            old = previous.get(file.filename)
+            expected = file.hashes.get("sha256")
+            if old and (not expected or expected == old["sha256"]):
+                try:
+                    _link(
+                        os.path.join(directory, "files", file.filename),
+                        os.path.join(new, "files", file.filename),
+                    )
+                    files[file.filename] = old
+                    continue
+                except FileNotFoundError:
+                    pass
+            to_download[file.filename] = file
+        unchanged = len(files)
+
+        def download(file: SimpleFile) -> Tuple[str, int]:
+            target = os.path.join(new, "files", file.filename)
+            resp = http.request("GET", file.url, preload_content=False)
+            try:
+                if resp.status != 200:
+                    raise urllib3.exceptions.HTTPError(f"status {resp.status}")
+                digest, size = sha256(), 0
+                with open(target + ".part", "wb") as f:
+                    for chunk in resp.stream(2**16):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+            finally:
+                resp.release_conn()
+            expected = file.hashes.get("sha256")
+            if expected and digest.hexdigest() != expected:
+                os.unlink(target + ".part")
+                raise ValueError(f"sha256 mismatch for {file.filename}")
+            os.replace(target + ".part", target)
+            return digest.hexdigest(), size
+
+        downloaded, downloaded_bytes, done = 0, 0, 0
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(download, f): f for f in to_download.values()}
+            for future in as_completed(futures):
+                filename = futures[future].filename
+                done += 1
+                try:
+                    digest, size = future.result()
+                except Exception as e:
+                    print(f"[{done}/{len(to_download)}] Failed to download {filename}: {e}")
+                    failed += 1
+                    continue
+                files[filename] = {"sha256": digest, "size": size}
+                downloaded += 1
+                downloaded_bytes += size
+                print(f"[{done}/{len(to_download)}] {filename} ({size / 1e6:.1f} MB)")
+
+        rewritten = _write_pages(new, directory, selected, files)
+        with open(os.path.join(new, MANIFEST), "w") as f:
+            json.dump({"files": files}, f, indent=1, sort_keys=True)
+
+        result = MirrorResult(
+            projects=len(selected),
+            rewritten=rewritten,
+            downloaded=downloaded,
+            unchanged=unchanged,
+            failed=failed,
+            downloaded_bytes=downloaded_bytes,
+        )
+        if failed:
+            return result
+        _replace(directory, new)
+        return result._replace(updated=True)
+    finally:
+        if os.path.exists(new):
+            shutil.rmtree(new)
+
+
+def _link(source: str, target: str) -> None:
+    "Hardlink the file, or copy it if the file system does not support that."
+    try:
+        os.link(source, target)
+    except FileNotFoundError:
+        raise
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def _write_pages(
+    new: str,
+    old: str,
+    selected: Dict[str, List[SimpleFile]],
+    files: Dict[str, Dict[str, Union[str, int]]],
+) -> int:
+    """Write the simple pages of the new version of the mirror. Pages that did not change are
+    linked to those of the old version. Returns the number of projects of which pages changed."""
+    rewritten = 0
+    for project, project_files in selected.items():
+        listed = sorted(
+            {f.filename: f for f in project_files if f.filename in files}.values(),
+            key=lambda f: f.filename,
+        )
+        pages = _project_pages(project, listed, files)
+        changed = False
+        for name, content in pages.items():
+            changed |= _write_page(new, old, os.path.join("simple", project, name), content)
+        rewritten += changed
+
+    projects = sorted(selected)
+    root = {
+        "index.html": _html_page(
+            "Simple index", [(html.escape(p), f"{quote(p)}/", "") for p in projects]
+        ),
+        "index.json": _json_page({"projects": [{"name": p} for p in projects]}),
+    }
+    for name, content in root.items():
+        _write_page(new, old, os.path.join("simple", name), content)
+    return rewritten
+
+
+def _write_page(new: str, old: str, path: str, content: bytes) -> bool:
+    "Write the page to the new version, or link the old one if the same. Was it changed?"
+    target, source = os.path.join(new, path), os.path.join(old, path)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        with open(source, "rb") as f:
+            if f.read() == content:
+                _link(source, target)
+                return False
+    except FileNotFoundError:
+        pass
+    with open(target, "wb") as f:
+        f.write(content)
+    return True
+
+
+def _project_pages(
+    project: str, listed: List[SimpleFile], files: Dict[str, Dict[str, Union[str, int]]]
+) -> Dict[str, bytes]:
+    "The html and json pages of a project listing its files."
+    links = []
+    json_files = []
+    for file in listed:
+        url = f"../../files/{quote(file.filename)}"
+        digest = files[file.filename]["sha256"]
+        attributes = ""
+        if file.requires_python:
+            attributes = f' data-requires-python="{html.escape(file.requires_python)}"'
+        links.append((html.escape(file.filename), f"{url}#sha256={digest}", attributes))
+        entry = {
+            "filename": file.filename,
+            "url": url,
+            "hashes": {"sha256": digest},
+            "size": files[file.filename]["size"],
+        }
+        if file.requires_python:
+            entry["requires-python"] = file.requires_python
+        json_files.append(entry)
+    infos = [parse_filename(f.filename) for f in listed]
+    versions = sorted({info.version for info in infos if info})
+    return {
+        "index.html": _html_page(f"Links for {project}", links),
+        "index.json": _json_page({"name": project, "versions": versions, "files": json_files}),
+    }
+
+
+def _html_page(title: str, links: List[Tuple[str, str, str]]) -> bytes:
+    "A PEP 503 page with the links: (text, href, extra attributes)."
+    anchors = "".join(
+        f'<a href="{html.escape(href)}"{attributes}>{text}</a><br>\n'
+        for text, href, attributes in links
+    )
+    return (
+        "<!DOCTYPE html>\n<html><head>"
+        '<meta name="pypi:repository-version" content="1.1">'
+        f"<title>{title}</title></head>\n<body>\n<h1>{title}</h1>\n{anchors}</body></html>\n"
+    ).encode()
+
+
+def _json_page(content: Dict) -> bytes:
+    "A PEP 691 page."
+    return json.dumps({"meta": {"api-version": "1.1"}, **content}, indent=1).encode()
+
+
+def _replace(directory: str, new: str) -> None:
+    "Put the new version of the mirror in place of the old one."
+    if not os.path.exists(directory):
+        os.rename(new, directory)
+        return
+    old = new + "-old"
+    os.rename(directory, old)
+    os.rename(new, directory)
+    shutil.rmtree(old)
@@ -1,16 +1,88 @@
-from typing import List, Union
-from subprocess import check_call, CalledProcessError
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Mapping, NamedTuple, Sequence, Union
+from subprocess import PIPE, STDOUT, check_call, run, CalledProcessError
 import logging
+import os
+import runpy
+import shutil
 import sys
+import warnings
+from urllib.parse import quote, urlsplit
 
-from .argparser import subparser
-from .proxy import ProxyAddress, IndexProxy
+from .argparser import add_proxy_arguments, proxy_kwargs, subparser
+from .auth import authenticate
+from .config import server_configs
+from .proxy import SELECT_PATH, ProxyAddress, IndexProxy
+from .simple import FileSelector
 
 logger = logging.getLogger(__name__)
 
+
+def env_flag(name: str) -> bool:
+    "Is the boolean environment variable set? Unset, empty, 0, false, no and off are off."
+    return os.environ.get(name, "").strip().lower() not in ("", "0", "false", "no", "off")
+
+
 # Parser for the crane pip command (not to be confused with the pip command itself)
 argparser_pip = subparser.add_parser(
-    "pip", help="Any pip command, but crane indexes do get correctly authenticated.", add_help=False
+    "pip",
+    help="Any pip command, but crane indexes do get correctly authenticated.",
+    add_help=False,
+    allow_abbrev=False,
+)
+add_proxy_arguments(argparser_pip)
+argparser_pip.add_argument(
+    "--requirement-set",
+    nargs=2,
+    action="append",
+    default=[],
+    metavar=("PYTHON", "REQUIREMENTS"),
+    help="Run the pip command for a target environment (python executable or venv directory) "
+    "with a requirements file appended as '-r REQUIREMENTS'. Can be given multiple times, the "
+    "pip processes then run concurrently against one shared proxy.",
+)
+argparser_pip.add_argument(
+    "--parallel",
+    type=int,
+    default=4,
+    help="Maximum number of concurrent pip processes for --requirement-set. (Default: 4)",
+)
+argparser_pip.add_argument(
+    "--shared-proxy",
+    metavar="URL",
+    help="Use an already running shared proxy ('crane serve --shared') instead of starting one. "
+    "Your access token of the crane index is passed along to it.",
+)
+argparser_pip.add_argument(
+    "--installer",
+    choices=("pip", "uv"),
+    default=os.environ.get("CRANE_INSTALLER", "pip"),
+    help="Run the command with pip or with uv ('uv pip ...', for its faster resolver and parallel "
+    "downloads). The index arguments are pointed at the proxy for either. (Default: pip, or the "
+    "CRANE_INSTALLER environment variable)",
+)
+argparser_pip.add_argument(
+    "--in-process",
+    action="store_true",
+    default=env_flag("CRANE_PIP_IN_PROCESS"),
+    help="Run pip inside the crane process instead of starting a second python interpreter. "
+    "Saves the startup time of a process for short pip commands. Not for uv or "
+    "--requirement-set. (Default: off, or on if the CRANE_PIP_IN_PROCESS environment variable is "
+    "set to eg. 1)",
+)
+argparser_pip.add_argument(
+    "--no-in-process",
+    action="store_false",
+    dest="in_process",
+    help="Run pip as a second python process, also when CRANE_PIP_IN_PROCESS is set.",
+)
+argparser_pip.add_argument(
+    "--select-compatible",
+    action="store_true",
+    help="Let the proxy leave out the files that can not be installed on this python (version, "
+    "platform and Requires-Python) from the project pages. Speeds up resolving projects with "
+    "many files. Not for --requirement-set or pip options targeting another platform.",
 )
 
 
@@ -18,26 +90,111 @@ class NoIndexError(Exception):
     pass
 
 
-def entrypoint_pip(args_for_pip) -> int:
-    "Entry point of the 'crane pip' command."
+def entrypoint_pip(args, args_for_pip: List[str]) -> int:
+    """Entry point of the 'crane pip' command.
+
+    `args` are the options parsed for crane itself, `args_for_pip` are passed on to pip."""
 
     # Arguments not explicitly parsed are meant for pip.
-    if not call_requires_index(args_for_pip):
-        call_pip(args=args_for_pip)
+    if args.requirement_set:
+        return entrypoint_pip_sets(args, args_for_pip)
+    if args.in_process and args.installer != "pip":
+        logger.warning(f"{args.installer} can not run in process, starting it as a sub-process.")
+    if not call_requires_index(args_for_pip, args.installer):
+        call_pip(args=args_for_pip, installer=args.installer, in_process=args.in_process)
         return 0
 
     url = get_index_url(args_for_pip)
-    with IndexProxy(index_url=url) as p:
-        new_args = prepare_pip_args(args=args_for_pip, proxy_address=p.proxy_address)
-        call_pip(args=new_args)
+    with proxied_index_url(args, url) as proxy_url:
+        if args.select_compatible:
+            proxy_url = selecting_url(proxy_url, FileSelector.for_interpreter())
+        new_args = prepare_pip_args(
+            args=args_for_pip, proxy_address=proxy_url, installer=args.installer
+        )
+        call_pip(
+            args=new_args,
+            installer=args.installer,
+            in_process=args.in_process,
+            index_url=proxy_url,
+        )
 
     return 0
 
 
+def entrypoint_pip_sets(args, args_for_pip: List[str]) -> int:
+    "Run the pip command for every requirement set concurrently. Exit code 1 if any failed."
+    sets = [RequirementSet(python, requirements) for python, requirements in args.requirement_set]
+    if args.in_process:
+        logger.warning("Requirement sets target other environments, pip runs as sub-processes.")
+    if not call_requires_index(args_for_pip, args.installer):
+        results = run_pip_sets(sets, args_for_pip, args.parallel, args.installer)
+    else:
+        url = get_index_url(args_for_pip)
+        with proxied_index_url(args, url) as proxy_url:
+            new_args = prepare_pip_args(
+                args=args_for_pip, proxy_address=proxy_url, installer=args.installer
+            )
+            results = run_pip_sets(sets, new_args, args.parallel, args.installer, proxy_url)
+
+    failed = [r for r in results if r.exit_code != 0]
+    print(f"{len(results) - len(failed)}/{len(results)} requirement sets succeeded.")
+    for r in failed:
+        print(f"  failed (exit code {r.exit_code}): {r.requirement_set.requirements}")
+    return 1 if failed else 0
+
+
 argparser_pip.set_defaults(entrypoint_pip=entrypoint_pip)
 
 
+@contextmanager
+def proxied_index_url(args, index_url: Union[str, None]) -> Iterator[str]:
+    "The index url pip should use: the shared proxy if given, otherwise a proxy started here."
+    if args.shared_proxy:
+        yield shared_proxy_url(args.shared_proxy, index_url)
+        return
+    with IndexProxy(index_url=index_url, **proxy_kwargs(args)) as p:
+        yield p.proxy_address.url()
+
+
+def shared_proxy_url(proxy_url: str, index_url: Union[str, None]) -> str:
+    """Url of a shared proxy with the access token of the (registered) index as credentials.
+
+    Pip sends the credentials of the url as Basic auth, from which the proxy takes the token. The
+    url is passed to pip in its environment, never on its command line. See `index_env`."""
+    proxy_url = proxy_url.rstrip("/")
+    if not index_url or index_url not in server_configs:
+        return proxy_url
+    token = authenticate(crane_url=index_url)
+    scheme, _, rest = proxy_url.partition("://")
+    return f"{scheme}://__token__:{quote(token, safe='')}@{rest}"
+
+
+def has_credentials(url: str) -> bool:
+    return urlsplit(url).password is not None
+
+
+def index_env(index_url: Union[str, None], installer: str = "pip") -> Dict[str, str]:
+    """Environment variables pointing the installer at an index url with credentials (eg. of the
+    shared proxy). Any local user can read the command line of a process (`ps`), its environment
+    only the user itself. Empty for urls without credentials, which go on the command line."""
+    if not index_url or not has_credentials(index_url):
+        return {}
+    return {"UV_INDEX_URL" if installer == "uv" else "PIP_INDEX_URL": index_url}
+
+
+def selecting_url(proxy_url: str, selector: FileSelector) -> str:
+    "Index url of the proxy serving the pages with only the files selected."
+    return proxy_url.rstrip("/") + SELECT_PATH + quote(selector.to_query(), safe="")
+
+
 PIP_COMMANDS_WITH_INDEX = {"install", "download", "search", "index", "wheel"}
+UV_COMMANDS_WITH_INDEX = {"install", "compile", "sync"}
+
+# Options (taking a value) selecting the indexes. Replaced by the proxy.
+PIP_INDEX_OPTIONS = {"--index-url", "-i", "--extra-index-url"}
+UV_INDEX_OPTIONS = PIP_INDEX_OPTIONS | {"--index", "--default-index"}
+# Environment variables of uv selecting the indexes, which would bypass the proxy.
+UV_INDEX_ENV = ("UV_INDEX_URL", "UV_EXTRA_INDEX_URL", "UV_INDEX", "UV_DEFAULT_INDEX")
 
 
 def get_index_url(args: List[str]) -> Union[str, None]:
@@ -48,17 +205,22 @@ def get_index_url(args: List[str]) -> Union[str, None]:
             return arg
         if arg == "-i" or arg == "--index-url":
             is_url = True
+        elif arg.startswith("--index-url="):
+            return arg.partition("=")[2]
     return None
 
 
-def call_requires_index(args: List[str]) -> bool:
+def call_requires_index(args: List[str], installer: str = "pip") -> bool:
     "Does the pip call in question require the index?"
-    if args and set(args).intersection(PIP_COMMANDS_WITH_INDEX):
+    commands = UV_COMMANDS_WITH_INDEX if installer == "uv" else PIP_COMMANDS_WITH_INDEX
+    if args and set(args).intersection(commands):
         return True
     return False
 
 
-def prepare_pip_args(args: List[str], proxy_address: ProxyAddress) -> List[str]:
+def prepare_pip_args(
+    args: List[str], proxy_address: Union[ProxyAddress, str], installer: str = "pip"
+) -> List[str]:
     """Prepare the argument list for the pip-subprocess call based on the crane pip args
 
     Arguments:
@@ -66,27 +228,38 @@ def prepare_pip_args(args: List[str], proxy_address: ProxyAddress) -> List[str]:
     args: List[str]
         Argument list of the the pip command portion. Eg. the list of arguments one would issue
         to a normal `pip {args}` command (without the `pip` portion then).
-    proxy_address: Address
-        The address list on which the local proxy/index is exposed and we have to point to
+    proxy_address: ProxyAddress | str
+        The address (or url) on which the proxy/index is exposed and we have to point to
         subprocess pip call to.
+    installer: "pip" | "uv"
+        The installer that runs the command. uv has more options selecting indexes.
+
+    A url with credentials is not added to the arguments: it goes in the environment of the
+    installer, see `index_env`.
     """
-    if not call_requires_index(args):
+    if not call_requires_index(args, installer):
         return args
 
     # Filter out --index and --extra-index specification
+    index_options = UV_INDEX_OPTIONS if installer == "uv" else PIP_INDEX_OPTIONS
     filtered_args = []
     skip = False
     for arg in args:
         if skip:
             skip = False
             continue
-        if arg == "--index-url" or arg == "-i" or arg == "--extra-index-url":
+        if arg in index_options:
             skip = True
             continue
+        if arg.partition("=")[0] in index_options:
+            continue
         filtered_args.append(arg)
 
     # Point pip towards the local proxy
-    resulting_args = filtered_args + ["-i", proxy_address.url()]
+    url = proxy_address if isinstance(proxy_address, str) else proxy_address.url()
+    if has_credentials(url):
+        return filtered_args
+    resulting_args = filtered_args + ["-i", url]
     return resulting_args
 
 
@@ -106,8 +279,51 @@ class LaunchPipError(PipError):
     pass
 
 
-def call_pip(args: List[str] = []) -> None:
-    """Call pip in a sub-process with the list of arguments specified.
+def find_uv() -> str:
+    "Path of the uv executable: on the PATH or installed as python package."
+    uv = shutil.which("uv")
+    if uv:
+        return uv
+    try:
+        from uv import find_uv_bin  # type: ignore
+    except ImportError:
+        raise NoExecutableError("Could not find uv. Install it with 'pip install uv'.")
+    return find_uv_bin()
+
+
+def installer_command(python: str, args: List[str], installer: str = "pip") -> List[str]:
+    """The command line running pip (or 'uv pip') with the arguments for the python environment.
+
+    uv does not run inside the environment, it is given the python with --python (unless the
+    arguments select the environment themselves)."""
+    if installer == "uv":
+        command = [find_uv(), "pip"] + args
+        if not {"--python", "-p", "--system", "--target", "--prefix"} & set(args):
+            command += ["--python", python]
+        return command
+    return [python, "-m", "pip"] + args
+
+
+def installer_env(
+    installer: str = "pip", index_url: Union[str, None] = None
+) -> Union[Dict[str, str], None]:
+    """Environment of the installer process, with the `index_env` of the index url. None for the
+    environment of crane itself."""
+    extra = index_env(index_url, installer)
+    if installer != "uv" and not extra:
+        return None
+    env = {k: v for k, v in os.environ.items() if installer != "uv" or k not in UV_INDEX_ENV}
+    env.update(extra)
+    return env
+
+
+def call_pip(
+    args: List[str] = [],
+    installer: str = "pip",
+    in_process: bool = False,
+    index_url: Union[str, None] = None,
+) -> None:
+    """Call pip in a sub-process (or in this process) with the list of arguments specified.
 
     Arguments:
     ----------
@@ -116,6 +332,13 @@ def call_pip(args: List[str] = []) -> None:
         be specified.
 
         Eg. to install a pkg the argument list looks like: ['install', 'pkg']
+    installer: "pip" | "uv"
+        Run the command with pip or with 'uv pip'. (Default: pip)
+    in_process: bool
+        Run pip in this process, see `run_pip_in_process`. Ignored for uv. (Default: False)
+    index_url: str | None
+        The index url the arguments were prepared for. Set in the environment if it has
+        credentials, see `index_env`. (Default: None)
 
     Returns:
     --------
@@ -132,6 +355,13 @@ def call_pip(args: List[str] = []) -> None:
         Pip could not get launched.
     """
 
+    if in_process and installer == "pip":
+        exit_code = run_pip_in_process(args, index_env(index_url))
+        if exit_code != 0:
+            logger.critical(f"pip crashed with an exit-code: {exit_code}.")
+            raise RuntimePipError("pip failed")
+        return
+
     exec = sys.executable
     if not exec:
         raise NoExecutableError("Could not find any python executable")
@@ -139,8 +369,8 @@ def call_pip(args: List[str] = []) -> None:
     logger.info(f"Using executable to call pip: {exec}")
 
     try:
-        full_call = [exec, "-m", "pip"] + args
-        check_call(args=full_call)
+        full_call = installer_command(exec, args, installer)
+        check_call(args=full_call, env=installer_env(installer, index_url))
     except CalledProcessError as e:
         logger.critical(f"pip crashed with an exit-code: {e.returncode}.")
         if e.stderr:
@@ -149,3 +379,136 @@ def call_pip(args: List[str] = []) -> None:
     except Exception as e:
         logger.critical(f"pip process failed to launch with the following error: {e}")
         raise LaunchPipError("Failed to launch pip") from e
+
+
+@contextmanager
+def isolated_interpreter_state() -> Iterator[None]:
+    """Restore the state of the interpreter that pip changes when it runs in this process.
+
+    That is the argv, the environment, the module search path, the warning filters and the
+    logging: pip configures the root logger for its console output, the logs of crane (eg. of the
+    proxy serving pip meanwhile) are kept out of it."""
+    argv, path, environ = sys.argv[:], sys.path[:], dict(os.environ)
+    showwarning, filters = warnings.showwarning, warnings.filters[:]
+    root = logging.getLogger()
+    handlers, level = root.handlers[:], root.level
+    crane_logger = logging.getLogger(__package__)
+    propagate = crane_logger.propagate
+    crane_logger.propagate = False
+    try:
+        yield
+    finally:
+        sys.argv, sys.path[:] = argv, path
+        os.environ.clear()
+        os.environ.update(environ)
+        warnings.showwarning = showwarning
+        warnings.filters[:] = filters
+        for handler in root.handlers[:]:
+            if handler not in handlers:
+                root.removeHandler(handler)
+                handler.close()
+        for handler in handlers:
+            if handler not in root.handlers:
+                root.addHandler(handler)
+        root.setLevel(level)
+        crane_logger.propagate = propagate
+
+
+def run_pip_in_process(args: List[str], env: Mapping[str, str] = {}) -> int:
+    """Run the pip command line in this process, as `python -m pip {args}` would, with the
+    environment variables `env` set. Returns the exit code of pip.
+
+    This spares starting a second interpreter (and importing crane in it for nothing) at the cost
+    of running pip in an interpreter it does not own: pip does not support being run in process,
+    it assumes it owns the interpreter. pip runs in the calling thread, the proxy keeps serving
+    from its own. pip is run as its `__main__` module (with `runpy`, so no internals of pip are
+    relied upon). It changes process wide state (argv, environment, logging, ...) as a program
+    that exits after would, `isolated_interpreter_state` restores that state after."""
+    logger.info("Running pip in process.")
+    with isolated_interpreter_state():
+        sys.argv = ["pip"] + list(args)
+        os.environ.update(env)
+        try:
+            runpy.run_module("pip", run_name="__main__", alter_sys=True)
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                return e.code or 0
+            print(e.code, file=sys.stderr)
+            return 1
+    return 0
+
+
+class RequirementSet(NamedTuple):
+    "A requirements file to be installed in a target environment."
+
+    # Python executable or venv directory.
+    python: str
+    requirements: str
+
+    def executable(self) -> str:
+        "Python executable of the target environment."
+        if os.path.isdir(self.python):
+            if sys.platform == "win32":
+                return os.path.join(self.python, "Scripts", "python.exe")
+            return os.path.join(self.python, "bin", "python")
+        return self.python
+
+
+class RequirementSetResult(NamedTuple):
+    requirement_set: RequirementSet
+    exit_code: int
+    # Combined stdout and stderr of the pip process.
+    log: str
+
+
+def run_pip_sets(
+    sets: Sequence[RequirementSet],
+    args: List[str],
+    parallel: int = 4,
+    installer: str = "pip",
+    index_url: Union[str, None] = None,
+) -> List[RequirementSetResult]:
+    """Run pip concurrently for each of the requirement sets.
+
+    The output of each pip process is captured and printed as a single block once the process
+    finished, so the logs of concurrent processes do not interleave.
+
+    Arguments:
+    ----------
+    sets: Sequence[RequirementSet]
+        The target environments with their requirements files.
+    args: list[str]
+        Pip arguments shared by all sets. `-r {requirements}` is appended per set.
+    parallel: int
+        Maximum number of pip processes running at the same time.
+    installer: "pip" | "uv"
+        Run the commands with pip or with 'uv pip'. (Default: pip)
+    index_url: str | None
+        The index url the arguments were prepared for, see `call_pip`. (Default: None)
+    """
+    env = installer_env(installer, index_url)
+
+    def run_set(requirement_set: RequirementSet) -> RequirementSetResult:
+        try:
+            full_call = installer_command(
+                requirement_set.executable(),
+                args + ["-r", requirement_set.requirements],
+                installer,
+            )
+            process = run(full_call, stdout=PIPE, stderr=STDOUT, env=env)
+        except (OSError, NoExecutableError) as e:
+            return RequirementSetResult(requirement_set, exit_code=1, log=f"Failed to launch: {e}")
+        return RequirementSetResult(
+            requirement_set, process.returncode, process.stdout.decode(errors="replace")
+        )
+
+    results = []
+    with ThreadPoolExecutor(max_workers=max(parallel, 1)) as executor:
+        futures = [executor.submit(run_set, s) for s in sets]
+        for future in as_completed(futures):
+            result = future.result()
+            s = result.requirement_set
+            print(f"==> {s.requirements} ({s.executable()}) exit code: {result.exit_code}")
+            print(result.log, end="" if result.log.endswith("\n") else "\n", flush=True)
+            results.append(result)
+    return results
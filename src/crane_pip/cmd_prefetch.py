@@ -0,0 +1,239 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from hashlib import sha256
+import math
+import sys
+from typing import Dict, List, NamedTuple, Sequence, Tuple, Union
+
+import urllib3
+from pip._vendor.packaging.tags import Tag, sys_tags
+
+from .argparser import add_proxy_arguments, proxy_kwargs, subparser
+from .lockfiles import LockFileError, PinnedPackage, read_lock_file
+from .proxy import IndexProxy, ProxyAddress
+from .simple import SimpleFile, parse_filename, parse_page, same_version
+from .store import LastKnownGoodStore
+
+prefetch_parser = subparser.add_parser(
+    "prefetch",
+    help="Download the files of requirement/lock files into the local store of the proxy.",
+    description="Resolve the packages pinned in requirements.txt, pylock.toml, poetry.lock or "
+    "uv.lock files through the index proxy and download their files in parallel into the "
+    "last-known-good store. Later 'crane pip' and 'crane serve' runs serve these files locally.",
+)
+prefetch_parser.add_argument(
+    "files", nargs="+", help="requirements.txt, pylock.toml, poetry.lock or uv.lock files."
+)
+prefetch_parser.add_argument(
+    "--index-url",
+    "-i",
+    help="Url of a registered crane index to resolve the packages from. (Default: only PyPI)",
+)
+prefetch_parser.add_argument(
+    "--jobs", "-j", type=int, default=8, help="Number of parallel downloads. (Default: 8)"
+)
+prefetch_parser.add_argument(
+    "--all-platforms",
+    action="store_true",
+    help="Download the files for all platforms. By default only the best matching wheel for "
+    "this interpreter (or else the sdist) is downloaded.",
+)
+add_proxy_arguments(prefetch_parser, store_options=False)
+
+# Prefer json pages, they are quicker to parse.
+PAGE_ACCEPT = "application/vnd.pypi.simple.v1+json, application/vnd.pypi.simple.v1+html;q=0.1"
+
+
+class PrefetchResult(NamedTuple):
+    "Outcome of a prefetch."
+
+    downloaded: int = 0
+    already_stored: int = 0
+    failed: int = 0
+    downloaded_bytes: int = 0
+
+
+def entrypoint_prefetch(args) -> int:
+    "Entry point of the 'crane prefetch' command"
+    packages: List[PinnedPackage] = []
+    try:
+        for file in args.files:
+            packages += read_lock_file(file)
+    except LockFileError as e:
+        sys.stderr.write(f"{e}\n")
+        return 1
+
+    store = LastKnownGoodStore()
+    supported_tags = None if args.all_platforms else list(sys_tags())
+    with IndexProxy(index_url=args.index_url, port=0, store=store, **proxy_kwargs(args)) as p:
+        result = prefetch(packages, p.proxy_address, store, args.jobs, supported_tags)
+
+    print(
+        f"Prefetched {result.downloaded} files ({result.downloaded_bytes / 1e6:.1f} MB), "
+        f"{result.already_stored} already stored, {result.failed} failed."
+    )
+    return 1 if result.failed else 0
+
+
+prefetch_parser.set_defaults(entrypoint_command=entrypoint_prefetch)
+
+
+def select_files(
+    files: Sequence[SimpleFile],
+    package: PinnedPackage,
+    supported_tags: Union[Sequence[Tag], None],
+) -> List[SimpleFile]:
+    """Select the files of the page belonging to the pinned package.
+
+    Arguments:
+    ----------
+    files: Sequence[SimpleFile]
+        Files listed on the page of the project.
+    package: PinnedPackage
+        The pinned package. If the lock file listed file names or hashes, only those are selected.
+    supported_tags: Sequence[Tag] | None
+        Tags supported by the target interpreter in order of preference. Only the best matching
+        wheel (or if none, a sdist) is selected. None selects the files of all platforms.
+    """
+    candidates = []
+    for file in files:
+        if package.filenames and file.filename not in package.filenames:
+            continue
+        # Files without hashes on the page are left for the installer to verify.
+        if package.hashes and file.hashes:
+            if not {f"{a}:{v}" for a, v in file.hashes.items()} & package.hashes:
+                continue
+        if file.yanked and not (package.filenames or package.hashes):
+            continue
+        info = parse_filename(file.filename)
+        if info and same_version(info.version, package.version):
+            candidates.append((file, info))
+
+    if supported_tags is None:
+        return [file for file, _ in candidates]
+
+    ranking = {tag: i for i, tag in enumerate(supported_tags)}
+    best_wheel, best_rank = None, math.inf
+    for file, info in candidates:
+        if info.tags:
+            rank = min(ranking.get(tag, math.inf) for tag in info.tags)
+            if rank < best_rank:
+                best_wheel, best_rank = file, rank
+    if best_wheel:
+        return [best_wheel]
+    return [file for file, info in candidates if info.tags is None][:1]
+
+
+def resolve_files(
+    packages: Sequence[PinnedPackage],
+    http: urllib3.PoolManager,
+    base_url: str,
+    jobs: int = 8,
+    supported_tags: Union[Sequence[Tag], None] = None,
+) -> Tuple[Dict[str, List[SimpleFile]], int]:
+    """Select the files of the pinned packages on their project pages, fetched in parallel from
+    the proxy at `base_url`. Failures are printed.
+
+    Returns:
+    --------
+    The selected files per project (urls of the proxy) and the number of packages that failed.
+    """
+
+    def fetch_page(name: str) -> List[SimpleFile]:
+        resp = http.request("GET", f"{base_url}/{name}/", headers={"Accept": PAGE_ACCEPT})
+        if resp.status != 200:
+            raise urllib3.exceptions.HTTPError(f"status {resp.status}")
+        return parse_page(resp.data, resp.headers.get("Content-Type", ""), f"{base_url}/{name}/")
+
+    by_project: Dict[str, List[PinnedPackage]] = {}
+    for package in packages:
+        by_project.setdefault(package.name, []).append(package)
+
+    selected: Dict[str, List[SimpleFile]] = {}
+    failed = 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(fetch_page, name): name for name in by_project}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                files = future.result()
+            except Exception as e:
+                print(f"Failed to fetch the page of {name}: {e}")
+                failed += len(by_project[name])
+                continue
+            project_files: Dict[str, SimpleFile] = {}
+            for package in by_project[name]:
+                package_files = select_files(files, package, supported_tags)
+                if not package_files:
+                    print(f"No files found for {package.name}=={package.version}")
+                    failed += 1
+                for file in package_files:
+                    project_files[file.url] = file
+            selected[name] = list(project_files.values())
+    return selected, failed
+
+
+def prefetch(
+    packages: Sequence[PinnedPackage],
+    proxy_address: ProxyAddress,
+    store: LastKnownGoodStore,
+    jobs: int = 8,
+    supported_tags: Union[Sequence[Tag], None] = None,
+) -> PrefetchResult:
+    """Download the files of the pinned packages through the proxy, which stores them.
+
+    First the project pages are fetched and the files are selected, then the files that are not
+    stored yet are downloaded. Both in parallel with `jobs` workers. Progress is printed.
+    """
+    base_url = proxy_address.url()
+    http = urllib3.PoolManager(maxsize=jobs)
+
+    # Step 1: resolve the files via the project pages.
+    selected, failed = resolve_files(packages, http, base_url, jobs, supported_tags)
+    to_download = {file.url: file for files in selected.values() for file in files}
+
+    # Step 2: download the files not stored yet.
+    paths = {url: url[len(base_url) :] for url in to_download}
+    missing = [url for url in to_download if not store.has(paths[url])]
+    already_stored = len(to_download) - len(missing)
+    done = 0
+
+    def download(url: str) -> Tuple[str, int]:
+        file = to_download[url]
+        resp = http.request("GET", url, preload_content=False)
+        try:
+            if resp.status != 200:
+                raise urllib3.exceptions.HTTPError(f"status {resp.status}")
+            digest, size = sha256(), 0
+            for chunk in resp.stream(2**16):
+                digest.update(chunk)
+                size += len(chunk)
+        finally:
+            resp.release_conn()
+        expected = file.hashes.get("sha256")
+        if expected and digest.hexdigest() != expected:
+            store.remove(paths[url])
+            raise ValueError(f"sha256 mismatch for {file.filename}")
+        return file.filename, size
+
+    downloaded, downloaded_bytes = 0, 0
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(download, url): url for url in missing}
+        for future in as_completed(futures):
+            done += 1
+            try:
+                filename, size = future.result()
+            except Exception as e:
+                filename = to_download[futures[future]].filename
+                print(f"[{done}/{len(missing)}] Failed to download {filename}: {e}")
+                failed += 1
+                continue
+            downloaded += 1
+            downloaded_bytes += size
+            print(f"[{done}/{len(missing)}] {filename} ({size / 1e6:.1f} MB)")
+
+    return PrefetchResult(
+        downloaded=downloaded,
+        already_stored=already_stored,
+        failed=failed,
+        downloaded_bytes=downloaded_bytes,
+    )
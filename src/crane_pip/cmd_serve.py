@@ -1,4 +1,4 @@
-from .argparser import subparser
+from .argparser import add_proxy_arguments, proxy_kwargs, subparser
 from .proxy import IndexProxy
 
 server_parser = subparser.add_parser(
@@ -12,12 +12,42 @@ server_parser.add_argument(
     help="Index url to forward the requests to. Note, the url should have already been registered by the 'crane index register' command.",
 )
 server_parser.add_argument("--port", "-p", help="port to serve the proxy under.", default=9999)
+server_parser.add_argument(
+    "--shared",
+    action="store_true",
+    help="Serve multiple users: the proxy does not authenticate itself but uses the access token "
+    "each client sends (eg. via 'crane pip --shared-proxy'). Only public files are shared.",
+)
+server_parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="Number of worker processes serving the proxy. Dead workers are restarted. (Default: 1)",
+)
+server_parser.add_argument(
+    "--reload-interval",
+    type=float,
+    default=2.0,
+    metavar="SECONDS",
+    help="Check this often whether the registered configs or tokens changed (eg. by 'crane index "
+    "register' or 'crane index login') and reload them. 0 to only reload on SIGHUP. (Default: 2)",
+)
+add_proxy_arguments(server_parser)
 
 
 def entrypoint_serve(args):
-    proxy = IndexProxy(index_url=args.url, port=args.port)
+    proxy = IndexProxy(
+        index_url=args.url,
+        port=args.port,
+        shared=args.shared,
+        reload_interval=args.reload_interval or None,
+        **proxy_kwargs(args),
+    )
     print(f"Serving index proxy on: {proxy.proxy_address.url()}")
-    proxy.start_here()
+    if args.workers > 1:
+        proxy.start_workers(args.workers)
+    else:
+        proxy.start_here()
     return 0
 
 
@@ -0,0 +1,183 @@
+"""Coalescing of identical concurrent requests into a single upstream fetch.
+
+The first request for a key becomes the leader and performs the fetch. Requests with the same key
+arriving while the fetch is in flight become followers: they wait for the response of the leader
+instead of doing a fetch of their own. Bodies are streamed tee-style: every chunk the leader
+receives is spooled and handed to the followers as soon as it arrives, so followers do not wait
+for the complete body (nor do they miss the start of it when joining late). Small bodies are
+spooled in memory, large ones (files) to a temporary file.
+"""
+
+from bisect import bisect_right
+import os
+import tempfile
+from threading import Condition, Lock
+from typing import IO, Dict, Hashable, Iterable, Iterator, List, Tuple, Union
+
+# Bodies up to this many bytes are spooled in memory, larger ones to a temporary file.
+SPOOL_MEMORY = 2**20
+# Bytes read from the temporary file at once.
+READ_SIZE = 2**16
+
+
+class FetchFailed(Exception):
+    "The leader of a coalesced fetch failed."
+
+    pass
+
+
+class Spool:
+    """Append-only copy of a body, read at any offset. In memory (as the chunks appended) up to
+    `max_memory` bytes, then moved to a temporary file. Closed with the file when collected."""
+
+    def __init__(self, max_memory: int = SPOOL_MEMORY) -> None:
+        self.max_memory = max_memory
+        self.size = 0
+        self._lock = Lock()
+        self._chunks: List[bytes] = []
+        # Offset of every chunk in memory.
+        self._starts: List[int] = []
+        self._file: Union[IO[bytes], None] = None
+
+    def append(self, chunk: bytes) -> None:
+        with self._lock:
+            if self._file is None and self.size + len(chunk) > self.max_memory:
+                self._file = tempfile.TemporaryFile()
+                self._file.writelines(self._chunks)
+                self._chunks, self._starts = [], []
+            if self._file is not None:
+                # Reads move the position.
+                self._file.seek(0, os.SEEK_END)
+                self._file.write(chunk)
+            else:
+                self._chunks.append(chunk)
+                self._starts.append(self.size)
+            self.size += len(chunk)
+
+    def read(self, offset: int) -> bytes:
+        "The bytes from `offset` on: the rest of the chunk in memory, or a block of the file."
+        with self._lock:
+            if self._file is not None:
+                self._file.seek(offset)
+                return self._file.read(READ_SIZE)
+            i = bisect_right(self._starts, offset) - 1
+            if i < 0:
+                return b""
+            return self._chunks[i][offset - self._starts[i] :]
+
+    def spooled_to_file(self) -> bool:
+        return self._file is not None
+
+
+class InflightFetch:
+    """A single fetch shared by a leader and any number of followers."""
+
+    def __init__(self) -> None:
+        self._cond = Condition()
+        self._head: Union[Tuple[int, Dict[str, str]], None] = None
+        self._content: Union[bytes, None] = None
+        self._streaming = False
+        self._spool = Spool()
+        self._done = False
+        self._error: Union[BaseException, None] = None
+        self.followers = 0
+
+    # Leader side
+    def publish(
+        self,
+        status: int,
+        headers: Dict[str, str],
+        content: Union[bytes, None] = None,
+        stream: Union[Iterable[bytes], None] = None,
+    ) -> Union[Iterator[bytes], None]:
+        """Publish the response of the leader.
+
+        For a streamed body the returned iterator must be consumed by the leader (completely, even
+        if its own client went away) as it feeds the followers."""
+        with self._cond:
+            self._head = (status, headers)
+            self._content = content
+            self._streaming = stream is not None
+            if stream is None:
+                self._done = True
+            self._cond.notify_all()
+        if stream is None:
+            return None
+        return self._tee(stream)
+
+    def _tee(self, stream: Iterable[bytes]) -> Iterator[bytes]:
+        try:
+            for chunk in stream:
+                self._spool.append(chunk)
+                with self._cond:
+                    self._cond.notify_all()
+                yield chunk
+        except BaseException as e:
+            self.fail(e)
+            raise
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def fail(self, error: BaseException) -> None:
+        with self._cond:
+            if not self._done:
+                self._error = error
+                self._done = True
+                self._cond.notify_all()
+
+    # Follower side
+    def wait_head(self) -> Tuple[int, Dict[str, str]]:
+        "Wait for the status and headers of the response."
+        with self._cond:
+            self._cond.wait_for(lambda: self._head is not None or self._done)
+            if self._head is None:
+                raise FetchFailed("Leading request failed") from self._error
+            return self._head
+
+    @property
+    def content(self) -> Union[bytes, None]:
+        "Content of a non-streamed response."
+        return self._content
+
+    @property
+    def streaming(self) -> bool:
+        return self._streaming
+
+    def iter_body(self) -> Iterator[bytes]:
+        "Iterate over the chunks of a streamed body as they arrive."
+        offset = 0
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: offset < self._spool.size or self._done)
+                if offset >= self._spool.size:
+                    if self._error:
+                        raise FetchFailed("Leading request failed") from self._error
+                    return
+            chunk = self._spool.read(offset)
+            offset += len(chunk)
+            yield chunk
+
+
+class Coalescer:
+    "Registry of the in flight fetches by key."
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._inflight: Dict[Hashable, InflightFetch] = {}
+
+    def join(self, key: Hashable) -> Tuple[InflightFetch, bool]:
+        "Join the in flight fetch of the key, or start one. Returns the fetch and if we lead it."
+        with self._lock:
+            fetch = self._inflight.get(key)
+            if fetch:
+                fetch.followers += 1
+                return fetch, False
+            fetch = self._inflight[key] = InflightFetch()
+            return fetch, True
+
+    def release(self, key: Hashable, fetch: InflightFetch) -> None:
+        "Stop new requests from joining the fetch. Called by the leader once its fetch is complete."
+        with self._lock:
+            if self._inflight.get(key) is fetch:
+                del self._inflight[key]
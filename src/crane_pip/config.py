@@ -4,10 +4,20 @@ from __future__ import annotations
 
 from collections import UserDict
 import os
-import json
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, TYPE_CHECKING
+from typing import Dict, List, TYPE_CHECKING, Union
+
+from .db import MetadataStore
+
+
+# Grants with which tokens are requested from the crane server. Only the device code grant is
+# interactive (the user logs in with a browser), the others suit CI runners and services:
+# client_credentials: The client secret is exchanged for tokens.
+# token_exchange: A token of another identity provider (eg. the OIDC token of a CI job) is
+#   exchanged for tokens. (RFC 8693)
+# external: The access token is supplied as is.
+GRANTS = ("device_code", "client_credentials", "token_exchange", "external")
 
 
 @dataclass
@@ -18,18 +28,47 @@ class ServerConfig:
     client_id: str
     token_url: str
     device_url: str
+    grant: str = "device_code"
+    # Environment variable and/or file holding the secret of the non-interactive grants: the client
+    # secret, the token to exchange or the access token. The secret itself is never stored.
+    secret_env: Union[str, None] = None
+    secret_file: Union[str, None] = None
+
+    # Index urls (PyPI or its mirrors) to fall back on. Empty means the default PyPI.
+    fallback_urls: List[str] = field(default_factory=list)
+
+    # Timeouts (seconds) of the requests to the index. None means the default.
+    connect_timeout: Union[float, None] = None
+    read_timeout: Union[float, None] = None
 
     @classmethod
-    def from_json(cls, config: Dict[str, str]) -> ServerConfig:
+    def from_json(cls, config: Dict[str, Union[str, float, List[str]]]) -> ServerConfig:
         return cls(**config)
 
-    def to_json(self) -> Dict[str, str]:
+    def is_interactive(self) -> bool:
+        return self.grant == "device_code"
+
+    def to_json(self) -> Dict[str, Union[str, float, List[str]]]:
         # Url is used as the key and thus not stored in the indivual config object itself.
-        return {
+        d: Dict[str, Union[str, float, List[str]]] = {
             "client_id": self.client_id,
             "token_url": self.token_url,
             "device_url": self.device_url,
         }
+        # Optional settings are only stored when set.
+        if self.grant != "device_code":
+            d["grant"] = self.grant
+        if self.secret_env:
+            d["secret_env"] = self.secret_env
+        if self.secret_file:
+            d["secret_file"] = self.secret_file
+        if self.fallback_urls:
+            d["fallback_urls"] = self.fallback_urls
+        if self.connect_timeout is not None:
+            d["connect_timeout"] = self.connect_timeout
+        if self.read_timeout is not None:
+            d["read_timeout"] = self.read_timeout
+        return d
 
 
 # Starting from 3.9 this is not needed anymore: https://stackoverflow.com/a/72436468
@@ -42,7 +81,7 @@ else:
 class ServerConfigs(TypedUserDict):
     """A dictionary representing the stored crane server configs on disk. Key = crane server url,
 
-    Setting an item also saves the config on disk.
+    Setting (or deleting) an item also saves that config in the metadata database on disk.
 
     Other modules should interact with the configs via the server_configs object
     and do not directly access this class! Else multiple in-memory states will get out of sync.
@@ -50,33 +89,29 @@ class ServerConfigs(TypedUserDict):
 
     config_dir = os.path.join(Path.home(), ".local", "share", "crane", "python")
     os.makedirs(config_dir, exist_ok=True)
+    db_file = os.path.join(config_dir, "crane.db")
+    # Flat json configs of older versions. Imported into the database once.
     server_config_file = os.path.join(config_dir, "servers.json")
 
     def __init__(self):
-        if not os.path.isfile(self.server_config_file):
-            with open(self.server_config_file, "w") as f:
-                f.write(json.dumps({}))
-            self.data = {}
-        else:
-            with open(self.server_config_file, "r") as f:
-                raw_data = json.load(f)
-                self.data = {
-                    url: ServerConfig.from_json(config) for url, config in raw_data.items()
-                }
+        self.db = MetadataStore(self.db_file)
+        self.db.import_legacy_json("servers", self.server_config_file)
+        self.reload()
+
+    def reload(self) -> None:
+        "Reload the in-memory state from disk. (Configs might be updated by other crane processes.)"
+        self.data = {
+            url: ServerConfig.from_json(config)
+            for url, config in self.db.read_table("servers").items()
+        }
 
     def __setitem__(self, key: str, item: ServerConfig) -> None:
         self.data[key] = item
-        self._write()
+        self.db.write_entry("servers", key, item.to_json())
 
     def __delitem__(self, key) -> None:
         del self.data[key]
-        self._write()
-
-    def _write(self):
-        "Write current in memory state of the config to disk"
-        to_write = {url: tokens.to_json() for url, tokens in self.data.items()}
-        with open(self.server_config_file, "w") as f:
-            f.write(json.dumps(to_write))
+        self.db.delete_entry("servers", key)
 
 
 server_configs = ServerConfigs()
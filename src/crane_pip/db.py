@@ -0,0 +1,167 @@
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+from threading import RLock
+from typing import Dict, Iterator, Union
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tokens (url TEXT PRIMARY KEY, tokens TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS servers (url TEXT PRIMARY KEY, config TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS responses (
+    path TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    headers TEXT NOT NULL,
+    stored_at TEXT NOT NULL,
+    size INTEGER NOT NULL DEFAULT 0,
+    used_at REAL NOT NULL DEFAULT 0,
+    PRIMARY KEY (path, variant)
+);
+CREATE TABLE IF NOT EXISTS artifacts (
+    path TEXT PRIMARY KEY,
+    filename TEXT NOT NULL,
+    hashes TEXT NOT NULL,
+    size INTEGER,
+    content_type TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS artifacts_filename ON artifacts (filename);
+"""
+
+# Columns added to the tables of databases created by older versions.
+ADDED_COLUMNS = {
+    "responses": {"size": "INTEGER NOT NULL DEFAULT 0", "used_at": "REAL NOT NULL DEFAULT 0"},
+}
+# Indexes on added columns, created once the columns exist.
+ADDED_INDEXES = """
+CREATE INDEX IF NOT EXISTS responses_used_at ON responses (used_at);
+"""
+
+
+class MetadataStore:
+    """SQLite database holding the metadata of crane-pip.
+
+    Tables:
+    -------
+    tokens / servers:
+        Cached tokens and registered server configs by url. Values are the json of the objects.
+    responses:
+        Metadata of the responses in the last-known-good store. (The bodies are separate files.)
+    artifacts:
+        Records of the artifact index of the proxy.
+
+    The database runs in WAL mode so multiple crane processes can use it at the same time: readers
+    do not block the (single) writer. A writer waits up to `timeout` seconds for another one.
+    Within the process the connection is shared by the threads and guarded by a lock.
+    """
+
+    timeout = 30.0
+
+    def __init__(self, db_file: str) -> None:
+        self.db_file = db_file
+        self._lock = RLock()
+        self._conn: Union[sqlite3.Connection, None] = None
+        self._pid = 0
+
+    def connection(self) -> sqlite3.Connection:
+        # A connection can not be shared with forked processes.
+        if self._conn is None or self._pid != os.getpid():
+            os.makedirs(os.path.dirname(self.db_file) or ".", exist_ok=True)
+            conn = sqlite3.connect(
+                self.db_file, timeout=self.timeout, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Durable enough in WAL mode and much faster than FULL.
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            _add_columns(conn)
+            conn.executescript(ADDED_INDEXES)
+            self._conn, self._pid = conn, os.getpid()
+        return self._conn
+
+    @contextmanager
+    def transaction(self, immediate: bool = False) -> Iterator[sqlite3.Connection]:
+        """Run statements in a transaction.
+
+        An `immediate` transaction takes the write lock of the database at the start, so no
+        other process can write in between a read and a write of the transaction."""
+        with self._lock:
+            conn = self.connection()
+            conn.execute("BEGIN IMMEDIATE" if immediate else "BEGIN")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def execute(self, sql: str, parameters=()) -> list:
+        "Execute a single statement and return all rows."
+        with self._lock:
+            return self.connection().execute(sql, parameters).fetchall()
+
+    def data_version(self) -> int:
+        "Changes whenever another connection (eg. of another crane process) committed a change."
+        return self.execute("PRAGMA data_version")[0][0]
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None and self._pid == os.getpid():
+                self._conn.close()
+            self._conn = None
+
+    # Json key-value tables: tokens and servers
+    def read_table(self, table: str) -> Dict[str, Dict]:
+        "Read all entries of the tokens or servers table."
+        column = _JSON_TABLES[table]
+        rows = self.execute(f"SELECT url, {column} FROM {table}")
+        return {url: json.loads(value) for url, value in rows}
+
+    def read_entry(self, table: str, url: str) -> Union[Dict, None]:
+        column = _JSON_TABLES[table]
+        rows = self.execute(f"SELECT {column} FROM {table} WHERE url = ?", (url,))
+        return json.loads(rows[0][0]) if rows else None
+
+    def write_entry(self, table: str, url: str, value: Dict) -> None:
+        column = _JSON_TABLES[table]
+        self.execute(
+            f"INSERT OR REPLACE INTO {table} (url, {column}) VALUES (?, ?)",
+            (url, json.dumps(value)),
+        )
+
+    def delete_entry(self, table: str, url: str) -> None:
+        self.execute(f"DELETE FROM {table} WHERE url = ?", (url,))
+
+    def import_legacy_json(self, table: str, json_file: str) -> None:
+        """One time import of a json file (tokens.json/servers.json) of older crane versions."""
+        key = f"imported:{table}"
+        with self.transaction(immediate=True) as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = ?", (key,)).fetchall():
+                return
+            if os.path.isfile(json_file):
+                with open(json_file, "r") as f:
+                    legacy = json.load(f)
+                column = _JSON_TABLES[table]
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO {table} (url, {column}) VALUES (?, ?)",
+                    [(url, json.dumps(value)) for url, value in legacy.items()],
+                )
+            conn.execute("INSERT INTO meta (key, value) VALUES (?, ?)", (key, json_file))
+
+
+_JSON_TABLES = {"tokens": "tokens", "servers": "config"}
+
+
+def _add_columns(conn: sqlite3.Connection) -> None:
+    for table, columns in ADDED_COLUMNS.items():
+        existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        for column, definition in columns.items():
+            if column in existing:
+                continue
+            try:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+            except sqlite3.OperationalError as e:
+                # Added by another crane process meanwhile.
+                if "duplicate column" not in str(e):
+                    raise
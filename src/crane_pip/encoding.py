@@ -0,0 +1,85 @@
+"""Content encoding (compression) negotiation of the proxy.
+
+Towards the upstream indexes the proxy asks for every encoding urllib3 can decode, regardless of
+what the client asked for. Towards the client the (decoded) simple pages are compressed with the
+best encoding the client accepts.
+"""
+
+import gzip
+from typing import Dict, Union
+
+import urllib3
+
+try:
+    import brotli  # type: ignore
+except ImportError:
+    try:
+        import brotlicffi as brotli  # type: ignore
+    except ImportError:
+        brotli = None
+
+# Encodings the proxy can decode. Eg. "gzip,deflate,br"
+UPSTREAM_ACCEPT_ENCODING = urllib3.util.make_headers(accept_encoding=True)["accept-encoding"]
+
+# Encodings the proxy can serve in order of preference.
+SERVED_ENCODINGS = ("br", "gzip") if brotli else ("gzip",)
+
+# Smaller bodies are not worth compressing.
+MIN_COMPRESS_SIZE = 1024
+
+
+def parse_accept_encoding(header: Union[str, None]) -> Dict[str, float]:
+    "Parse an Accept-Encoding header into encoding -> q-value."
+    accepted = {}
+    for part in (header or "").split(","):
+        encoding, _, params = part.partition(";")
+        encoding = encoding.strip().lower()
+        if not encoding:
+            continue
+        q = 1.0
+        for param in params.split(";"):
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        accepted[encoding] = q
+    return accepted
+
+
+def accepts(header: Union[str, None], encoding: str) -> bool:
+    "Does the Accept-Encoding header accept the encoding?"
+    accepted = parse_accept_encoding(header)
+    if encoding in accepted:
+        return accepted[encoding] > 0
+    return accepted.get("*", 0) > 0
+
+
+def choose_encoding(header: Union[str, None]) -> Union[str, None]:
+    "The preferred encoding to serve given the Accept-Encoding header. None for no compression."
+    accepted = parse_accept_encoding(header)
+    best, best_q = None, 0.0
+    for encoding in SERVED_ENCODINGS:
+        q = accepted.get(encoding, accepted.get("*", 0.0))
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+def compress(content: bytes, encoding: str) -> bytes:
+    if encoding == "br":
+        # Quality 5 compresses about as fast as gzip but smaller.
+        return brotli.compress(content, quality=5)
+    if encoding == "gzip":
+        return gzip.compress(content, compresslevel=6, mtime=0)
+    raise ValueError(f"Unsupported encoding: {encoding}")
+
+
+def decompress(content: bytes, encoding: str) -> bytes:
+    "Decode content compressed by the proxy. (See `compress`)"
+    if encoding == "br" and brotli:
+        return brotli.decompress(content)
+    if encoding == "gzip":
+        return gzip.decompress(content)
+    raise ValueError(f"Unsupported encoding: {encoding}")
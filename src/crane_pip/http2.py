@@ -0,0 +1,452 @@
+"""Optional HTTP/2 transport of the proxy towards the upstream indexes.
+
+Over HTTP/1.1 every concurrent request to an index needs a connection of its own. Over HTTP/2 the
+concurrent requests to an index are multiplexed as streams over a single connection: no extra TCP
+and TLS handshakes while pip fires its requests, and no head-of-line blocking between them.
+
+HTTP/2 is negotiated with ALPN for https upstreams. Servers that do not select it (and http
+upstreams) are remembered and served by the HTTP/1.1 pools of urllib3, as is everything if the
+`h2` package is not installed.
+
+The responses are urllib3 responses (decoding, streaming, draining all work as usual), of which
+the body is read from the stream. Flow control windows are only opened as the body is consumed,
+so a slow client does not make the proxy buffer a large file in memory.
+"""
+
+from collections import deque
+import io
+import logging
+import socket
+import ssl
+from threading import Condition, Lock, Thread
+from typing import Deque, Dict, List, Mapping, Set, Tuple, Union
+from urllib.parse import urlsplit
+
+import urllib3
+from urllib3.exceptions import ConnectTimeoutError, ProtocolError, ReadTimeoutError
+
+try:
+    import h2.config  # type: ignore
+    import h2.connection  # type: ignore
+    import h2.errors  # type: ignore
+    import h2.events  # type: ignore
+    import h2.exceptions  # type: ignore
+    import h2.settings  # type: ignore
+except ImportError:
+    h2 = None
+
+logger = logging.getLogger(__name__)
+
+# Flow control windows: large enough to not throttle the download of files.
+STREAM_WINDOW = 2**22
+CONNECTION_WINDOW = 2**24
+MAX_FRAME_SIZE = 2**20
+
+# Connection specific headers, not allowed in HTTP/2 requests.
+_CONNECTION_HEADERS = {
+    "connection",
+    "host",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "transfer-encoding",
+    "upgrade",
+}
+
+Origin = Tuple[str, int]
+
+
+def h2_installed() -> bool:
+    "Is the h2 package installed?"
+    return h2 is not None
+
+
+class NotNegotiated(Exception):
+    "The server did not select HTTP/2 with ALPN."
+
+    pass
+
+
+class ConnectionClosed(Exception):
+    "The connection can not take new streams. (Closed or going away.)"
+
+    pass
+
+
+class _Stream:
+    "State of a request/response exchange of a connection."
+
+    def __init__(self, stream_id: int, lock: Lock) -> None:
+        self.stream_id = stream_id
+        # Notified on the events of this stream only, such that a chunk of one response does not
+        # wake up the readers of all other responses.
+        self.cond = Condition(lock)
+        self.headers: Union[List[Tuple[str, str]], None] = None
+        self.chunks: Deque[Tuple[bytes, int]] = deque()
+        self.ended = False
+        self.error: Union[Exception, None] = None
+
+
+class Http2Connection:
+    """A HTTP/2 connection to an origin, shared by concurrent requests.
+
+    A reader thread receives the frames of all streams. All state is guarded by one lock. Each
+    stream has a condition to wait for its events, the connection one to wait for a free stream."""
+
+    def __init__(
+        self, origin: Origin, connect_timeout: Union[float, None], context: ssl.SSLContext
+    ) -> None:
+        host, port = origin
+        try:
+            sock = socket.create_connection((host, port), timeout=connect_timeout)
+        except socket.timeout as e:
+            raise ConnectTimeoutError(f"Connection to {host}:{port} timed out. ({e})")
+        except OSError as e:
+            raise ProtocolError(f"Failed to connect to {host}:{port}", e)
+        try:
+            tls = context.wrap_socket(sock, server_hostname=host)
+        except (OSError, ssl.SSLError) as e:
+            sock.close()
+            raise ProtocolError(f"TLS handshake with {host}:{port} failed", e)
+        if tls.selected_alpn_protocol() != "h2":
+            tls.close()
+            raise NotNegotiated(f"{host}:{port}")
+        tls.settimeout(None)
+
+        self.origin = origin
+        self.authority = host if port == 443 else f"{host}:{port}"
+        self._sock = tls
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._streams: Dict[int, _Stream] = {}
+        self.closed = False
+        self._conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding="utf-8")
+        )
+        self._conn.initiate_connection()
+        self._conn.update_settings(
+            {
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: STREAM_WINDOW,
+                h2.settings.SettingCodes.MAX_FRAME_SIZE: MAX_FRAME_SIZE,
+            }
+        )
+        self._conn.increment_flow_control_window(CONNECTION_WINDOW)
+        self._sock.sendall(self._conn.data_to_send())
+        Thread(target=self._read_frames, name="http2-reader", daemon=True).start()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Mapping[str, str],
+        read_timeout: Union[float, None],
+        preload_content: bool = True,
+        decode_content: bool = True,
+    ) -> urllib3.HTTPResponse:
+        "Send the request as a new stream and wait for the head of the response."
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request_headers = [
+            (":method", method),
+            (":authority", self.authority),
+            (":scheme", "https"),
+            (":path", path),
+        ]
+        request_headers += [
+            (k.lower(), v) for k, v in headers.items() if k.lower() not in _CONNECTION_HEADERS
+        ]
+
+        with self._cond:
+            # Respect the limit of concurrent streams of the server.
+            while not self.closed and (
+                self._conn.open_outbound_streams
+                >= self._conn.remote_settings.max_concurrent_streams
+            ):
+                if not self._cond.wait(read_timeout):
+                    raise ReadTimeoutError(None, url, "Waiting for a free stream timed out.")
+            if self.closed:
+                raise ConnectionClosed(url)
+            stream = _Stream(self._conn.get_next_available_stream_id(), self._lock)
+            self._streams[stream.stream_id] = stream
+            self._conn.send_headers(stream.stream_id, request_headers, end_stream=True)
+            self._flush()
+
+            while stream.headers is None and stream.error is None:
+                if not stream.cond.wait(read_timeout):
+                    self._reset(stream)
+                    raise ReadTimeoutError(None, url, f"Read timed out. ({read_timeout})")
+            if stream.headers is None:
+                raise ProtocolError(f"Request failed: {stream.error}", stream.error)
+            status = int(dict(stream.headers)[":status"])
+            response_headers = urllib3.HTTPHeaderDict(
+                [(k, v) for k, v in stream.headers if not k.startswith(":")]
+            )
+
+        return urllib3.HTTPResponse(
+            body=_StreamBody(self, stream, url, read_timeout),
+            headers=response_headers,
+            status=status,
+            version=20,
+            preload_content=preload_content,
+            decode_content=decode_content,
+            request_method=method,
+            request_url=url,
+        )
+
+    def close(self) -> None:
+        with self._lock:
+            if not self.closed:
+                self.closed = True
+                try:
+                    self._conn.close_connection()
+                    self._flush()
+                except Exception:
+                    pass
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+    # Called with the lock held.
+    def _flush(self) -> None:
+        data = self._conn.data_to_send()
+        if data:
+            self._sock.sendall(data)
+
+    def _reset(self, stream: _Stream) -> None:
+        "Cancel a stream of which the response is not (completely) read."
+        if self._streams.pop(stream.stream_id, None) is not None:
+            self._cond.notify()
+        if stream.ended or stream.error or self.closed:
+            return
+        stream.error = ProtocolError("Stream cancelled")
+        try:
+            self._conn.reset_stream(stream.stream_id, error_code=h2.errors.ErrorCodes.CANCEL)
+            self._flush()
+        except (h2.exceptions.H2Error, OSError):
+            pass
+
+    def _consumed(self, stream: _Stream, length: int) -> None:
+        "Open the flow control windows for the consumed data."
+        try:
+            self._conn.acknowledge_received_data(length, stream.stream_id)
+            self._flush()
+        except (h2.exceptions.H2Error, OSError):
+            pass
+
+    def _read_frames(self) -> None:
+        error: Exception = ConnectionClosed("Connection closed by the server")
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                with self._lock:
+                    touched: Set[_Stream] = set()
+                    for event in self._conn.receive_data(data):
+                        self._handle_event(event, touched)
+                    self._flush()
+                    for stream in touched:
+                        stream.cond.notify()
+        except Exception as e:
+            error = e
+        with self._lock:
+            self.closed = True
+            for stream in self._streams.values():
+                if not stream.ended and stream.error is None:
+                    stream.error = error
+                stream.cond.notify()
+            self._streams.clear()
+            self._cond.notify_all()
+
+    def _handle_event(self, event, touched: Set[_Stream]) -> None:
+        "Update the state of the stream of the event, adding it to the touched streams."
+        stream = self._streams.get(getattr(event, "stream_id", 0))
+        if stream is not None:
+            touched.add(stream)
+        if isinstance(event, h2.events.ResponseReceived) and stream:
+            stream.headers = event.headers
+        elif isinstance(event, h2.events.DataReceived):
+            if stream:
+                stream.chunks.append((event.data, event.flow_controlled_length))
+            else:
+                # Data of a cancelled stream still counts for the connection window.
+                self._conn.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id
+                )
+        elif isinstance(event, h2.events.StreamEnded) and stream:
+            stream.ended = True
+            self._close_stream(stream)
+        elif isinstance(event, h2.events.StreamReset) and stream:
+            stream.error = ProtocolError(f"Stream reset by the server (code {event.error_code})")
+            self._close_stream(stream)
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            # Going away: no new streams. Streams the server did not process fail.
+            self.closed = True
+            self._cond.notify_all()
+            for stream_id, s in list(self._streams.items()):
+                if event.last_stream_id is None or stream_id > event.last_stream_id:
+                    s.error = ConnectionClosed("Connection terminated by the server")
+                    touched.add(s)
+                    self._close_stream(s)
+
+    def _close_stream(self, stream: _Stream) -> None:
+        del self._streams[stream.stream_id]
+        # A request may be waiting for a free stream.
+        self._cond.notify()
+
+
+class _StreamBody(io.RawIOBase):
+    "The body of a response, read from its stream."
+
+    def __init__(
+        self, connection: Http2Connection, stream: _Stream, url: str, timeout: Union[float, None]
+    ) -> None:
+        self._connection = connection
+        self._stream = stream
+        self._url = url
+        self._timeout = timeout
+        # Rest of the last received chunk.
+        self._pending = memoryview(b"")
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        if not self._pending:
+            self._pending = memoryview(self._next_chunk())
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+    def readall(self) -> bytes:
+        chunks = [bytes(self._pending)]
+        self._pending = memoryview(b"")
+        while True:
+            chunk = self._next_chunk()
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+
+    def _next_chunk(self) -> bytes:
+        stream, cond = self._stream, self._stream.cond
+        with cond:
+            while not stream.chunks and not stream.ended and stream.error is None:
+                if not cond.wait(self._timeout):
+                    self._connection._reset(stream)
+                    raise ReadTimeoutError(None, self._url, f"Read timed out. ({self._timeout})")
+            if stream.chunks:
+                data, length = stream.chunks.popleft()
+                self._connection._consumed(stream, length)
+                return data
+            if stream.ended:
+                return b""
+            raise ProtocolError(f"Response interrupted: {stream.error}", stream.error)
+
+    def close(self) -> None:
+        if not self.closed:
+            with self._connection._lock:
+                self._connection._reset(self._stream)
+        super().close()
+
+
+class Http2Pool:
+    """HTTP/2 connections to the upstream origins, one per origin.
+
+    `request` returns None for origins that are not served over HTTP/2, which the caller then
+    requests over HTTP/1.1."""
+
+    def __init__(self, context: Union[ssl.SSLContext, None] = None) -> None:
+        if context is None:
+            context = ssl.create_default_context()
+        context.set_alpn_protocols(["h2", "http/1.1"])
+        self.context = context
+        self._lock = Lock()
+        self._connections: Dict[Origin, Http2Connection] = {}
+        self._http1: Set[Origin] = set()
+        # Number of connections opened. (Eg. to verify requests get multiplexed.)
+        self.connections_opened = 0
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        headers: Mapping[str, str],
+        timeout: Union[urllib3.Timeout, float, None] = None,
+        preload_content: bool = True,
+        decode_content: bool = True,
+        **kwargs,
+    ) -> Union[urllib3.HTTPResponse, None]:
+        "Request the url over HTTP/2. None if the origin does not support it."
+        parts = urlsplit(url)
+        if parts.scheme != "https" or not parts.hostname:
+            return None
+        origin = (parts.hostname, parts.port or 443)
+        connect_timeout, read_timeout = _timeouts(timeout)
+        # A connection closing in between getting and using it is replaced once.
+        for attempt in range(2):
+            connection = self._connection(origin, connect_timeout)
+            if connection is None:
+                return None
+            try:
+                return connection.request(
+                    method, url, headers, read_timeout, preload_content, decode_content
+                )
+            except ConnectionClosed:
+                with self._lock:
+                    if self._connections.get(origin) is connection:
+                        del self._connections[origin]
+                if attempt:
+                    raise ProtocolError(f"Connection to {parts.netloc} closed")
+        return None
+
+    def _connection(
+        self, origin: Origin, connect_timeout: Union[float, None]
+    ) -> Union[Http2Connection, None]:
+        with self._lock:
+            if origin in self._http1:
+                return None
+            connection = self._connections.get(origin)
+            if connection is not None and not connection.closed:
+                return connection
+            try:
+                connection = Http2Connection(origin, connect_timeout, self.context)
+            except NotNegotiated:
+                logger.info(f"No HTTP/2 for {origin[0]}:{origin[1]}, using HTTP/1.1.")
+                self._http1.add(origin)
+                return None
+            self._connections[origin] = connection
+            self.connections_opened += 1
+            return connection
+
+    def protocols(self) -> Dict[str, str]:
+        "Protocol used per origin (host:port) contacted so far."
+        with self._lock:
+            used = {f"{h}:{p}": "HTTP/2" for h, p in self._connections}
+            used.update({f"{h}:{p}": "HTTP/1.1" for h, p in self._http1})
+            return used
+
+    def clear(self) -> None:
+        "Close all connections."
+        with self._lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+        for connection in connections:
+            connection.close()
+
+
+def _timeouts(
+    timeout: Union[urllib3.Timeout, float, None],
+) -> Tuple[Union[float, None], Union[float, None]]:
+    "Connect and read timeout in seconds. (None for no timeout)"
+    if not isinstance(timeout, urllib3.Timeout):
+        return timeout, timeout
+
+    def seconds(value) -> Union[float, None]:
+        return float(value) if isinstance(value, (int, float)) else None
+
+    return seconds(timeout.connect_timeout), seconds(timeout.read_timeout)
@@ -0,0 +1,121 @@
+"""Rewriting of the links on simple pages so that all downloads flow through the proxy.
+
+Links to files are rewritten into the proxy namespace:
+
+    /files/<index-id>/<scheme>/<host>/<path>
+
+The index-id identifies the index the page came from (and thus which authentication applies) and
+the remainder is the location of the file upstream. The rewrite is deterministic: the same upstream
+link always maps to the same proxy path, also across proxy restarts.
+
+Links to other pages of the same index (eg. project links on the root page) are rewritten relative
+to the proxy root instead, such that they keep falling back over the configured indexes.
+"""
+
+from hashlib import sha256
+import html
+import json
+import re
+from typing import Dict, Tuple, Union
+from urllib.parse import unquote, urljoin, urlsplit
+
+FILES_PATH = "/files/"
+
+_ANCHOR_HREF = re.compile(r"(<a\b[^>]*?\bhref\s*=\s*)([\"'])(.*?)\2", re.IGNORECASE | re.DOTALL)
+
+
+class InvalidProxyPath(ValueError):
+    "The path is not a valid path in the /files/ namespace of the proxy."
+
+    pass
+
+
+def index_id(index_url: str) -> str:
+    "Short deterministic identifier of an index url."
+    return sha256(index_url.encode()).hexdigest()[:10]
+
+
+def is_files_path(path: str) -> bool:
+    return path.startswith(FILES_PATH)
+
+
+def to_proxy_path(url: str, index_id: str, index_url: str) -> str:
+    """Map an (absolute) upstream url onto a path of the proxy.
+
+    Arguments:
+    ----------
+    url: str
+        Absolute url of the linked resource.
+    index_id: str
+        Id of the index the link was found on.
+    index_url: str
+        Base url of the index the link was found on.
+    """
+    base = index_url.rstrip("/") + "/"
+    parts = urlsplit(url)
+    if url.startswith(base) and parts.path.endswith("/"):
+        # Another page of the same index.
+        return url[len(base) - 1 :]
+
+    path = f"{FILES_PATH}{index_id}/{parts.scheme}/{parts.netloc}{parts.path}"
+    if parts.query:
+        path += "?" + parts.query
+    if parts.fragment:
+        path += "#" + parts.fragment
+    return path
+
+
+def from_proxy_path(path: str) -> Tuple[str, str]:
+    """Inverse of `to_proxy_path` for paths in the /files/ namespace.
+
+    Returns:
+    --------
+    The index-id and the upstream url.
+    """
+    if not is_files_path(path):
+        raise InvalidProxyPath(f"Not a proxy file path: {path}")
+    try:
+        id_, scheme, location = path[len(FILES_PATH) :].split("/", 2)
+    except ValueError:
+        raise InvalidProxyPath(f"Incomplete proxy file path: {path}")
+    if scheme not in ("http", "https") or not location or location.startswith("/"):
+        raise InvalidProxyPath(f"Invalid proxy file path: {path}")
+    # Clients quote the path they request, eg. pip sends the port of the host as `host%3A8080`.
+    host, slash, rest = location.partition("/")
+    return id_, f"{scheme}://{unquote(host)}{slash}{rest}"
+
+
+def rewrite_html(
+    content: str,
+    page_url: str,
+    index_id: str,
+    index_url: str,
+    links: Union[Dict[str, str], None] = None,
+) -> str:
+    """Rewrite the anchors of a PEP 503 html page.
+
+    `links` memoizes the rewrites (href -> new href) for the same page, index and index url: the
+    hrefs in it are not rewritten again and new ones are added to it."""
+    links = {} if links is None else links
+
+    def replace(match: re.Match) -> str:
+        prefix, quote, href = match.groups()
+        new_href = links.get(href)
+        if new_href is None:
+            url = urljoin(page_url, html.unescape(href))
+            new_href = html.escape(to_proxy_path(url, index_id, index_url), quote=True)
+            links[href] = new_href
+        return f"{prefix}{quote}{new_href}{quote}"
+
+    return _ANCHOR_HREF.sub(replace, content)
+
+
+def rewrite_json(content: str, page_url: str, index_id: str, index_url: str) -> str:
+    "Rewrite the file urls of a PEP 691 json page."
+    page = json.loads(content)
+    if not isinstance(page, dict) or not isinstance(page.get("files"), list):
+        return content
+    for file in page["files"]:
+        if isinstance(file, dict) and "url" in file:
+            file["url"] = to_proxy_path(urljoin(page_url, file["url"]), index_id, index_url)
+    return json.dumps(page)
@@ -0,0 +1,161 @@
+"""Reading the pinned packages from requirements and lock files.
+
+Supported are requirements.txt files (only `name==version` pins are used), pylock.toml (PEP 751),
+poetry.lock and uv.lock.
+"""
+
+import logging
+import os
+import re
+import sys
+from typing import Dict, FrozenSet, List, NamedTuple
+from urllib.parse import unquote, urlparse
+
+if sys.version_info >= (3, 11):
+    import tomllib
+else:
+    import tomli as tomllib
+
+from .simple import normalize_name
+
+logger = logging.getLogger(__name__)
+
+_PINNED_REQUIREMENT = re.compile(
+    r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[[^\]]*\])?\s*===?\s*([^\s;,\\]+)\s*(?:;.*)?$"
+)
+_HASH_OPTION = re.compile(r"--hash[=\s]+(\w+):(\w+)")
+
+
+class LockFileError(Exception):
+    "The requirements or lock file could not be read."
+
+    pass
+
+
+class PinnedPackage(NamedTuple):
+    """A package pinned to a specific version.
+
+    Lock files also list the individual files (name and/or hashes) of a version. If they do not, all
+    files of the version are eligible."""
+
+    name: str
+    version: str
+    filenames: FrozenSet[str] = frozenset()
+    # Hashes as "algorithm:value"
+    hashes: FrozenSet[str] = frozenset()
+
+
+def read_lock_file(path: str) -> List[PinnedPackage]:
+    "Read the pinned packages from a requirements, pylock.toml, poetry.lock or uv.lock file."
+    basename = os.path.basename(path)
+    try:
+        if basename == "poetry.lock":
+            return _read_poetry_lock(_load_toml(path))
+        if basename == "uv.lock":
+            return _read_uv_lock(_load_toml(path))
+        if re.fullmatch(r"pylock\.([^.]+\.)?toml", basename):
+            return _read_pylock(_load_toml(path))
+        return _read_requirements(path)
+    except (OSError, KeyError, TypeError, tomllib.TOMLDecodeError) as e:
+        raise LockFileError(f"Failed to read {path}: {e}") from e
+
+
+def _load_toml(path: str) -> Dict:
+    with open(path, "rb") as f:
+        return tomllib.load(f)
+
+
+def _filename_from_url(url: str) -> str:
+    return unquote(os.path.basename(urlparse(url).path))
+
+
+def _read_requirements(path: str) -> List[PinnedPackage]:
+    with open(path, "r") as f:
+        # Join continuation lines.
+        content = re.sub(r"\\\r?\n", " ", f.read())
+
+    packages = []
+    for line in content.splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        if line.startswith(("-r ", "--requirement ", "-c ", "--constraint ")):
+            included = line.split(None, 1)[1].strip()
+            packages += _read_requirements(os.path.join(os.path.dirname(path), included))
+            continue
+        if line.startswith("-"):
+            continue
+        hashes = frozenset(f"{algo}:{value}" for algo, value in _HASH_OPTION.findall(line))
+        requirement = _HASH_OPTION.sub("", line).strip()
+        match = _PINNED_REQUIREMENT.match(requirement)
+        if not match:
+            logger.warning(f"Skipping requirement that is not pinned to a version: {requirement}")
+            continue
+        packages.append(
+            PinnedPackage(name=normalize_name(match[1]), version=match[2], hashes=hashes)
+        )
+    return packages
+
+
+def _read_poetry_lock(lock: Dict) -> List[PinnedPackage]:
+    packages = []
+    for package in lock.get("package", []):
+        source = package.get("source", {})
+        if source.get("type") in ("git", "directory", "file", "url"):
+            continue
+        files = package.get("files", [])
+        packages.append(
+            PinnedPackage(
+                name=normalize_name(package["name"]),
+                version=package["version"],
+                filenames=frozenset(f["file"] for f in files),
+                hashes=frozenset(f["hash"] for f in files if "hash" in f),
+            )
+        )
+    return packages
+
+
+def _read_uv_lock(lock: Dict) -> List[PinnedPackage]:
+    packages = []
+    for package in lock.get("package", []):
+        # Only packages from an index, not editable/path/git dependencies.
+        if "registry" not in package.get("source", {}):
+            continue
+        files = package.get("wheels", [])
+        if "sdist" in package:
+            files = files + [package["sdist"]]
+        packages.append(
+            PinnedPackage(
+                name=normalize_name(package["name"]),
+                version=package["version"],
+                filenames=frozenset(_filename_from_url(f["url"]) for f in files if "url" in f),
+                hashes=frozenset(f["hash"] for f in files if "hash" in f),
+            )
+        )
+    return packages
+
+
+def _read_pylock(lock: Dict) -> List[PinnedPackage]:
+    packages = []
+    for package in lock.get("packages", []):
+        if "version" not in package:
+            # Packages from vcs/directories have no version and are not served by an index.
+            continue
+        files = package.get("wheels", [])
+        if "sdist" in package:
+            files = files + [package["sdist"]]
+        packages.append(
+            PinnedPackage(
+                name=normalize_name(package["name"]),
+                version=package["version"],
+                filenames=frozenset(
+                    f["name"] if "name" in f else _filename_from_url(f["url"])
+                    for f in files
+                    if "name" in f or "url" in f
+                ),
+                hashes=frozenset(
+                    f"{algo}:{value}" for f in files for algo, value in f.get("hashes", {}).items()
+                ),
+            )
+        )
+    return packages
@@ -0,0 +1,136 @@
+"""Incremental updates of the simple pages the proxy serves.
+
+Per index, path and requested format the proxy keeps the state of the last page it got: the
+validators of the upstream response (ETag, Last-Modified and PyPI's `X-PyPI-Last-Serial`), a digest
+of the upstream content and what the proxy made of it (the rewritten page and its files).
+
+With it a refresh of a page is cheap:
+
+- The upstream request is conditional, so an unchanged page is answered with a bodyless 304.
+- A page with the same serial (or the same content) as before is not rewritten nor parsed again.
+- Of a changed page only the new entries are rewritten and parsed: the rewrites of the links and
+  the parsed anchors are memoized per page. Only the new and changed files are recorded in the
+  artifact index.
+- A page is compressed once per encoding the clients ask for, not on every request.
+
+The states are kept in memory (per process), least recently used first out once `max_size` bytes
+of pages are held.
+"""
+
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from typing import Dict, Mapping, NamedTuple, Tuple, Union
+
+from .encoding import compress
+from .simple import SimpleFile
+
+# (index url, path, Accept header of the request)
+PageKey = Tuple[str, str, str]
+
+
+class PageState(NamedTuple):
+    "What the proxy knows about the last version of a page of an index."
+
+    # Of the upstream response.
+    page_url: str
+    digest: str
+    content_type: str
+    etag: Union[str, None]
+    last_modified: Union[str, None]
+    serial: Union[str, None]
+    # The (decoded) headers and the rewritten content as served.
+    headers: Mapping[str, str]
+    content: bytes
+    # Files on the rewritten page by proxy path.
+    files: Dict[str, SimpleFile]
+    # Memoized rewrites of the links (href -> new href) and parsed anchors. (Html pages only.)
+    links: Dict[str, str]
+    anchors: Dict[str, Union[SimpleFile, None]]
+    # Time (epoch) the files were last recorded in the artifact index.
+    recorded: float
+    # The content compressed per encoding, added as clients ask for it. See `PageCache.encoded`.
+    encoded: Dict[str, bytes]
+
+    def conditional_headers(self) -> Dict[str, str]:
+        "Headers making a request for the page conditional on it being changed."
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def is_unchanged(self, content_type: str, serial: Union[str, None], digest: str) -> bool:
+        "Is a new upstream response the same page? By serial if both have one, else by content."
+        if content_type != self.content_type:
+            return False
+        if serial and self.serial:
+            return serial == self.serial
+        return digest == self.digest
+
+
+def page_digest(content: bytes) -> str:
+    return sha256(content).hexdigest()
+
+
+def _state_size(state: PageState) -> int:
+    return len(state.content) + sum(map(len, state.encoded.values()))
+
+
+class PageCache:
+    """States of the pages of the indexes, by index url, path and requested format."""
+
+    max_size = 64 * 2**20
+
+    def __init__(self) -> None:
+        self._lock = Lock()
+        self._pages: "OrderedDict[PageKey, PageState]" = OrderedDict()
+        self._size = 0
+        self.counts = {"revalidated": 0, "unchanged": 0, "changed": 0}
+
+    def get(self, key: PageKey) -> Union[PageState, None]:
+        with self._lock:
+            state = self._pages.get(key)
+            if state is not None:
+                self._pages.move_to_end(key)
+            return state
+
+    def put(self, key: PageKey, state: PageState) -> None:
+        with self._lock:
+            old = self._pages.pop(key, None)
+            if old is not None:
+                self._size -= _state_size(old)
+            self._pages[key] = state
+            self._size += _state_size(state)
+            self._evict()
+
+    def encoded(self, key: PageKey, state: PageState, encoding: str) -> bytes:
+        "The content of the page state (kept under `key`) compressed, once per encoding."
+        with self._lock:
+            encoded = state.encoded.get(encoding)
+        if encoded is not None:
+            return encoded
+        # Concurrent requests might compress it twice, but do not wait on each other.
+        encoded = compress(state.content, encoding)
+        with self._lock:
+            if encoding not in state.encoded:
+                state.encoded[encoding] = encoded
+                if self._pages.get(key) is state:
+                    self._size += len(encoded)
+                    self._evict()
+        return encoded
+
+    def _evict(self) -> None:
+        while self._size > self.max_size and len(self._pages) > 1:
+            _, evicted = self._pages.popitem(last=False)
+            self._size -= _state_size(evicted)
+
+    def count(self, outcome: str) -> None:
+        "Count the outcome of a refresh: revalidated (304), unchanged or changed."
+        with self._lock:
+            self.counts[outcome] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts, pages=len(self._pages), size=self._size)
@@ -0,0 +1,216 @@
+"""Built-in profiling of the proxy: where does it spend its CPU time, per kind of request?
+
+Code is profiled in regions, labelled by what they handle (eg. `GET /files/`, `auth`). The
+profiles are aggregated per label. Two modes:
+
+- cprofile: deterministic profiling with cProfile. Exact call counts and times, but it slows the
+  profiled code down. Written as a pstats file per label (`python -m pstats`, snakeviz, ...).
+- sample: a thread samples the stacks of the threads in a region every `interval` seconds. Low
+  overhead, so fit for a proxy under real load. Written as collapsed stacks (one line per stack:
+  `label;outer frame;...;inner frame count`) for flamegraph.pl, speedscope or inferno.
+
+Both also write a summary (`crane-profile-<pid>.txt`) with the number of regions and the time
+spent per label. The files are written to the output directory on `dump`: when the proxy stops
+and on SIGUSR1 (`kill -USR1 <pid>`, also of a worker process).
+
+Regions do not nest: the profile of a region entered within another one (eg. the token refresh
+within a request) is part of the outer one. Its time is counted for both labels.
+
+Note, since python 3.12 only a single cProfile profiler can be active at a time. Regions starting
+while another one is profiled are then counted, but not profiled ("skipped" in the summary).
+"""
+
+from collections import Counter
+from contextlib import contextmanager
+import cProfile
+import io
+import logging
+import os
+import pstats
+import re
+import signal
+import sys
+from threading import RLock, Thread, current_thread, get_ident, main_thread
+import time
+from typing import Dict, Iterator, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_MODES = ("cprofile", "sample")
+
+
+class Profiler:
+    """Profiles of regions of code, aggregated per label.
+
+    Arguments:
+    ----------
+    mode: "cprofile" | "sample"
+        How to profile, see the module documentation.
+    directory: str
+        Directory the profiles are written to.
+    interval: float
+        Seconds between the samples in sample mode.
+    """
+
+    def __init__(self, mode: str, directory: str = ".", interval: float = 0.005) -> None:
+        if mode not in PROFILE_MODES:
+            raise ValueError(f"Unknown profile mode: {mode}")
+        self.mode = mode
+        self.directory = directory
+        self.interval = interval
+        self._reset()
+
+    def _reset(self) -> None:
+        self._lock = RLock()
+        # Thread id -> (label, number of frames outside of the region)
+        self._active: Dict[int, Tuple[str, int]] = {}
+        # Per label: number of regions, seconds spent in them and skipped regions
+        self._counts: Counter = Counter()
+        self._seconds: Counter = Counter()
+        self._skipped: Counter = Counter()
+        # cprofile: per label the profiles, of which the unused ones are reused.
+        self._profiles: Dict[str, List[cProfile.Profile]] = {}
+        self._idle_profiles: Dict[str, List[cProfile.Profile]] = {}
+        # sample: number of samples per collapsed stack
+        self._stacks: Counter = Counter()
+        if self.mode == "sample":
+            Thread(target=self._sample, name="profile-sampler", daemon=True).start()
+
+    def reset_after_fork(self) -> None:
+        "Start over in a forked process: without the profiles of the parent, which it dumps."
+        self._reset()
+
+    @contextmanager
+    def region(self, label: str) -> Iterator[None]:
+        "Profile the code run in the context under the label."
+        ident = get_ident()
+        if ident in self._active:
+            # Nested: only timed, its profile is part of the outer region.
+            start = time.perf_counter()
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self._counts[label] += 1
+                    self._seconds[label] += time.perf_counter() - start
+            return
+        profile = None
+        # The frames above the one entering the region are left out of the samples.
+        outside = _depth(sys._getframe(3)) if self.mode == "sample" else 0
+        with self._lock:
+            self._active[ident] = (label, outside)
+            if self.mode == "cprofile":
+                idle = self._idle_profiles.setdefault(label, [])
+                profile = idle.pop() if idle else None
+        if self.mode == "cprofile":
+            if profile is None:
+                profile = cProfile.Profile()
+                with self._lock:
+                    self._profiles.setdefault(label, []).append(profile)
+            try:
+                profile.enable()
+            except ValueError:
+                # Another profiler is active. (python >= 3.12)
+                with self._lock:
+                    self._idle_profiles[label].append(profile)
+                    self._skipped[label] += 1
+                profile = None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            with self._lock:
+                del self._active[ident]
+                self._counts[label] += 1
+                self._seconds[label] += elapsed
+                if profile is not None:
+                    self._idle_profiles[label].append(profile)
+
+    def _sample(self) -> None:
+        own = get_ident()
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            stacks = []
+            for ident, (label, outside) in active.items():
+                frame = frames.get(ident)
+                if frame is None or ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    name = os.path.basename(code.co_filename)
+                    stack.append(f"{code.co_name} ({name}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.reverse()
+                stacks.append(";".join([label] + stack[outside:]))
+            with self._lock:
+                self._stacks.update(stacks)
+
+    def summary(self) -> str:
+        "Number of regions and time spent per label."
+        lines = [f"{'label':<32} {'count':>8} {'seconds':>10} {'mean ms':>9} {'skipped':>8}"]
+        with self._lock:
+            for label, seconds in self._seconds.most_common():
+                count = self._counts[label]
+                lines.append(
+                    f"{label:<32} {count:>8} {seconds:>10.3f} {seconds / count * 1e3:>9.2f}"
+                    f" {self._skipped[label]:>8}"
+                )
+        return "\n".join(lines) + "\n"
+
+    def dump(self) -> List[str]:
+        "Write the profiles to the output directory. Returns the files written."
+        os.makedirs(self.directory, exist_ok=True)
+        prefix = os.path.join(self.directory, f"crane-profile-{os.getpid()}")
+        written = []
+        with self._lock:
+            summary = self.summary()
+            if self.mode == "cprofile":
+                for label, profiles in self._profiles.items():
+                    stats = pstats.Stats(profiles[0])
+                    for profile in profiles[1:]:
+                        stats.add(profile)
+                    file = f"{prefix}-{_slug(label)}.pstats"
+                    stats.dump_stats(file)
+                    written.append(file)
+                    top = io.StringIO()
+                    pstats.Stats(file, stream=top).sort_stats("cumulative").print_stats(15)
+                    summary += f"\n== {label}\n{top.getvalue()}"
+            else:
+                file = f"{prefix}.collapsed"
+                with open(file, "w") as f:
+                    for stack, count in self._stacks.items():
+                        f.write(f"{stack} {count}\n")
+                written.append(file)
+        with open(f"{prefix}.txt", "w") as f:
+            f.write(summary)
+        written.append(f"{prefix}.txt")
+        logger.info(f"Profiles written to {', '.join(written)}")
+        return written
+
+    def dump_on_signal(self) -> None:
+        "Dump the profiles on SIGUSR1. (Only on platforms that have it, from the main thread.)"
+        if not hasattr(signal, "SIGUSR1") or current_thread() is not main_thread():
+            return
+        signal.signal(signal.SIGUSR1, lambda signum, frame: self.dump())
+
+
+def _depth(frame) -> int:
+    "Number of frames of the stack of the frame."
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def _slug(label: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "_", label).strip("_") or "root"
@@ -1,16 +1,65 @@
+import base64
+import binascii
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from enum import Enum
+import itertools
 import sys
 import json
+import os
+import signal
+import sqlite3
+import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
 from socketserver import ThreadingMixIn
-from threading import Lock, Thread
-from typing import NamedTuple, Tuple, Dict, Union
-from urllib.parse import urlparse
+from threading import Event, Lock, Thread, current_thread, main_thread
+from typing import (
+    Callable,
+    ContextManager,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    NamedTuple,
+    Sequence,
+    Tuple,
+    Dict,
+    Union,
+)
+from email.utils import formatdate
+from urllib.parse import unquote, urlparse
 
-import urllib3
 import logging
+import urllib3
 
-from .auth import authenticate, get_access_token
+from .artifacts import ArtifactIndex
+from .auth import authenticate, credentials_version, get_access_token, reload_credentials
+from .coalesce import Coalescer
+from .encoding import (
+    MIN_COMPRESS_SIZE,
+    UPSTREAM_ACCEPT_ENCODING,
+    accepts,
+    choose_encoding,
+    compress,
+)
+from .config import server_configs
+from .links import (
+    FILES_PATH,
+    InvalidProxyPath,
+    from_proxy_path,
+    index_id,
+    is_files_path,
+    rewrite_html,
+    rewrite_json,
+)
+from .pages import PageCache, PageKey, PageState, page_digest
+from .profiling import Profiler
+from .recording import Record, Recorder, connection_id
+from .simple import FileSelector, SimpleFile, parse_page, select_files
+from .speculate import Speculator
+from .store import LastKnownGoodStore
+from .upstream import DEFAULT_PYPI_URL, DEFAULT_TIMEOUT, UpstreamError, UpstreamPool
+from .workers import WorkerSupervisor
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +72,12 @@ class ProxyLifetimeError(ProxyError):
     pass
 
 
+class MissingClientCredentials(ProxyError):
+    "A client of a shared proxy did not provide credentials for the crane index."
+
+    pass
+
+
 class ProxyAddress(NamedTuple):
     "Address of the proxy."
 
@@ -34,10 +89,29 @@ class ProxyAddress(NamedTuple):
 
 
 class IndexConfig(NamedTuple):
-    "Index configuration. Registerd indexes have a token."
+    """Index configuration. Registerd indexes have a token.
+
+    Mirrors are alternative base urls serving the same index. Which one gets used is decided on
+    their health and latency."""
 
     url: str
     registered: bool = False
+    mirrors: Tuple[str, ...] = ()
+    timeout: urllib3.Timeout = DEFAULT_TIMEOUT
+
+    def urls(self) -> Tuple[str, ...]:
+        return (self.url,) + self.mirrors
+
+
+class ProxyMode(Enum):
+    "How the proxy uses the upstream indexes and the last-known-good store."
+
+    # Always forward to the upstream indexes.
+    ONLINE = "online"
+    # Answer from the store if the upstream indexes fail.
+    STALE_IF_ERROR = "stale-if-error"
+    # Only answer from the store, never contact the upstream indexes.
+    OFFLINE = "offline"
 
 
 class IndexProxy:
@@ -50,11 +124,45 @@ class IndexProxy:
         simply be forwarded to PyPI.
     port: int
         Port number to serve the proxy under. (Default: 9999)
+    fallback_urls: Sequence[str]
+        Index urls (PyPI or mirrors of it) to fall back on. If empty, the fallback urls registered
+        with the index are used, or otherwise PyPI.
+    mode: ProxyMode
+        Online (default), stale-if-error or offline. The last two require a store.
+    store: LastKnownGoodStore | None
+        Store in which the successful responses are persisted. (Default: None, nothing is stored)
+    shared: bool
+        Serve multiple (local) users, each with their own credentials. See below.
+    connect_timeout, read_timeout: float | None
+        Timeouts (seconds) of the requests to all indexes. If None, the timeouts registered with
+        the crane index apply to it, otherwise the default timeouts.
+    hedge_after: float | None
+        Hedge requests to the next mirror if no response arrived after that many seconds.
+        (Default: None, no hedging)
+    warm_up: bool
+        Warm up when the proxy starts. See below. (Default: False)
+    warm_up_projects: Sequence[str]
+        Projects of which the pages are fetched during the warm-up. (Implies warm_up)
+    http2: bool
+        Request the indexes over HTTP/2 where supported. See below. (Default: False)
+    profile: "cprofile" | "sample" | None
+        Profile the handling of the requests and the authentication. See below. (Default: None)
+    profile_dir: str
+        Directory the profiles are written to. (Default: the working directory)
+    speculate: "pages" | "files" | None
+        Prefetch the dependencies of the distributions served. See below. (Default: None)
+    record: str | None
+        File to record the requests to (appended), for replays in benchmarks. No bodies, nor
+        credentials are recorded. See the recording module. (Default: None)
+    reload_interval: float | None
+        Seconds between checks whether the registered configs or the cached tokens changed on
+        disk, to reload them. See below. (Default: None, only reloaded on SIGHUP)
 
     Configuration:
     --------------
     The index to which the proxy forwards is specified in the construction. If a given package is
-    not found the index the request is forwarded to PyPI.
+    not found the index the request is forwarded to the fallback index. When multiple fallback
+    urls are given they are treated as mirrors of each other: the healthiest/fastest one is used.
 
     (Configuration is in active development)
 
@@ -64,44 +172,259 @@ class IndexProxy:
     the server act on the users behave against the crane server.
 
     Note, if the provided index url is not a registered crane protected index no authentication
-    flow is then initialized.
+    flow is then initialized. Neither is it in offline mode.
+
+    Reload:
+    -------
+    The registered configs and the cached tokens are reloaded from disk with `reload`: on SIGHUP
+    (when served by start_here or start_workers, the supervisor passes it on to the workers) or
+    when changed by another crane process (eg. `crane index register` or `crane index login`),
+    checked every `reload_interval` seconds. The indexes are swapped at once: requests in flight
+    finish with the old ones, the connection pools, caches and the store are kept.
+
+    Shared mode:
+    ------------
+    A shared proxy serves many users: it does not authenticate itself, instead the access token
+    of the crane index is taken from the Authorization header of the client (a Bearer token, or
+    the password of Basic auth, eg. `http://__token__:<access-token>@127.0.0.1:9999`). Clients
+    without credentials get a 401 for the crane index. Client credentials are never forwarded
+    to other hosts. Only the files of the public (fallback) indexes are stored and shared
+    between the users, everything of the crane index is fetched per user.
+
+    Offline / stale-if-error:
+    -------------------------
+    Successful responses are persisted in the store (if given). Files found in the store (eg. put
+    there by `crane prefetch`) are always served from it. In offline mode requests are only
+    answered from the store. In stale-if-error mode the store is used when the upstream indexes or
+    the authentication fail. Stale responses carry an `X-Crane-Stale` and a `Warning` header.
 
     Lifetime:
     ---------
     Start and stop the server in a seperate thread using the methods start/stop.
-    The lifetime can also be managed via a context manager.
+    The lifetime can also be managed via a context manager. Alternatively serve in this thread
+    with start_here, or with multiple worker processes with start_workers.
+
+    Warm-up:
+    --------
+    Such that the first requests are as fast as later ones, the warm-up concurrently validates (or
+    refreshes) the token of the crane index and opens a connection to every index and mirror.
+    Then the pages of the `warm_up_projects` are fetched through the proxy. The warm-up runs in
+    the background while the proxy serves. With workers it runs before the workers are started,
+    and each worker opens its own connections.
+
+    HTTP/2:
+    -------
+    With `http2` the https indexes that support it are requested over HTTP/2: the concurrent
+    requests to an index share a single connection. Requires the optional `h2` package, without it
+    (and for indexes without HTTP/2 support) HTTP/1.1 is used.
+
+    Profiling:
+    ----------
+    With `profile` the handling of every request is profiled, aggregated per endpoint (eg.
+    `GET /files/`), as is the authentication at start up. Either with cProfile, or (less overhead)
+    by sampling the stacks. The profiles are written when the proxy stops and on SIGUSR1, by every
+    worker separately. See the profiling module.
+
+    Speculation:
+    ------------
+    With `speculate` the dependencies (Requires-Dist) of the metadata and wheels the proxy serves
+    are prefetched in the background: their pages and the metadata of the files pip most likely
+    picks, or with "files" also those files (into the store). Such that they are at hand by the
+    time the (sequential) resolver of pip asks for them. See the speculate module.
     """
 
-    def __init__(self, index_url: Union[str, None], port: int = 9999) -> None:
+    def __init__(
+        self,
+        index_url: Union[str, None],
+        port: int = 9999,
+        fallback_urls: Sequence[str] = (),
+        mode: ProxyMode = ProxyMode.ONLINE,
+        store: Union[LastKnownGoodStore, None] = None,
+        shared: bool = False,
+        connect_timeout: Union[float, None] = None,
+        read_timeout: Union[float, None] = None,
+        hedge_after: Union[float, None] = None,
+        warm_up: bool = False,
+        warm_up_projects: Sequence[str] = (),
+        http2: bool = False,
+        profile: Union[str, None] = None,
+        profile_dir: str = ".",
+        speculate: Union[str, None] = None,
+        record: Union[str, None] = None,
+        reload_interval: Union[float, None] = None,
+    ) -> None:
         self._proxy: ThreadedHTTPServer
         self._proxy_thread: Thread
-
-        self.proxy_address = ProxyAddress(host="127.0.0.1", port=port)
+        self._profiler = Profiler(profile, profile_dir) if profile else None
+        if self._profiler:
+            self._profiler.dump_on_signal()
+        # No requests to the indexes in offline mode.
+        self._warm_up = (warm_up or bool(warm_up_projects)) and mode != ProxyMode.OFFLINE
+        self._warm_up_projects = tuple(warm_up_projects)
+        self._shared = shared
+        self._index_url = index_url
+        self._fallback_urls = tuple(fallback_urls)
+        self._timeouts = (connect_timeout, read_timeout)
+        self._reload_interval = reload_interval
+        self._stopped = Event()
+        self._supervisor: Union[WorkerSupervisor, None] = None
+
+        self.proxy_address = ProxyAddress(host="127.0.0.1", port=int(port))
         self.is_running: bool = False
 
-        # Determine the which indexes the proxy server should forward request to.
-        pypi_config = IndexConfig(url="https://pypi.python.org/simple")
+        if mode != ProxyMode.ONLINE and not store:
+            raise ProxyError(f"The {mode.value} mode requires a store.")
         if index_url:
-            # Perform a (potential) interactive authentication at start up and warm up the cache.
-            authenticate(crane_url=index_url)
-            indx_config = IndexConfig(url=index_url, registered=True)
-            indexes = (indx_config, pypi_config)
-        else:
-            indexes = (pypi_config,)
-
+            if shared:
+                # The clients bring their own credentials.
+                pass
+            elif mode == ProxyMode.ONLINE:
+                # Perform a (potential) interactive authentication at start up and warm up the
+                # cache.
+                with self._profiled("auth"):
+                    authenticate(crane_url=index_url)
+            elif mode == ProxyMode.STALE_IF_ERROR:
+                try:
+                    with self._profiled("auth"):
+                        authenticate(crane_url=index_url)
+                except Exception as e:
+                    logger.warning(f"Authentication failed, serving from store on errors: {e}")
+
+        indexes = self._resolve_indexes()
         self._indexes = indexes
         # Provide configured url/token info to handler class that each request instance would need.
         ProxyHTTPRequestHandler.indexes = indexes
+        ProxyHTTPRequestHandler.indexes_by_id = {index_id(i.url): i for i in indexes}
         ProxyHTTPRequestHandler.token_access_lock = Lock()
+        ProxyHTTPRequestHandler.upstream = UpstreamPool(hedge_after=hedge_after, http2=http2)
+        ProxyHTTPRequestHandler.mode = mode
+        ProxyHTTPRequestHandler.store = store
+        ProxyHTTPRequestHandler.coalescer = Coalescer()
+        ProxyHTTPRequestHandler.artifacts = ArtifactIndex(store.db if store else None)
+        ProxyHTTPRequestHandler.pages = PageCache()
+        ProxyHTTPRequestHandler.shared = shared
+        ProxyHTTPRequestHandler.profiler = self._profiler
+        if speculate == "files" and not store:
+            logger.warning("Speculative downloads of files need a store, only metadata is fetched.")
+        ProxyHTTPRequestHandler.speculator = (
+            Speculator(files=speculate == "files" and store is not None) if speculate else None
+        )
+        ProxyHTTPRequestHandler.recorder = Recorder(record) if record else None
+
+    def _resolve_indexes(self) -> Tuple[IndexConfig, ...]:
+        "The indexes to forward to: from the arguments, completed with the registered config."
+        index_url, fallback_urls = self._index_url, self._fallback_urls
+        connect_timeout, read_timeout = self._timeouts
+        # Determine the which indexes the proxy server should forward request to.
+        if not fallback_urls and index_url and index_url in server_configs:
+            fallback_urls = tuple(server_configs[index_url].fallback_urls)
+        if not fallback_urls:
+            fallback_urls = (DEFAULT_PYPI_URL,)
+        timeout = urllib3.Timeout(
+            connect=connect_timeout or DEFAULT_TIMEOUT.connect_timeout,
+            read=read_timeout or DEFAULT_TIMEOUT.read_timeout,
+        )
+        pypi_config = IndexConfig(
+            url=fallback_urls[0], mirrors=tuple(fallback_urls[1:]), timeout=timeout
+        )
+        if not index_url:
+            return (pypi_config,)
+        registered = server_configs.get(index_url)
+        if registered:
+            timeout = urllib3.Timeout(
+                connect=connect_timeout
+                or registered.connect_timeout
+                or DEFAULT_TIMEOUT.connect_timeout,
+                read=read_timeout or registered.read_timeout or DEFAULT_TIMEOUT.read_timeout,
+            )
+        indx_config = IndexConfig(url=index_url, registered=True, timeout=timeout)
+        return (indx_config, pypi_config)
+
+    def reload(self) -> None:
+        """Reload the registered configs and the cached tokens from disk, and swap in the indexes
+        following from them. If that fails, the current ones are kept.
+
+        The links on the pages served before keep working: the ids of indexes that were dropped
+        (eg. a changed fallback url) still resolve."""
+        try:
+            with ProxyHTTPRequestHandler.token_access_lock:
+                reload_credentials()
+            indexes = self._resolve_indexes()
+        except Exception as e:
+            logger.warning(f"Reloading the configuration failed, keeping the current one: {e}")
+            return
+        logger.debug("Reloaded the registered configs and tokens.")
+        if _index_settings(indexes) == _index_settings(self._indexes):
+            return
+        indexes_by_id = dict(ProxyHTTPRequestHandler.indexes_by_id)
+        indexes_by_id.update((index_id(i.url), i) for i in indexes)
+        # The ids first: requests that already see the new indexes must find them by id.
+        ProxyHTTPRequestHandler.indexes_by_id = indexes_by_id
+        ProxyHTTPRequestHandler.indexes = indexes
+        self._indexes = indexes
+        urls = ", ".join(i.url for i in indexes)
+        logger.info(f"Reloaded the configuration, forwarding to: {urls}")
+
+    def _watch_credentials(self, version: Tuple[int, int]) -> None:
+        """Reload when other crane processes changed the registered configs or tokens, compared to
+        the `version` read before the proxy started serving."""
+        while not self._stopped.wait(self._reload_interval):
+            try:
+                current = credentials_version()
+            except sqlite3.Error as e:
+                logger.debug(f"Checking the configuration for changes failed: {e}")
+                continue
+            if current != version:
+                version = current
+                self.reload()
+
+    def _start_watching(self, version: Union[Tuple[int, int], None] = None) -> None:
+        self._stopped.clear()
+        if self._reload_interval:
+            # Read here, not in the thread: changes made once serving started must not be missed.
+            if version is None:
+                version = credentials_version()
+            Thread(target=self._watch_credentials, args=(version,), daemon=True).start()
+
+    def _reload_on_sighup(self) -> Union[Callable, int, None]:
+        """Reload on SIGHUP. (Only on platforms that have it, from the main thread.) Returns the
+        previous handler."""
+        if not hasattr(signal, "SIGHUP") or current_thread() is not main_thread():
+            return None
+        return signal.signal(signal.SIGHUP, self._on_sighup)
+
+    def _on_sighup(self, signum, frame) -> None:
+        # In the main thread, which holds none of the locks the reload takes. (Unlike a thread
+        # started here, which could be forked by the supervisor while holding one.)
+        self.reload()
+        if self._supervisor:
+            self._supervisor.signal_workers(signal.SIGHUP)
+
+    def _profiled(self, label: str) -> ContextManager[None]:
+        return self._profiler.region(label) if self._profiler else nullcontext()
+
+    def _dump_profiles(self) -> None:
+        if self._profiler:
+            self._profiler.dump()
+
+    def _create_server(self) -> "ThreadedHTTPServer":
+        server = ThreadedHTTPServer(self.proxy_address, ProxyHTTPRequestHandler)
+        # Port 0 lets the OS pick a free port.
+        self.proxy_address = ProxyAddress(host=self.proxy_address.host, port=server.server_port)
+        if ProxyHTTPRequestHandler.speculator:
+            ProxyHTTPRequestHandler.speculator.start(self.proxy_address.url())
+        return server
 
     def start(self) -> None:
         "Start up the proxy an seperate thread."
         if not self.is_running:
-            self._proxy = ThreadedHTTPServer(self.proxy_address, ProxyHTTPRequestHandler)
+            self._proxy = self._create_server()
             logger.debug(f"Starting proxy on {self.proxy_address.url()}")
             self._proxy_thread = Thread(target=self._proxy.serve_forever)
             self._proxy_thread.start()
             self.is_running = True
+            self._start_warm_up()
+            self._start_watching()
         else:
             raise ProxyLifetimeError(f"Proxy is already running on {self.proxy_address.url()}")
 
@@ -112,14 +435,134 @@ class IndexProxy:
         if self.is_running:
             raise ProxyLifetimeError(f"Proxy is already running on {self.proxy_address.url()}")
 
-        self._proxy = ThreadedHTTPServer(self.proxy_address, ProxyHTTPRequestHandler)
+        self._proxy = self._create_server()
         logger.debug(f"Starting proxy on {self.proxy_address.url()}")
         self.is_running = True
+        self._start_warm_up()
+        self._start_watching()
+        previous = self._reload_on_sighup()
         try:
             self._proxy.serve_forever()
         except KeyboardInterrupt:
             logger.debug("Shutting down proxy server")
             self.is_running = False
+        finally:
+            self._stopped.set()
+            if previous is not None:
+                signal.signal(signal.SIGHUP, previous)
+            self._dump_profiles()
+
+    def start_workers(self, workers: int) -> None:
+        """Start up the proxy in `workers` forked processes, supervised by this process.
+
+        This function only returns on keyboard interrupt or SIGTERM."""
+        if self.is_running:
+            raise ProxyLifetimeError(f"Proxy is already running on {self.proxy_address.url()}")
+
+        self._proxy = self._create_server()
+        logger.debug(f"Starting proxy on {self.proxy_address.url()} with {workers} workers")
+        self.is_running = True
+        if self._warm_up:
+            # Served by this process for the time of the warm-up: no threads may run at the fork.
+            serving = Thread(target=self._proxy.serve_forever)
+            serving.start()
+            try:
+                self.warm_up(self._warm_up_projects)
+            finally:
+                self._proxy.shutdown()
+                serving.join()
+        self._supervisor = WorkerSupervisor(self._proxy, workers, on_start=self._start_worker)
+        previous = self._reload_on_sighup()
+        try:
+            self._supervisor.run()
+        finally:
+            logger.debug("Shutting down proxy server")
+            if previous is not None:
+                signal.signal(signal.SIGHUP, previous)
+            self._supervisor = None
+            self._proxy.server_close()
+            self.is_running = False
+            self._dump_profiles()
+
+    def _start_worker(self) -> None:
+        "Set up a forked worker. The connections of the supervisor are not to be shared."
+        ProxyHTTPRequestHandler.upstream.reset_after_fork()
+        if ProxyHTTPRequestHandler.speculator:
+            ProxyHTTPRequestHandler.speculator.reset_after_fork()
+        if ProxyHTTPRequestHandler.recorder:
+            ProxyHTTPRequestHandler.recorder.reset_after_fork()
+        if self._profiler:
+            self._profiler.reset_after_fork()
+            # The supervisor stops the workers with SIGTERM.
+            signal.signal(signal.SIGTERM, self._exit_worker)
+        if self._warm_up:
+            Thread(target=self._warm_up_indexes, daemon=True).start()
+        # Only the supervisor passes on SIGHUP. Workers reload themselves.
+        self._supervisor = None
+        if self._reload_interval:
+            # The configuration of the supervisor is as old as its last SIGHUP. The version is read
+            # first, such that changes made during the reload are picked up by the next one.
+            version = credentials_version()
+            self.reload()
+            self._start_watching(version)
+
+    def _exit_worker(self, signum, frame) -> None:
+        self._dump_profiles()
+        os._exit(0)
+
+    def _start_warm_up(self) -> None:
+        if self._warm_up:
+            Thread(target=self.warm_up, args=(self._warm_up_projects,), daemon=True).start()
+
+    def warm_up(self, projects: Sequence[str] = (), jobs: int = 8) -> "WarmUpReport":
+        """Warm up the tokens and connections of the indexes, then fetch the pages of `projects`
+        through the (running) proxy. All concurrently. The report is printed and returned."""
+        start = time.monotonic()
+        upstreams = self._warm_up_indexes(jobs)
+        pages = failed_pages = 0
+        if projects:
+            http = urllib3.PoolManager(maxsize=jobs)
+            base_url = self.proxy_address.url()
+
+            def fetch_page(project: str) -> bool:
+                try:
+                    resp = http.request("GET", f"{base_url}/{project}/", timeout=DEFAULT_TIMEOUT)
+                except urllib3.exceptions.HTTPError:
+                    return False
+                return resp.status == 200
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for ok in executor.map(fetch_page, projects):
+                    pages += ok
+                    failed_pages += not ok
+            # Ends the keep-alive connections (and so the threads serving them).
+            http.clear()
+        report = WarmUpReport(time.monotonic() - start, upstreams, pages, failed_pages)
+        print(report.summary())
+        return report
+
+    def _warm_up_indexes(self, jobs: int = 8) -> Dict[str, str]:
+        "Validate the tokens and probe every index url concurrently. Outcome by url."
+
+        def warm_up(index: IndexConfig, url: str) -> str:
+            headers = {}
+            try:
+                if index.registered and not self._shared:
+                    with self._profiled("auth"), ProxyHTTPRequestHandler.token_access_lock:
+                        headers["Authorization"] = "Bearer " + get_access_token(index.url)
+            except Exception as e:
+                return f"token failed: {e}"
+            attempt = ProxyHTTPRequestHandler.upstream.probe(
+                url, headers, timeout=index.timeout, preload_content=False
+            )
+            if attempt.resp is None:
+                return f"unreachable: {attempt.error}"
+            return f"{attempt.resp.status}"
+
+        tasks = [(index, url) for index in self._indexes for url in index.urls()]
+        with ThreadPoolExecutor(max_workers=max(min(len(tasks), jobs), 1)) as executor:
+            outcomes = executor.map(lambda task: warm_up(*task), tasks)
+            return {url: outcome for (_, url), outcome in zip(tasks, outcomes)}
 
     def __enter__(self):
         self.start()
@@ -130,7 +573,12 @@ class IndexProxy:
         if self.is_running:
             logger.info("Shutting down proxy server")
             self._proxy.shutdown()
+            self._proxy.server_close()
             self.is_running = False
+            self._stopped.set()
+            if ProxyHTTPRequestHandler.speculator:
+                ProxyHTTPRequestHandler.speculator.stop()
+            self._dump_profiles()
         else:
             raise ProxyLifetimeError("No proxy running to stop.")
 
@@ -141,6 +589,23 @@ class IndexProxy:
             logger.debug("Proxy already stopped in the context manager.")
 
 
+class WarmUpReport(NamedTuple):
+    "Outcome of the warm-up of the proxy."
+
+    duration: float
+    # Index url -> status of the probe, or the failure.
+    upstreams: Dict[str, str]
+    pages: int = 0
+    failed_pages: int = 0
+
+    def summary(self) -> str:
+        lines = [f"Warm-up done in {self.duration:.2f}s"]
+        lines += [f"  {url}: {outcome}" for url, outcome in self.upstreams.items()]
+        if self.pages or self.failed_pages:
+            lines.append(f"  {self.pages} project pages fetched, {self.failed_pages} failed")
+        return "\n".join(lines)
+
+
 class Method(Enum):
     "Supported http methods of proxy index."
 
@@ -158,65 +623,510 @@ class Method(Enum):
 SUPPORTED_METHODS = [m.value for m in Method]
 
 
+def is_page_content_type(content_type: str) -> bool:
+    "Is the content type that of a simple page (html or json)?"
+    return "text/html" in content_type or "json" in content_type
+
+
+def get_charset(content_type: str) -> str:
+    "Charset as specified in the content type header. (Default utf-8)"
+    for param in content_type.split(";")[1:]:
+        key, _, value = param.partition("=")
+        if key.strip().lower() == "charset" and value.strip():
+            return value.strip().strip('"')
+    return "utf-8"
+
+
 class ResponseClient(NamedTuple):
-    "Http response to send back to the client (pip, ...)"
+    """Http response to send back to the client (pip, ...)
+
+    Large bodies are not materialized as `content` but streamed: `stream` yields the chunks of the
+    body (of which the length is given by the Content-Length header)."""
 
     status_code: int
-    headers: Dict[str, str]
+    # Any mapping: the (case-insensitive) headers of urllib3 are passed on without copying.
+    headers: Mapping[str, str]
     content: Union[bytes, None]
+    stream: Union[Iterator[bytes], None] = None
+
+
+# Size of the chunks in which bodies are streamed.
+CHUNK_SIZE = 2**16
+
+# Path of the stats of the proxy. (Project names can not start with an underscore.)
+STATS_PATH = "/_crane/stats"
+# Root of the pages with only the files selected for a target environment:
+# /_crane/select/<query>/<project>/ with the query as for `FileSelector.from_query`.
+SELECT_PATH = "/_crane/select/"
+
+# Headers of the upstream response that are not passed on to the client.
+_HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length"}
+# Request headers forwarded upstream that change its response (besides Accept/Authorization).
+_FETCH_VARYING_HEADERS = ("Range", "If-Range", "If-None-Match", "If-Modified-Since")
+# Headers the proxy sets itself, those of the upstream response are replaced.
+_OWN_HEADERS = _HOP_BY_HOP_HEADERS | {"server", "date"}
 
 
 class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
     # Indexes to forward request to. This property is set on IndexProxy initialization.
     indexes: Tuple[IndexConfig, ...]
+    # Index-id (as used in the /files/ namespace) -> index.
+    indexes_by_id: Dict[str, IndexConfig]
     token_access_lock: Lock
+    upstream: UpstreamPool
+    mode: ProxyMode
+    store: Union[LastKnownGoodStore, None]
+    coalescer: Coalescer
+    artifacts: ArtifactIndex
+    pages: PageCache
+    shared: bool = False
+    profiler: Union[Profiler, None] = None
+    speculator: Union[Speculator, None] = None
+    recorder: Union[Recorder, None] = None
+    # Numbers the client connections, for the recording.
+    connections = itertools.count()
+    # Per request: the status and size of the body of the response (as sent).
+    response_status = 0
+    response_size = 0
     protocol_version = "HTTP/1.1"
+    # Per request: the selection of files asked for and the parsed anchors of the page (if known).
+    selector: Union[FileSelector, None] = None
+    page_anchors: Union[Dict[str, Union[SimpleFile, None]], None] = None
+    # The page state (and its key) of the page of the request, for its compressed variants.
+    page_state: Union[Tuple[PageKey, PageState], None] = None
+    selection_prefix = ""
 
     def _handle_request(self, method: Method) -> ResponseClient:
         """Businuess logic for handeling the request."""
 
-        headers = dict(self.headers)
+        shareable = self._is_shareable()
+        # Files are immutable, so what is known about them does not need to be asked upstream.
+        if method == Method.HEAD and is_files_path(self.path) and shareable:
+            record = self.artifacts.get(self.path)
+            if record and record.size is not None and record.content_type:
+                print(f"Index hit for resource: {self.path}")
+                headers = {
+                    "Content-Type": record.content_type,
+                    "Content-Length": str(record.size),
+                    "X-Crane-Cache": "index",
+                }
+                return ResponseClient(status_code=200, headers=headers, content=None)
+        if self.store and is_files_path(self.path) and method != Method.OPTIONS and shareable:
+            stored = self.store.get(self._store_key())
+            if stored:
+                print(f"Store hit for resource: {self.path}")
+                headers = dict(stored.headers)
+                headers["Content-Length"] = str(len(stored.content))
+                self.artifacts.record_download(self.path, headers)
+                headers["X-Crane-Cache"] = "hit"
+                return ResponseClient(status_code=200, headers=headers, content=stored.content)
+
+        if self.mode == ProxyMode.OFFLINE:
+            stored = self._stored_response(reason="offline")
+            if stored:
+                return stored
+            print(f"Not in store (offline) resource: {self.path}")
+            return ResponseClient(status_code=504, headers={}, content=None)
+
+        try:
+            resp = self._handle_upstream_request(method)
+        except Exception as e:
+            stored = self.mode == ProxyMode.STALE_IF_ERROR and self._stored_response(reason="error")
+            if not stored:
+                raise
+            logger.warning(f"Upstream failed: {e}")
+            return stored
+
+        if resp.status_code >= 500 and self.mode == ProxyMode.STALE_IF_ERROR:
+            stored = self._stored_response(reason="error")
+            if stored:
+                return stored
+        if self.store and method == Method.GET and resp.status_code == 200 and shareable:
+            variant = self._store_variant(resp.headers.get("Content-Type", ""))
+            if resp.stream is not None:
+                return resp._replace(stream=self._store_stream(resp, variant))
+            if resp.content:
+                self.store.put(self._store_key(), resp.headers, resp.content, variant=variant)
+        return resp
+
+    def _store_stream(self, resp: ResponseClient, variant: str) -> Iterator[bytes]:
+        "Pass through a streamed body, writing it to the store and adding it once complete."
+        assert self.store and resp.stream is not None
+        length = int(resp.headers.get("Content-Length", -1))
+        writer = self.store.writer(self._store_key(), resp.headers, variant=variant)
+        size = 0
+        try:
+            for chunk in resp.stream:
+                writer.write(chunk)
+                size += len(chunk)
+                if size == length:
+                    # Store before the client receives the last chunk.
+                    writer.commit()
+                yield chunk
+        finally:
+            writer.close()
+
+    def _handle_upstream_request(self, method: Method) -> ResponseClient:
+        "Forward the request to the upstream indexes."
+
         # TODO not exactly sure what the correct Host header should be...
         # but for now seems we can leave it out. TODO investigate
-        del headers["Host"]
-        org_auth_header = headers["Authorization"] if "Authorization" in headers else None
+        # Authorization is set per index by `_set_auth_header`.
+        headers = {
+            k: v for k, v in self.headers.items() if k.lower() not in ("host", "authorization")
+        }
 
+        try:
+            if is_files_path(self.path):
+                return self._handle_file_request(method, headers)
+            return self._handle_index_request(method, headers)
+        except MissingClientCredentials:
+            print(f"401 (no client credentials) for resource: {self.path}")
+            headers = {"WWW-Authenticate": 'Basic realm="crane-pip"'}
+            return ResponseClient(status_code=401, headers=headers, content=None)
+
+    def _is_shareable(self) -> bool:
+        """May the response for the request be shared with other clients?
+
+        Always the case, except in shared mode for everything that might come from the crane
+        index: its files and the pages (which might be merged with the crane index)."""
+        if not self.shared:
+            return True
+        if is_files_path(self.path):
+            try:
+                id_, _ = from_proxy_path(self.path)
+            except InvalidProxyPath:
+                return True
+            index = self.indexes_by_id.get(id_)
+            return not (index and index.registered)
+        return not any(index.registered for index in self.indexes)
+
+    def _store_key(self) -> str:
+        """Key of the response in the store. File paths name the index and the url of the file,
+        pages are kept per configuration of the indexes: only (reordered) mirrors share them."""
+        if is_files_path(self.path):
+            return self.path
+        return f"/_indexes/{store_scope(self.indexes)}{self.path}"
+
+    def _store_variant(self, content_type: str) -> str:
+        "Variant under which a response is stored: pages are stored per format."
+        if is_files_path(self.path):
+            return ""
+        return "json" if "json" in content_type else "html"
+
+    def _stored_response(self, reason: str) -> Union[ResponseClient, None]:
+        """The last-known-good response from the store, marked as stale. None if not stored."""
+        if not self.store or not self._is_shareable():
+            return None
+        if is_files_path(self.path):
+            variants = [""]
+        elif "json" in self.headers.get("Accept", ""):
+            variants = ["json", "html"]
+        else:
+            variants = ["html"]
+
+        for variant in variants:
+            stored = self.store.get(self._store_key(), variant=variant)
+            if stored:
+                print(f"Stale ({reason}) for resource: {self.path}")
+                headers = dict(stored.headers)
+                headers["X-Crane-Stale"] = f"{reason}; stored-at={stored.stored_at.isoformat()}"
+                headers["Warning"] = '110 crane-pip "Response is Stale"'
+                return ResponseClient(status_code=200, headers=headers, content=stored.content)
+        return None
+
+    def _handle_index_request(self, method: Method, headers: Dict[str, str]) -> ResponseClient:
+        """Request a path relative to the index urls. Trying the next index if not found.
+
+        Simple pages get their links rewritten to point to the proxy."""
+        org_auth_header = self.headers.get("Authorization")
+        client_accept_encoding = self.headers.get("Accept-Encoding")
+        # Ask for compressed pages, even if the client did not: we decode them anyway.
+        headers = {k: v for k, v in headers.items() if k.lower() != "accept-encoding"}
+        headers["Accept-Encoding"] = UPSTREAM_ACCEPT_ENCODING
+        # Conditional requests of the client itself are passed on as is.
+        client_conditional = any(
+            k.lower() in ("if-none-match", "if-modified-since") for k in headers
+        )
+
+        # If every index recently responded with a 404, there is no need to ask again.
+        last_response = ResponseClient(status_code=404, headers={}, content=None)
+        # Indexes that could not be reached (or are skipped by the circuit breaker).
+        unreachable: List[str] = []
+        last_error: Union[UpstreamError, None] = None
         for index in self.indexes:
-            # Set the correct Auth header. (keeping in mind that this updates accross loops)
-            if index.registered:
-                headers["Authorization"] = "Bearer " + self._fetch_token(index.url)
-            else:
-                if org_auth_header:
-                    headers["Authorization"] = org_auth_header
-                else:
-                    del headers["Authorization"]
-
-            resp = urllib3.request(
-                method.value,
-                url=self._get_request_url(index),
-                decode_content=False,
-                headers=headers,
-            )
+            # What is found in the crane index depends on the user in shared mode.
+            per_client = self.shared and index.registered
+            if not per_client and self.artifacts.is_not_found(index.url, self.path):
+                print(f"404 (cached) for resource: {index.url}{self.path}")
+                continue
+            self._set_auth_header(headers, index, org_auth_header)
+            page_key = (index.url, self.path, self.headers.get("Accept", ""))
+            page = None
+            if method == Method.GET and not per_client and not client_conditional:
+                page = self.pages.get(page_key)
+            try:
+                base_url, resp = self.upstream.request_mirrors(
+                    method.value,
+                    candidates=[(base, self._get_request_url(base)) for base in index.urls()],
+                    headers=dict(headers, **page.conditional_headers()) if page else headers,
+                    preload_content=False,
+                    timeout=index.timeout,
+                )
+            except UpstreamError as e:
+                # Try the next index, but only serve what it finds. (See below.)
+                logger.warning(f"Index {index.url} unreachable, trying the next index: {e}")
+                unreachable.append(index.url)
+                last_error = e
+                continue
 
-            # If resource not found try next index.
-            if self._is_404(resp):
+            content_type = resp.headers.get("Content-Type", "")
+            is_page = is_page_content_type(content_type)
+            # Pages are decoded as we need to inspect and rewrite them. Other content only if
+            # the client does not accept the encoding.
+            content_encoding = resp.headers.get("Content-Encoding")
+            decode = is_page or bool(
+                content_encoding and not accepts(client_accept_encoding, content_encoding)
+            )
+            content = resp.read(decode_content=decode)
+            resp_headers: Mapping[str, str] = resp.headers
+            if decode:
+                resp_headers = {
+                    k: v
+                    for k, v in resp_headers.items()
+                    if k.lower() not in ("content-encoding", "content-length")
+                }
+            last_response = ResponseClient(
+                status_code=resp.status, headers=resp_headers, content=content
+            )
+            if page and page.page_url != resp.url:
+                # Served by another mirror: its links differ.
+                page = None
+
+            if page and resp.status == 304:
+                print(f"304 (page unchanged) for resource: {resp.url}")
+                self.pages.count("revalidated")
+                self.page_anchors = page.anchors
+                if time.time() - page.recorded > self.artifacts.max_age / 2:
+                    self.artifacts.record_page(page.files.values())
+                    page = page._replace(recorded=time.time(), encoded=dict(page.encoded))
+                    self.pages.put(page_key, page)
+                self.page_state = (page_key, page)
+                last_response = ResponseClient(
+                    status_code=200,
+                    headers=revalidated_headers(page.headers, resp_headers),
+                    content=page.content,
+                )
+            elif self._is_404(resp.status, content_type, content):
+                # If resource not found try next index.
                 # TODO make logger.debug info work!
-                print(f"404 for resource: {self._get_request_url(index)}")
+                print(f"404 for resource: {resp.url}")
+                if not per_client:
+                    self.artifacts.record_not_found(index.url, self.path)
                 continue
+            else:
+                print(f"{resp.status} for resource: {resp.url}")
+            if is_page and resp.status == 200 and content:
+                content = self._update_page(
+                    page_key if not per_client else None,
+                    page,
+                    last_response,
+                    resp.url,
+                    index,
+                    self.upstream.resolve(base_url),
+                )
+                last_response = last_response._replace(content=content)
+            if unreachable:
+                warning = f'199 crane-pip "Skipped unreachable index: {", ".join(unreachable)}"'
+                last_response = last_response._replace(
+                    headers=dict(last_response.headers, Warning=warning)
+                )
+            return last_response
 
-            print(f"{resp.status} for resource: {self._get_request_url(index)}")
+        # If we get here then it means no index has the resource. Return the response of the
+        # the last call index. Unless an index could not be asked: its absence is then unknown.
+        if last_error:
+            raise last_error
+        return last_response
+
+    def _handle_file_request(self, method: Method, headers: Dict[str, str]) -> ResponseClient:
+        """Request a file in the /files/ namespace: links rewritten on the pages of an index."""
+        try:
+            id_, url = from_proxy_path(self.path)
+            index = self.indexes_by_id[id_]
+        except (InvalidProxyPath, KeyError):
+            return ResponseClient(status_code=404, headers={}, content=None)
+
+        # Only the index itself gets the index credentials, not the hosts it links to.
+        target = urlparse(url)
+        same_origin = any(
+            (target.scheme, target.netloc) == urlparse(u)[:2]
+            for u in map(self.upstream.resolve, index.urls())
+        )
+        self._set_auth_header(
+            headers, index if same_origin else None, self.headers.get("Authorization")
+        )
+
+        resp = self.upstream.request(
+            method.value, url, headers=headers, preload_content=False, timeout=index.timeout
+        )
+        print(f"{resp.status} for resource: {url}")
+        resp_headers = resp.headers
+        if resp.status == 200 and self._is_shareable():
+            self.artifacts.record_download(self.path, resp_headers)
+        if method == Method.GET and resp.status == 200 and "Content-Length" in resp.headers:
             return ResponseClient(
-                status_code=resp.status, headers=dict(resp.headers), content=resp.data
+                status_code=resp.status,
+                headers=resp_headers,
+                content=None,
+                stream=iter_body(resp),
             )
-
-        # If we get here then it means no index has the resource. Return the response of the
-        # the last call index.
         return ResponseClient(
-            status_code=resp.status, headers=dict(resp.headers), content=resp.data
+            status_code=resp.status, headers=resp_headers, content=resp.read(decode_content=False)
         )
 
+    def _set_auth_header(
+        self,
+        headers: Dict[str, str],
+        index: Union[IndexConfig, None],
+        org_auth_header: Union[str, None],
+    ) -> None:
+        "Set the correct Auth header for the index (None if no index credentials apply)."
+        if index and index.registered:
+            if self.shared:
+                token = client_token(org_auth_header)
+                if not token:
+                    raise MissingClientCredentials(index.url)
+            else:
+                token = self._fetch_token(index.url)
+            headers["Authorization"] = "Bearer " + token
+        elif org_auth_header and not self.shared:
+            headers["Authorization"] = org_auth_header
+        else:
+            headers.pop("Authorization", None)
+
+    def _update_page(
+        self,
+        key: Union[PageKey, None],
+        page: Union[PageState, None],
+        resp: ResponseClient,
+        page_url: str,
+        index: IndexConfig,
+        base_url: str,
+    ) -> bytes:
+        """Rewrite a page and record its files, incrementally with respect to its previous state.
+
+        Returns the rewritten content. The new state is kept under `key`. (Unless None.)"""
+        assert resp.content
+        content_type = resp.headers.get("Content-Type", "")
+        serial = resp.headers.get("X-PyPI-Last-Serial")
+        digest = page_digest(resp.content)
+        encoded: Dict[str, bytes] = {}
+        if page and page.is_unchanged(content_type, serial, digest):
+            self.pages.count("unchanged")
+            content, files, links, anchors = page.content, page.files, page.links, page.anchors
+            encoded = dict(page.encoded)
+            changed: List[SimpleFile] = []
+        else:
+            if page:
+                self.pages.count("changed")
+            links = dict(page.links) if page else {}
+            anchors = dict(page.anchors) if page else {}
+            content = self._rewrite_page(
+                resp.content, content_type, page_url, index, base_url, links
+            )
+            files = {
+                f.url: f
+                for f in parse_page(content, content_type, anchors=anchors)
+                if is_files_path(f.url)
+            }
+            old_files = page.files if page else {}
+            changed = [f for path, f in files.items() if old_files.get(path) != f]
+
+        self.page_anchors = anchors
+        # Records of unchanged files are refreshed once in a while, such that they stay fresh.
+        recorded = page.recorded if page else 0.0
+        if time.time() - recorded > self.artifacts.max_age / 2:
+            self.artifacts.record_page(files.values())
+            recorded = time.time()
+        else:
+            self.artifacts.record_page(changed)
+
+        if key:
+            state = PageState(
+                page_url=page_url,
+                digest=digest,
+                content_type=content_type,
+                etag=resp.headers.get("ETag"),
+                last_modified=resp.headers.get("Last-Modified"),
+                serial=serial,
+                headers=resp.headers,
+                content=content,
+                files=files,
+                links=links,
+                anchors=anchors,
+                recorded=recorded,
+                encoded=encoded,
+            )
+            self.pages.put(key, state)
+            self.page_state = (key, state)
+        return content
+
+    def _rewrite_page(
+        self,
+        content: bytes,
+        content_type: str,
+        page_url: str,
+        index: IndexConfig,
+        base_url: str,
+        links: Union[Dict[str, str], None] = None,
+    ) -> bytes:
+        "Rewrite the links on a simple page to the /files/ namespace of the proxy."
+        id_ = index_id(index.url)
+        text = content.decode(get_charset(content_type))
+        if "json" in content_type:
+            text = rewrite_json(text, page_url, id_, base_url)
+        else:
+            text = rewrite_html(text, page_url, id_, base_url, links)
+        return text.encode(get_charset(content_type))
+
+    def setup(self):
+        super().setup()
+        self.connection_id = connection_id(next(self.connections))
+
     def do_request(self):
         "Top-level Wrapper for handeling all the different kind of method requests"
+        if self.profiler is None and self.recorder is None:
+            self._do_request()
+            return
+        arrived, start = time.time(), time.perf_counter()
+        path = self.path
+        self.response_status = self.response_size = 0
+        if self.profiler:
+            with self.profiler.region(profile_endpoint(self.command, path)):
+                self._do_request()
+        else:
+            self._do_request()
+        if self.recorder:
+            record = Record(
+                t=arrived,
+                connection=self.connection_id,
+                method=self.command,
+                path=path,
+                status=self.response_status,
+                size=self.response_size if self.command != "HEAD" else 0,
+                duration=time.perf_counter() - start,
+                accept=self.headers.get("Accept", ""),
+                accept_encoding=self.headers.get("Accept-Encoding", ""),
+            )
+            self.recorder.record(record)
+
+    def log_request(self, code="-", size="-"):
+        if isinstance(code, int):
+            self.response_status = int(code)
+        super().log_request(code, size)
+
+    def _do_request(self):
         try:
             if self.command not in SUPPORTED_METHODS:
                 self.send_response(405)
@@ -225,27 +1135,278 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
                 return
 
             method = Method(self.command)
-            resp = self._handle_request(method)
-            self.send_response(resp.status_code)
-            self._send_response_headers(resp.headers, resp.content)
-            if method.response_has_content() and resp.content:
-                self.wfile.write(resp.content)
+            self.page_anchors = None
+            self.page_state = None
+            raw_path = self.path
+            try:
+                self.path, self.selector = split_selector(self.path)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            # The selection prefix (if any), under which the dependencies are prefetched.
+            prefixed = raw_path != self.path and raw_path.endswith(self.path)
+            self.selection_prefix = raw_path[: -len(self.path)] if prefixed else ""
+            if method == Method.GET and self.path == STATS_PATH:
+                self._send_response(method, self._stats_response())
+                return
+            if method == Method.GET and self.speculator and self._is_shareable():
+                if self._send_speculated(raw_path):
+                    return
+                self.speculator.note_request(self.path, self.headers)
+            if method == Method.GET and self._send_stored_file():
+                return
+            if method == Method.OPTIONS:
+                self._send_response(method, self._encode_response(self._handle_request(method)))
+            else:
+                self._do_coalesced_request(method)
 
         except Exception:
             self.send_error(502, "Bad gateway")
 
-    def _is_404(self, resp: urllib3.BaseHTTPResponse) -> bool:
+    def _do_coalesced_request(self, method: Method) -> None:
+        """Handle the request, sharing the upstream fetch with identical concurrent requests.
+
+        Partial and conditional requests only share with the same partial or conditional ones:
+        their headers are forwarded upstream and make its response differ (206, 304)."""
+        # Users of a shared proxy share the fetches of public resources.
+        shared_fetch = self.shared and self._is_shareable()
+        key = (
+            method.value,
+            self.path,
+            self.headers.get("Accept"),
+            self.headers.get("Accept-Encoding"),
+            None if shared_fetch else self.headers.get("Authorization"),
+            self.selector,
+            tuple(self.headers.get(h) for h in _FETCH_VARYING_HEADERS),
+        )
+        fetch, leader = self.coalescer.join(key)
+        if not leader:
+            print(f"Coalesced request for resource: {self.path}")
+            status, headers = fetch.wait_head()
+            stream = fetch.iter_body() if fetch.streaming else None
+            self._send_response(method, ResponseClient(status, headers, fetch.content, stream))
+            return
+
+        try:
+            try:
+                resp = self._handle_request(method)
+                if method == Method.GET and self.speculator:
+                    resp = self._observe_dependencies(resp)
+                resp = self._encode_response(self._select_files(resp))
+            except BaseException as e:
+                fetch.fail(e)
+                raise
+            stream = fetch.publish(resp.status_code, resp.headers, resp.content, resp.stream)
+            # The leader feeds the followers, so it reads the full body even if its client left.
+            self._send_response(method, resp._replace(stream=stream), consume_all=True)
+        finally:
+            self.coalescer.release(key, fetch)
+
+    def _send_speculated(self, raw_path: str) -> bool:
+        "Send the response prefetched by the speculator. False if there is none."
+        assert self.speculator
+        prefetched = self.speculator.take(raw_path, self.headers)
+        if prefetched is None:
+            return False
+        print(f"Speculative hit for resource: {self.path}")
+        headers = dict(prefetched.headers)
+        headers["X-Crane-Cache"] = "speculative"
+        self._send_response(Method.GET, ResponseClient(200, headers, prefetched.content))
+        return True
+
+    def _observe_dependencies(self, resp: ResponseClient) -> ResponseClient:
+        """Let the speculator prefetch the dependencies of a served wheel or metadata file.
+
+        Of streamed responses only metadata files are held in memory, wheels are read back from
+        the store. (Without a store streamed wheels are not inspected.)"""
+        speculator = self.speculator
+        if (
+            speculator is None
+            or resp.status_code != 200
+            or not self.path.endswith((".whl", ".metadata"))
+            or not is_files_path(self.path)
+            or not self._is_shareable()
+            or int(resp.headers.get("Content-Length", 0)) > speculator.max_wheel_size
+        ):
+            return resp
+        prefix, path = self.selection_prefix, self.path
+        if resp.stream is None:
+            content = resp.content
+            speculator.observe(prefix, path, lambda: content)
+            return resp
+
+        chunks: Union[List[bytes], None] = None
+        if path.endswith(".metadata"):
+            if int(resp.headers.get("Content-Length", 0)) > speculator.max_metadata_size:
+                return resp
+            chunks = []
+
+            def load() -> Union[bytes, None]:
+                return b"".join(chunks or [])
+
+        elif self.store:
+            # Streamed wheels are not held in memory: they are read back from the store (in which
+            # they are complete once streamed).
+            store, key = self.store, self._store_key()
+
+            def load() -> Union[bytes, None]:
+                stored = store.get(key)
+                return stored.content if stored else None
+
+        else:
+            return resp
+
+        def observed(stream: Iterable[bytes]) -> Iterator[bytes]:
+            for chunk in stream:
+                if chunks is not None:
+                    chunks.append(chunk)
+                yield chunk
+            speculator.observe(prefix, path, load)
+
+        return resp._replace(stream=observed(resp.stream))
+
+    def _select_files(self, resp: ResponseClient) -> ResponseClient:
+        "Only keep the files of a page that are selected by the request. (If any selection.)"
+        content_type = resp.headers.get("Content-Type", resp.headers.get("content-type", ""))
+        if (
+            self.selector is None
+            or resp.status_code != 200
+            or not resp.content
+            or not is_page_content_type(content_type)
+            or any(k.lower() == "content-encoding" for k in resp.headers)
+        ):
+            return resp
+        charset = get_charset(content_type)
+        text = resp.content.decode(charset)
+        selected = select_files(text, content_type, self.selector, self.page_anchors)
+        headers = {k: v for k, v in resp.headers.items() if k.lower() != "content-length"}
+        return resp._replace(headers=headers, content=selected.encode(charset))
+
+    def _encode_response(self, resp: ResponseClient) -> ResponseClient:
+        """Compress simple pages if the client accepts it. Pages kept in the page cache are
+        compressed once per encoding. Compressed or not, pages vary on Accept-Encoding."""
+        content_type = resp.headers.get("Content-Type", resp.headers.get("content-type", ""))
+        if resp.status_code != 200 or not resp.content or not is_page_content_type(content_type):
+            return resp
+        vary = [v for k, v in resp.headers.items() if k.lower() == "vary"]
+        headers = {k: v for k, v in resp.headers.items() if k.lower() != "vary"}
+        if "accept-encoding" not in ", ".join(vary).lower():
+            vary.append("Accept-Encoding")
+        headers["Vary"] = ", ".join(vary)
+        encoding = choose_encoding(self.headers.get("Accept-Encoding"))
+        if (
+            not encoding
+            or len(resp.content) < MIN_COMPRESS_SIZE
+            or any(k.lower() == "content-encoding" for k in resp.headers)
+        ):
+            return resp._replace(headers=headers)
+        headers = {k: v for k, v in headers.items() if k.lower() != "content-length"}
+        headers["Content-Encoding"] = encoding
+        if self.page_state and self.page_state[1].content is resp.content:
+            content = self.pages.encoded(*self.page_state, encoding)
+        else:
+            content = compress(resp.content, encoding)
+        return resp._replace(headers=headers, content=content)
+
+    def _stats_response(self) -> ResponseClient:
+        """Stats of the proxy as json: health, circuit breaker state and counters per upstream, and
+        the outcomes of the page refreshes."""
+        stats = {"upstreams": self.upstream.stats(), "pages": self.pages.stats()}
+        if self.speculator:
+            stats["speculation"] = self.speculator.stats()
+        content = json.dumps(stats, indent=2).encode()
+        headers = {"Content-Type": "application/json", "Cache-Control": "no-store"}
+        return ResponseClient(status_code=200, headers=headers, content=content)
+
+    def _send_stored_file(self) -> bool:
+        """Send a file from the store with sendfile (no copies in user space). False if not stored.
+
+        Store hits need no upstream fetch, so they are not coalesced."""
+        if not (self.store and is_files_path(self.path) and self._is_shareable()):
+            return False
+        opened = self.store.open(self._store_key())
+        if not opened:
+            return False
+        headers, body = opened
+        with body:
+            headers["Content-Length"] = str(os.fstat(body.fileno()).st_size)
+            self.artifacts.record_download(self.path, headers)
+            headers["X-Crane-Cache"] = "hit"
+            print(f"Store hit for resource: {self.path}")
+            send_buffers(self.connection, [self._response_head(200, headers, None)])
+            self.connection.sendfile(body)
+        speculator = self.speculator
+        if (
+            speculator
+            and self.path.endswith((".whl", ".metadata"))
+            and int(headers["Content-Length"]) <= speculator.max_wheel_size
+        ):
+            store, path = self.store, self.path
+
+            def load() -> Union[bytes, None]:
+                stored = store.get(path)
+                return stored.content if stored else None
+
+            speculator.observe(self.selection_prefix, path, load)
+        return True
+
+    def _send_response(
+        self, method: Method, resp: ResponseClient, consume_all: bool = False
+    ) -> None:
+        "Send the response to the client. The head and the body are sent in one system call."
+        head = self._response_head(resp.status_code, resp.headers, resp.content)
+        if resp.stream is not None:
+            try:
+                self._write_stream(resp.stream, consume_all, head)
+            except Exception as e:
+                # The headers are already sent, all that is left is closing the connection.
+                logger.warning(f"Streaming {self.path} failed: {e}")
+                self.close_connection = True
+        elif method.response_has_content() and resp.content:
+            send_buffers(self.connection, [head, resp.content])
+        else:
+            send_buffers(self.connection, [head])
+
+    def _write_stream(self, stream: Iterable[bytes], consume_all: bool, head: bytes) -> None:
+        """Write the head and a streamed body. The head goes with the first chunk.
+
+        If `consume_all` the stream is read entirely, even on errors."""
+        pending = [head]
+        for chunk in stream:
+            pending.append(chunk)
+            try:
+                send_buffers(self.connection, pending)
+                pending = []
+            except OSError:
+                # Client went away.
+                self.close_connection = True
+                if not consume_all:
+                    return
+                for _ in stream:
+                    pass
+                return
+        if pending:
+            send_buffers(self.connection, pending)
+
+    def _is_404(self, status: int, content_type: str, content: Union[bytes, None]) -> bool:
         """Is the response a 404? Currently a bug in crane that turns actual 404 response in 200"""
 
-        if resp.status == 404:
+        if status == 404:
             return True
-        if resp.status != 200:
+        if status != 200 or not content:
             return False
 
-        if "text/html" in resp.headers["Content-Type"]:
-            return "Not found" in resp.data.decode()
-        if "application/json" in resp.headers["Content-Type"]:
-            parsed = json.loads(resp.data)
+        if "text/html" in content_type:
+            charset = get_charset(content_type).lower()
+            if charset in ("utf-8", "utf8", "ascii", "us-ascii", "iso-8859-1", "latin-1"):
+                # No need to decode (a copy of) the page for these charsets.
+                return b"Not found" in content
+            return "Not found" in content.decode(charset, errors="replace")
+        if "json" in content_type:
+            try:
+                parsed = json.loads(content)
+            except ValueError:
+                return False
             if isinstance(parsed, dict) and "code" in parsed and parsed["code"] == 404:
                 return True
         return False
@@ -259,50 +1420,57 @@ class ProxyHTTPRequestHandler(BaseHTTPRequestHandler):
         This operation needs to get coordinated between threads to ensure that not multiple
         threads are writing the same time on disk. Causing issues.
         """
-        with self.token_access_lock:
+        region = self.profiler.region("auth") if self.profiler else nullcontext()
+        with region, self.token_access_lock:
             return get_access_token(index_url)
 
-    def _get_request_url(self, index: IndexConfig) -> str:
-        """Get the url to forward the request to based on the index we send to."""
-        # If self.path endswith `/` then pip tried to add `/package_name/` to the
-        # base index url to explore the available versions of a package.
-        #
-        # Note, the base index-url might already contains a path like https://pypi.org/simple/
-        # and so pip requests a path `/package_name/` relative to the path path of the index url.
-        #
-        # The reponse is html containing href links usually absolute path links of the website.
-        # Eg. /simple/package_name/package_name-1.2.0.tar.gz and so the download request will
-        # be interms of absolute path.
-        #
-        # But since we force pip to talk to localhost:9999 we have the situation that self.path
-        # is one time with relative path to that of the index-url and the other time with absolute
-        # path from the index-url
-        if self.path.endswith("/"):
-            url = index.url + self.path
-        else:
-            parsed_url = urlparse(index.url)
-            url = parsed_url.scheme + "://" + parsed_url.netloc + self.path
-        return url
+    def _get_request_url(self, index_url: str) -> str:
+        """Get the url to forward the request to based on the index (base url) we send to.
 
-    def _send_response_headers(self, headers: Dict, content: Union[bytes, None]):
-        """Adjust and send response headers to the client
+        Paths outside of the /files/ namespace are always relative to the index url: links on the
+        simple pages are rewritten such that absolute links never end up here."""
+        return index_url.rstrip("/") + self.path
 
-        We have to set Content-Length if the response from the index was chunked.
+    def _response_head(
+        self, status: int, headers: Mapping[str, str], content: Union[bytes, None]
+    ) -> bytes:
+        """Build the status line and the headers of the response in one go.
+
+        Hop-by-hop headers of the upstream response are dropped, its Server and Date replaced by
+        those of the proxy. We have to set Content-Length if the response from the index was
+        chunked (or decoded): the content is then the body.
 
         Arguments:
         ----------
-        headers: dict
-            Dictionary of headers as responded back by the
+        status: int
+            Status code of the response.
+        headers: Mapping
+            Headers as responded back by the index (or set by the proxy).
+        content: bytes | None
+            The (materialized) body of the response. None if streamed or empty.
         """
-        res = {h.lower(): v for h, v in headers.items() if h.lower() != "transfer-encoding"}
-        if "content-length" not in res:
-            if content:
-                res["content-length"] = str(len(content))
-            else:
-                res["content-length"] = "0"
-        for k, v in res.items():
-            self.send_header(k, v)
-        self.end_headers()
+        self.log_request(status)
+        reason = self.responses[status][0] if status in self.responses else ""
+        lines = [
+            f"{self.protocol_version} {status} {reason}",
+            f"Server: {self.version_string()}",
+            f"Date: {http_date()}",
+        ]
+        content_length = None
+        for k, v in headers.items():
+            lower = k.lower()
+            if lower == "content-length":
+                content_length = v
+            elif lower not in _OWN_HEADERS:
+                lines.append(f"{k}: {v}")
+        if content_length is None:
+            content_length = str(len(content)) if content else "0"
+        self.response_size = int(content_length)
+        lines.append(f"Content-Length: {content_length}")
+        if self.close_connection:
+            lines.append("Connection: close")
+        lines.append("\r\n")
+        return "\r\n".join(lines).encode("latin-1")
 
 
 # Dispatch all the different method calls to do_request
@@ -310,8 +1478,134 @@ for m in ("HEAD", "GET", "OPTIONS", "POST", "PUT", "DELETE", "PATCH"):
     setattr(ProxyHTTPRequestHandler, "do_" + m, ProxyHTTPRequestHandler.do_request)
 
 
+def client_token(authorization: Union[str, None]) -> Union[str, None]:
+    """The access token in the Authorization header of a client. None if there is none.
+
+    Either a Bearer token, or the password of Basic auth (as pip sends the credentials in the
+    index url that way)."""
+    if not authorization:
+        return None
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() == "bearer":
+        return credentials.strip() or None
+    if scheme.lower() == "basic":
+        try:
+            decoded = base64.b64decode(credentials.strip(), validate=True).decode()
+        except (binascii.Error, UnicodeDecodeError):
+            return None
+        return decoded.partition(":")[2] or None
+    return None
+
+
+def split_selector(path: str) -> Tuple[str, Union[FileSelector, None]]:
+    """Split the selection of files off the path of a page request.
+
+    The selection is either given by the path prefix `SELECT_PATH` (for clients like pip that
+    only take the root url of an index) or by the query of the path."""
+    if path.startswith(SELECT_PATH):
+        query, _, rest = path[len(SELECT_PATH) :].partition("/")
+        return "/" + rest, FileSelector.from_query(unquote(query))
+    if "?" in path and not is_files_path(path):
+        page, _, query = path.partition("?")
+        selector = FileSelector.from_query(query)
+        if selector:
+            return page, selector
+    return path, None
+
+
+def profile_endpoint(method: str, path: str) -> str:
+    "The endpoint of a request, by which its profile is aggregated. Eg. `GET /<project>/`."
+    if path.startswith(SELECT_PATH):
+        path = split_selector(path)[0]
+        method += " selected"
+    if is_files_path(path):
+        endpoint = FILES_PATH
+    elif path.startswith("/_crane/"):
+        endpoint = path.partition("?")[0]
+    elif path.partition("?")[0].strip("/"):
+        endpoint = "/<project>/"
+    else:
+        endpoint = "/"
+    return f"{method} {endpoint}"
+
+
+def store_scope(indexes: Sequence[IndexConfig]) -> str:
+    "Identity of the indexes under which their pages are stored, regardless of mirror order."
+    return "+".join(index_id(" ".join(sorted(i.urls()))) for i in indexes)
+
+
+def _index_settings(indexes: Sequence[IndexConfig]) -> List[tuple]:
+    "What matters of the indexes to compare them. (urllib3 Timeouts do not compare by value)"
+    return [
+        (i.url, i.registered, i.mirrors, i.timeout.connect_timeout, i.timeout.read_timeout)
+        for i in indexes
+    ]
+
+
+def revalidated_headers(
+    stored: Mapping[str, str], not_modified: Mapping[str, str]
+) -> Dict[str, str]:
+    "Headers of a stored response, updated with those of the 304 that revalidated it."
+    headers = dict(stored)
+    lower = {k.lower(): k for k in headers}
+    for k, v in not_modified.items():
+        if k.lower() in _HOP_BY_HOP_HEADERS or k.lower().startswith("content-"):
+            continue
+        headers.pop(lower.get(k.lower(), k), None)
+        headers[k] = v
+    return headers
+
+
+def send_buffers(sock, buffers: List[bytes]) -> None:
+    "Send the buffers as one (vectored) write, without joining them first."
+    views = [memoryview(b) for b in buffers if b]
+    if not hasattr(sock, "sendmsg"):
+        for view in views:
+            sock.sendall(view)
+        return
+    while views:
+        sent = sock.sendmsg(views)
+        # Drop what was sent, continue with the remainder.
+        while views and sent >= len(views[0]):
+            sent -= len(views.pop(0))
+        if sent:
+            views[0] = views[0][sent:]
+
+
+# Date header cache: (epoch second, formatted date).
+_http_date = (0, "")
+
+
+def http_date() -> str:
+    "Value of the Date header. Formatted at most once a second."
+    global _http_date
+    now = int(time.time())
+    if _http_date[0] != now:
+        _http_date = (now, formatdate(now, usegmt=True))
+    return _http_date[1]
+
+
+def iter_body(resp: urllib3.BaseHTTPResponse) -> Iterator[bytes]:
+    "Stream the raw body of the upstream response, returning the connection to the pool after."
+    complete = False
+    try:
+        yield from resp.stream(CHUNK_SIZE, decode_content=False)
+        complete = True
+    finally:
+        if not complete:
+            # Connection is in an unknown state, it should not get reused.
+            resp.close()
+        resp.release_conn()
+
+
 class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
     daemon_threads = True
+    # Seconds between the checks for a shutdown. Short, such that stopping the proxy (at the end
+    # of every `crane pip` call) does not take up to half a second.
+    poll_interval = 0.05
+
+    def serve_forever(self, poll_interval: Union[float, None] = None) -> None:
+        super().serve_forever(poll_interval or self.poll_interval)
 
     def handle_error(self, request, client_address):
         # ignore ConnectionResetError
@@ -0,0 +1,80 @@
+"""Recording of the traffic of the proxy, to replay it (offline) in benchmarks.
+
+Every request handled by the proxy is written as a line of json to the recording: when it arrived,
+on which client connection, the method, path and Accept headers, the status, the size of the body
+and how long handling it took. No bodies nor other headers, thus no credentials. The queries of the
+paths of files (which can hold signatures, eg. of presigned urls) are left out too.
+
+The lines are appended as they are handled: the recording of a proxy killed is still usable and
+the worker processes of a proxy write to the same file. `benchmarks/replay.py` replays a recording
+against a stand-in index.
+"""
+
+import json
+import os
+from threading import Lock
+from typing import List, NamedTuple
+
+from .links import is_files_path
+
+
+class Record(NamedTuple):
+    "A request handled by the proxy."
+
+    # Time (epoch seconds) the request arrived.
+    t: float
+    # Identifies the client connection it arrived on. (Unique across the worker processes)
+    connection: str
+    method: str
+    path: str
+    status: int
+    # Bytes of the body of the response (as sent, thus possibly compressed).
+    size: int
+    # Seconds it took to handle the request.
+    duration: float
+    accept: str = ""
+    accept_encoding: str = ""
+
+
+class Recorder:
+    """Appends the records to the recording `file`."""
+
+    def __init__(self, file: str) -> None:
+        self.file = file
+        self._lock = Lock()
+        # Line buffered: every record is a single write.
+        self._out = open(file, "a", buffering=1)
+
+    def record(self, record: Record) -> None:
+        if is_files_path(record.path):
+            record = record._replace(path=record.path.partition("?")[0])
+        line = json.dumps(record._asdict()) + "\n"
+        with self._lock:
+            self._out.write(line)
+
+    def reset_after_fork(self) -> None:
+        "In a forked worker: the lock may have been held by another thread at the fork."
+        self._lock = Lock()
+
+    def close(self) -> None:
+        with self._lock:
+            self._out.close()
+
+
+def read_recording(file: str) -> List[Record]:
+    """The records of a recording, in order of arrival. Invalid lines (eg. the last one of a
+    recording cut short) are skipped."""
+    records = []
+    with open(file) as f:
+        for line in f:
+            try:
+                records.append(Record(**json.loads(line)))
+            except (ValueError, TypeError):
+                continue
+    records.sort(key=lambda r: r.t)
+    return records
+
+
+def connection_id(number: int) -> str:
+    "Id of the `number`th client connection of this process."
+    return f"{os.getpid()}-{number}"
@@ -0,0 +1,286 @@
+"""Parsing of the simple (PEP 503 html / PEP 691 json) pages and the file names listed on them."""
+
+from fnmatch import fnmatchcase
+from functools import lru_cache
+import html
+import json
+import re
+import sys
+from typing import Dict, FrozenSet, List, NamedTuple, Tuple, Union
+from urllib.parse import parse_qs, urlencode, urljoin
+
+# pip is a dependency of crane-pip. Its vendored copy of `packaging` saves us another dependency.
+from pip._vendor.packaging.specifiers import InvalidSpecifier, SpecifierSet
+from pip._vendor.packaging.tags import (
+    Tag,
+    compatible_tags,
+    cpython_tags,
+    generic_tags,
+    interpreter_name,
+    sys_tags,
+)
+from pip._vendor.packaging.utils import (
+    InvalidSdistFilename,
+    InvalidWheelFilename,
+    canonicalize_name,
+    parse_sdist_filename,
+    parse_wheel_filename,
+)
+from pip._vendor.packaging.version import InvalidVersion, Version
+
+_ANCHOR = re.compile(r"<a\b([^>]*)>(.*?)</a\s*>", re.IGNORECASE | re.DOTALL)
+_ATTRIBUTE = re.compile(r"([\w-]+)\s*=\s*(?:\"([^\"]*)\"|'([^']*)')", re.DOTALL)
+
+
+class SimpleFile(NamedTuple):
+    "A file listed on a simple page."
+
+    filename: str
+    url: str
+    hashes: Dict[str, str]
+    requires_python: Union[str, None] = None
+    yanked: bool = False
+    # Is the core metadata available at `{url}.metadata`? (PEP 658/714)
+    has_metadata: bool = False
+    # Size in bytes, only listed on json pages. (PEP 700)
+    size: Union[int, None] = None
+
+
+class FilenameInfo(NamedTuple):
+    "Project name, version and (for wheels) compatibility tags parsed from a file name."
+
+    name: str
+    version: str
+    tags: Union[Tuple[Tag, ...], None]  # None for source distributions
+
+
+def parse_page(
+    content: Union[str, bytes],
+    content_type: str,
+    page_url: str = "",
+    anchors: Union[Dict[str, Union[SimpleFile, None]], None] = None,
+) -> List[SimpleFile]:
+    """Parse the files listed on a simple page. Urls are made absolute with respect to `page_url`.
+
+    For html pages `anchors` memoizes the parsing (anchor -> file) for the same page url: the
+    anchors in it are not parsed again and new ones are added to it."""
+    if "json" in content_type:
+        return _parse_json_page(content, page_url)
+    if isinstance(content, bytes):
+        content = content.decode("utf-8", errors="replace")
+    return _parse_html_page(content, page_url, {} if anchors is None else anchors)
+
+
+def _parse_html_page(
+    content: str, page_url: str, anchors: Dict[str, Union[SimpleFile, None]]
+) -> List[SimpleFile]:
+    files = []
+    for match in _ANCHOR.finditer(content):
+        anchor = match.group(0)
+        if anchor not in anchors:
+            anchors[anchor] = _parse_anchor(match, page_url)
+        file = anchors[anchor]
+        if file is not None:
+            files.append(file)
+    return files
+
+
+def _parse_anchor(match: re.Match, page_url: str) -> Union[SimpleFile, None]:
+    "The file of an anchor of an html page. None if it has no href."
+    attrs = {
+        m.group(1).lower(): html.unescape(m.group(2) if m.group(2) is not None else m.group(3))
+        for m in _ATTRIBUTE.finditer(match.group(1))
+    }
+    if "href" not in attrs:
+        return None
+    url, _, fragment = urljoin(page_url, attrs["href"]).partition("#")
+    hashes = {}
+    if "=" in fragment:
+        algo, _, value = fragment.partition("=")
+        hashes[algo] = value
+    metadata = attrs.get("data-core-metadata", attrs.get("data-dist-info-metadata"))
+    return SimpleFile(
+        filename=html.unescape(match.group(2)).strip(),
+        url=url,
+        hashes=hashes,
+        requires_python=attrs.get("data-requires-python"),
+        yanked="data-yanked" in attrs,
+        has_metadata=metadata is not None and metadata != "false",
+    )
+
+
+def _parse_json_page(content: Union[str, bytes], page_url: str) -> List[SimpleFile]:
+    page = json.loads(content)
+    files = []
+    for file in page.get("files", []):
+        metadata = file.get("core-metadata", file.get("dist-info-metadata", False))
+        files.append(
+            SimpleFile(
+                filename=file["filename"],
+                url=urljoin(page_url, file["url"]),
+                hashes=file.get("hashes", {}),
+                requires_python=file.get("requires-python"),
+                yanked=bool(file.get("yanked", False)),
+                has_metadata=bool(metadata),
+                size=file.get("size"),
+            )
+        )
+    return files
+
+
+@lru_cache(maxsize=2**16)
+def parse_filename(filename: str) -> Union[FilenameInfo, None]:
+    "Parse a wheel or sdist file name. None if it is neither."
+    try:
+        if filename.endswith(".whl"):
+            name, version, _, tags = parse_wheel_filename(filename)
+            return FilenameInfo(name=name, version=str(version), tags=tuple(tags))
+        name, version = parse_sdist_filename(filename)
+        return FilenameInfo(name=name, version=str(version), tags=None)
+    except (InvalidWheelFilename, InvalidSdistFilename, InvalidVersion):
+        return None
+
+
+def same_version(a: str, b: str) -> bool:
+    "Compare versions as per PEP 440. (1.0 == 1.0.0)"
+    try:
+        return Version(a) == Version(b)
+    except InvalidVersion:
+        return a == b
+
+
+def normalize_name(name: str) -> str:
+    "Normalized project name as used in the simple page urls. (PEP 503)"
+    return canonicalize_name(name)
+
+
+class FileSelector(NamedTuple):
+    """Selection of the files on a simple page that can be installed in a target environment.
+
+    Selecting is a pre-filter for the resolver: files that might be installable are kept. Source
+    distributions and files of unknown type are kept if their Requires-Python allows it.
+
+    Arguments:
+    ----------
+    python: str | None
+        Python version of the target (eg. 3.11 or 3.11.4). Wheels must be built for it (or be
+        pure python) and Requires-Python must allow it.
+    platforms: tuple[str, ...]
+        Platform tags (eg. manylinux_2_17_x86_64) of which a wheel must have one, or `any`.
+        Shell-style wildcards are allowed (eg. manylinux*_x86_64). Empty for any platform.
+    implementation: str
+        Python implementation of the target as abbreviated in wheel tags. (Default: cp)
+    """
+
+    python: Union[str, None] = None
+    platforms: Tuple[str, ...] = ()
+    implementation: str = "cp"
+
+    @classmethod
+    def from_query(cls, query: str) -> Union["FileSelector", None]:
+        """Parse a query string (python=3.11&platform=...). None if it selects nothing.
+
+        Raises a ValueError for an invalid python version."""
+        params = parse_qs(query)
+        python = params.get("python", [None])[0]
+        platforms = tuple(params.get("platform", []))
+        if not python and not platforms:
+            return None
+        if python and not re.fullmatch(r"\d+\.\d+(\.\d+)?", python):
+            raise ValueError(f"Invalid python version: {python}")
+        return cls(python, platforms, params.get("implementation", ["cp"])[0])
+
+    @classmethod
+    def for_interpreter(cls) -> "FileSelector":
+        "Selector of the running interpreter. Its platform tags are generalized to wildcards."
+        platforms = sorted({_generalize_platform(t.platform) for t in sys_tags()} - {"any"})
+        # Without a pre-release suffix (eg. of 3.14.0rc2), as in the versions of wheel tags.
+        python = "%d.%d.%d" % sys.version_info[:3]
+        return cls(python, tuple(platforms), interpreter_name())
+
+    def to_query(self) -> str:
+        params = [("python", self.python)] if self.python else []
+        params += [("platform", p) for p in self.platforms]
+        if self.implementation != "cp":
+            params.append(("implementation", self.implementation))
+        return urlencode(params)
+
+    def selects(self, filename: str, requires_python: Union[str, None] = None) -> bool:
+        "Is the file possibly installable in the target environment?"
+        if self.python and requires_python and not _allows(requires_python, self.python):
+            return False
+        info = parse_filename(filename)
+        if info is None or info.tags is None:
+            return True
+        supported = _supported_pairs(self.python, self.implementation) if self.python else None
+        return any(
+            (supported is None or (tag.interpreter, tag.abi) in supported)
+            and (
+                not self.platforms
+                or tag.platform == "any"
+                or any(fnmatchcase(tag.platform, p) for p in self.platforms)
+            )
+            for tag in info.tags
+        )
+
+
+def select_files(
+    content: str,
+    content_type: str,
+    selector: FileSelector,
+    anchors: Union[Dict[str, Union[SimpleFile, None]], None] = None,
+) -> str:
+    """Remove the files not selected from a simple page. Links other than files are kept.
+
+    For html pages `anchors` memoizes the parsing as for `parse_page`."""
+    if "json" in content_type:
+        page = json.loads(content)
+        if not isinstance(page, dict) or not isinstance(page.get("files"), list):
+            return content
+        page["files"] = [
+            f
+            for f in page["files"]
+            if not isinstance(f, dict)
+            or selector.selects(f.get("filename", ""), f.get("requires-python"))
+        ]
+        return json.dumps(page)
+
+    anchors = {} if anchors is None else anchors
+
+    def select(match: re.Match) -> str:
+        anchor = match.group(0)
+        if anchor not in anchors:
+            anchors[anchor] = _parse_anchor(match, "")
+        file = anchors[anchor]
+        if file is None or selector.selects(file.filename, file.requires_python):
+            return anchor
+        return ""
+
+    return _ANCHOR.sub(select, content)
+
+
+def _generalize_platform(platform_tag: str) -> str:
+    "Wildcard for the versions of a platform tag. Eg. manylinux_2_17_x86_64 -> manylinux*_x86_64"
+    return re.sub(r"^(manylinux|musllinux|macosx)_?\d+(_\d+)*_", r"\1*_", platform_tag)
+
+
+@lru_cache(maxsize=1024)
+def _allows(requires_python: str, python: str) -> bool:
+    try:
+        return SpecifierSet(requires_python).contains(python, prereleases=True)
+    except (InvalidSpecifier, InvalidVersion):
+        return True
+
+
+@lru_cache(maxsize=64)
+def _supported_pairs(python: str, implementation: str) -> FrozenSet[Tuple[str, str]]:
+    "The (interpreter, abi) pairs of the wheel tags supported by a python version."
+    major, minor = (int(part) for part in python.split(".")[:2])
+    version = (major, minor)
+    interpreter = f"{implementation}{version[0]}{version[1]}"
+    if implementation == "cp":
+        tags = list(cpython_tags(version, platforms=["-"]))
+    else:
+        tags = list(generic_tags(interpreter, ["none"], platforms=["-"]))
+    tags += compatible_tags(version, interpreter, platforms=["-"])
+    return frozenset((tag.interpreter, tag.abi) for tag in tags)
@@ -0,0 +1,352 @@
+"""Speculative prefetching of the dependencies of the distributions the proxy serves.
+
+pip resolves one step at a time: it fetches the metadata of a distribution (its PEP 658 `.metadata`
+file, or the wheel itself), reads the dependencies, requests their pages, picks a version, fetches
+its metadata and so on. These round trips through the proxy to the indexes add up. While the proxy
+serves metadata or a wheel, the speculator reads its dependencies (`Requires-Dist`) and prefetches
+in the background:
+
+- the pages of the dependencies,
+- the metadata of the file pip most likely picks next: the best matching file (for the interpreter
+  of the proxy) of the latest version the requirement allows. Served in turn through the proxy,
+  the dependencies of the dependencies are prefetched too.
+- with `files`, that file itself. It ends up in the store of the proxy.
+
+The prefetches are requests to the proxy itself: they are authenticated, rewritten, stored and
+coalesced like any other request. A request of pip for a page being prefetched joins the prefetch.
+Prefetched pages are requested with the Accept headers of the last page request of the client,
+such that they match its next ones. The prefetched pages and metadata are held in memory for
+`max_age` seconds, to answer the first request for them.
+
+It is a best effort to be ahead of the resolver: markers are evaluated for the interpreter of the
+proxy (without extras) and pip may well pick another version.
+"""
+
+from collections import OrderedDict
+import email.parser
+import io
+import logging
+import math
+import platform
+from queue import Queue
+from threading import Lock, Thread
+import time
+from typing import Callable, Dict, List, Mapping, NamedTuple, Tuple, Union
+from urllib.parse import quote, unquote, urlparse
+import zipfile
+
+import urllib3
+from pip._vendor.packaging.requirements import Requirement
+from pip._vendor.packaging.specifiers import SpecifierSet
+from pip._vendor.packaging.tags import sys_tags
+from pip._vendor.packaging.utils import canonicalize_name
+from pip._vendor.packaging.version import InvalidVersion, Version
+
+from .encoding import decompress
+from .links import is_files_path
+from .simple import FileSelector, SimpleFile, parse_filename, parse_page
+from .upstream import DEFAULT_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# Request headers of pip, used for the prefetches before any request of the client was seen.
+DEFAULT_PAGE_HEADERS = {
+    "Accept": "application/vnd.pypi.simple.v1+json, application/vnd.pypi.simple.v1+html; q=0.1, "
+    "text/html; q=0.01"
+}
+DEFAULT_FILE_HEADERS = {"Accept": "*/*", "Accept-Encoding": "identity"}
+# Headers of the response of the proxy not to be served again.
+_RESPONSE_HEADERS = frozenset(("server", "date", "connection", "keep-alive", "transfer-encoding"))
+
+
+class Prefetched(NamedTuple):
+    "A response prefetched from the proxy."
+
+    headers: Mapping[str, str]
+    content: bytes
+    fetched_at: float
+
+
+# (path, Accept header, Accept-Encoding header) The headers are empty for files.
+HeldKey = Tuple[str, str, str]
+
+
+class Speculator:
+    """Prefetches the dependencies of the distributions served by the proxy, see the module.
+
+    Arguments:
+    ----------
+    files: bool
+        Also download the best matching files of the dependencies. (Only of use with a store.)
+    jobs: int
+        Number of concurrent prefetches.
+    """
+
+    # Seconds a prefetched response is held, and a project is not prefetched again.
+    max_age = 60.0
+    # Bytes of prefetched responses held, the oldest are dropped first.
+    max_size = 32 * 2**20
+    # Larger wheels are not inspected for their dependencies.
+    max_wheel_size = 64 * 2**20
+    # Nor larger metadata files. (Streamed ones are held in memory until complete.)
+    max_metadata_size = 2**20
+
+    def __init__(self, files: bool = False, jobs: int = 8) -> None:
+        self.files = files
+        self.jobs = jobs
+        self.base_url = ""
+        self._selector = FileSelector(python=platform.python_version())
+        self._ranking = {tag: i for i, tag in enumerate(sys_tags())}
+        self._reset()
+
+    def _reset(self) -> None:
+        self._lock = Lock()
+        self._queue: "Queue[Tuple[Callable[..., None], tuple]]" = Queue()
+        self._workers: List[Thread] = []
+        self._http = urllib3.PoolManager(maxsize=self.jobs)
+        self._stopped = False
+        self._page_headers: Dict[str, str] = dict(DEFAULT_PAGE_HEADERS)
+        self._file_headers: Dict[str, str] = dict(DEFAULT_FILE_HEADERS)
+        # Project -> time its prefetch started.
+        self._seen: Dict[str, float] = {}
+        self._held: "OrderedDict[HeldKey, Prefetched]" = OrderedDict()
+        self._size = 0
+        self.counts = {"prefetched": 0, "failed": 0, "hits": 0, "unused": 0}
+
+    def start(self, base_url: str) -> None:
+        "Prefetch from the proxy at `base_url`."
+        self.base_url = base_url.rstrip("/")
+        self._stopped = False
+
+    def stop(self) -> None:
+        "Stop prefetching. Queued prefetches are dropped, those in flight finish."
+        self._stopped = True
+
+    def reset_after_fork(self) -> None:
+        "Start over in a forked worker: the threads and connections of the parent are not shared."
+        base_url = self.base_url
+        self._reset()
+        self.start(base_url)
+
+    def note_request(self, path: str, headers: Mapping[str, str]) -> None:
+        """Take the Accept headers of a request of the client for the prefetches (of pages or
+        files), such that those are the same requests as the next ones of the client."""
+        accept = {k: headers[k] for k in ("Accept", "Accept-Encoding") if headers.get(k)}
+        if not accept:
+            return
+        if is_files_path(path):
+            self._file_headers = accept
+        else:
+            self._page_headers = accept
+
+    def observe(self, prefix: str, path: str, load: Callable[[], Union[bytes, None]]) -> None:
+        """Prefetch the dependencies of the distribution served at `path`, its metadata or wheel
+        as returned by `load`. Pages are prefetched under the `prefix` of the path (the selection
+        of files)."""
+        if not self._stopped and self.base_url:
+            self._submit(self._prefetch_dependencies, prefix, path, load)
+
+    def take(self, path: str, headers: Mapping[str, str]) -> Union[Prefetched, None]:
+        "The prefetched response for a request. None if there is none (anymore)."
+        with self._lock:
+            held = self._held.pop(self._key(path, headers), None)
+            if held is None:
+                return None
+            self._size -= len(held.content)
+            if time.monotonic() - held.fetched_at > self.max_age:
+                self.counts["unused"] += 1
+                return None
+            self.counts["hits"] += 1
+            return held
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts, held=len(self._held), size=self._size)
+
+    def _key(self, path: str, headers: Mapping[str, str]) -> HeldKey:
+        if is_files_path(path):
+            return (client_path(path), "", "")
+        return (path, headers.get("Accept", ""), headers.get("Accept-Encoding", ""))
+
+    def _submit(self, func: Callable[..., None], *args) -> None:
+        with self._lock:
+            if len(self._workers) < self.jobs:
+                worker = Thread(target=self._work, name="speculate", daemon=True)
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put((func, args))
+
+    def _work(self) -> None:
+        while True:
+            func, args = self._queue.get()
+            if self._stopped:
+                continue
+            try:
+                func(*args)
+            except Exception as e:
+                logger.debug(f"Speculative prefetch failed: {e}")
+                with self._lock:
+                    self.counts["failed"] += 1
+
+    def _prefetch_dependencies(
+        self, prefix: str, path: str, load: Callable[[], Union[bytes, None]]
+    ) -> None:
+        content = load()
+        if not content:
+            return
+        metadata = content if path.endswith(".metadata") else wheel_metadata(content)
+        if not metadata:
+            return
+        now = time.monotonic()
+        for requirement in requires_dist(metadata):
+            name = canonicalize_name(requirement.name)
+            with self._lock:
+                if now - self._seen.get(name, -math.inf) < self.max_age:
+                    continue
+                self._seen[name] = now
+            self._submit(self._prefetch_project, prefix, name, requirement.specifier)
+
+    def _prefetch_project(self, prefix: str, name: str, specifier: SpecifierSet) -> None:
+        page_headers = self._page_headers
+        page = self._fetch(f"{prefix}/{name}/", page_headers)
+        if page is None:
+            return
+        content = page.content
+        encoding = page.headers.get("Content-Encoding")
+        if encoding:
+            content = decompress(content, encoding)
+        page_url = f"{self.base_url}{prefix}/{name}/"
+        files = parse_page(content, page.headers.get("Content-Type", ""), page_url)
+        file = best_file(files, specifier, self._ranking, self._selector)
+        if file is None:
+            return
+        # Fetched through the proxy, the dependencies of the file are prefetched in turn.
+        path = client_path(urlparse(file.url).path)
+        if file.has_metadata:
+            self._fetch(path + ".metadata", self._file_headers)
+        if self.files:
+            self._fetch(path, self._file_headers, hold=False)
+
+    def _fetch(
+        self, path: str, headers: Dict[str, str], hold: bool = True
+    ) -> Union[Prefetched, None]:
+        "Fetch a path from the proxy. Successful responses are held (if `hold`). None on failure."
+        resp = self._http.request(
+            "GET",
+            self.base_url + path,
+            headers=headers,
+            preload_content=False,
+            decode_content=False,
+            timeout=DEFAULT_TIMEOUT,
+            retries=False,
+        )
+        ok = resp.status == 200
+        with self._lock:
+            self.counts["prefetched" if ok else "failed"] += 1
+        if not ok or not hold:
+            resp.drain_conn()
+            return None
+        content = resp.read(decode_content=False)
+        resp.release_conn()
+        prefetched = Prefetched(
+            headers={k: v for k, v in resp.headers.items() if k.lower() not in _RESPONSE_HEADERS},
+            content=content,
+            fetched_at=time.monotonic(),
+        )
+        with self._lock:
+            key = self._key(path, headers)
+            old = self._held.pop(key, None)
+            if old is not None:
+                self._size -= len(old.content)
+            self._held[key] = prefetched
+            self._size += len(content)
+            while self._size > self.max_size and self._held:
+                _, dropped = self._held.popitem(last=False)
+                self._size -= len(dropped.content)
+                self.counts["unused"] += 1
+        return prefetched
+
+
+def client_path(path: str) -> str:
+    """The path of a file as pip requests it: quoted. Eg. the host and port of the original url
+    in it (`127.0.0.1%3A8080`)."""
+    return quote(unquote(path), safe="/@")
+
+
+def wheel_metadata(content: bytes) -> Union[bytes, None]:
+    "The core metadata (METADATA of the .dist-info directory) of a wheel. None if not found."
+    try:
+        with zipfile.ZipFile(io.BytesIO(content)) as wheel:
+            for name in wheel.namelist():
+                directory, _, filename = name.partition("/")
+                if directory.endswith(".dist-info") and filename == "METADATA":
+                    return wheel.read(name)
+    except (zipfile.BadZipFile, OSError):
+        pass
+    return None
+
+
+def requires_dist(metadata: bytes) -> List[Requirement]:
+    """The requirements (Requires-Dist) in core metadata that apply to this interpreter, without
+    extras. Invalid requirements are left out."""
+    headers = email.parser.BytesHeaderParser().parsebytes(metadata)
+    requirements = []
+    for value in headers.get_all("Requires-Dist") or []:
+        try:
+            requirement = Requirement(value)
+            if requirement.marker and not requirement.marker.evaluate({"extra": ""}):
+                continue
+        except Exception:
+            # Invalid requirement or marker.
+            continue
+        requirements.append(requirement)
+    return requirements
+
+
+def best_file(
+    files: List[SimpleFile],
+    specifier: SpecifierSet,
+    ranking: Mapping,
+    selector: FileSelector,
+) -> Union[SimpleFile, None]:
+    """The file pip most likely picks: of the latest version the specifier allows (and that has a
+    file for this interpreter) the best ranked wheel (by tag), or else a source distribution. None
+    if there is none.
+
+    Arguments:
+    ----------
+    files: List[SimpleFile]
+        Files on the page of the project.
+    specifier: SpecifierSet
+        The version specifier of the requirement. (Pre-releases only if it names one)
+    ranking: Mapping[Tag, int]
+        Rank of the supported tags, lower is better.
+    selector: FileSelector
+        Files it does not select (eg. by Requires-Python) are left out.
+    """
+    by_version: Dict[Version, List[SimpleFile]] = {}
+    for file in files:
+        info = parse_filename(file.filename)
+        if info is None or file.yanked or not selector.selects(file.filename, file.requires_python):
+            continue
+        try:
+            version = Version(info.version)
+        except InvalidVersion:
+            continue
+        if specifier.contains(version):
+            by_version.setdefault(version, []).append(file)
+
+    for version in sorted(by_version, reverse=True):
+        best, best_rank = None, math.inf
+        sdist = None
+        for file in by_version[version]:
+            tags = parse_filename(file.filename).tags  # type: ignore
+            if tags is None:
+                sdist = sdist or file
+                continue
+            rank = min(ranking.get(tag, math.inf) for tag in tags)
+            if rank < best_rank:
+                best, best_rank = file, rank
+        if best or sdist:
+            return best or sdist
+    return None
@@ -0,0 +1,263 @@
+from datetime import datetime
+from hashlib import sha256
+import json
+import os
+import sqlite3
+import tempfile
+import time
+from typing import BinaryIO, Dict, NamedTuple, Tuple, Union
+
+from .cache import TokenCache
+from .db import MetadataStore
+
+# Hop-by-hop headers and headers recomputed on serving are not stored.
+_UNSTORED_HEADERS = {"connection", "keep-alive", "transfer-encoding", "content-length", "date"}
+
+# Bytes the bodies in the store may take, unless set with CRANE_STORE_MAX_SIZE (in GiB).
+DEFAULT_MAX_SIZE = 5 * 2**30
+# The time an entry was last used is only updated when older than this many seconds. (Spares a
+# write to the database on every read.)
+_USED_AT_RESOLUTION = 60.0
+# Entries selected at a time for eviction.
+_EVICT_BATCH = 32
+
+
+def default_max_size() -> int:
+    "Maximum size of the store: CRANE_STORE_MAX_SIZE (GiB, 0 for no limit) or the default."
+    configured = os.environ.get("CRANE_STORE_MAX_SIZE")
+    return int(float(configured) * 2**30) if configured else DEFAULT_MAX_SIZE
+
+
+class StoredResponse(NamedTuple):
+    "A response as stored in the last-known-good store."
+
+    path: str
+    headers: Dict[str, str]
+    content: bytes
+    stored_at: datetime
+
+
+class LastKnownGoodStore:
+    """On-disk store of the last successful (200) responses of the proxy.
+
+    Both simple pages (as served, so with rewritten links) and files are stored, keyed on a path
+    given by the proxy: that of the file, or of the page prefixed with the indexes. Simple pages
+    can be served as html or json, so they are stored per variant. The store lets the proxy
+    answer requests when the upstream indexes (or the identity provider) are unreachable.
+
+    Every entry consists of a body file, written atomically (write to temp file + rename), and a
+    row with the metadata in the metadata database of the store. The row is written after the body
+    and marks the entry as complete, so concurrent proxies can share the store.
+
+    The bodies take at most `max_size` bytes (0 for no limit, by default see `default_max_size`):
+    when more is stored the least recently used entries are evicted. Their total is loaded once
+    and kept up to date, it is only loaded again after other processes changed the store.
+    """
+
+    store_dir = os.path.join(TokenCache.cache_dir, "store")
+
+    def __init__(
+        self, store_dir: Union[str, None] = None, max_size: Union[int, None] = None
+    ) -> None:
+        if store_dir:
+            self.store_dir = store_dir
+        self.max_size = default_max_size() if max_size is None else max_size
+        os.makedirs(self.store_dir, exist_ok=True)
+        self.db = MetadataStore(os.path.join(self.store_dir, "metadata.db"))
+        # Running total of the sizes and the version of the database it is of.
+        self._size: Union[int, None] = None
+        self._size_version: Union[Tuple[int, int], None] = None
+        self._add_missing_sizes()
+
+    def _add_missing_sizes(self) -> None:
+        "Sizes of the entries stored by older versions, which did not record them."
+        rows = self.db.execute("SELECT path, variant FROM responses WHERE size = 0")
+        for path, variant in rows:
+            try:
+                size = os.path.getsize(self._entry_path(path, variant))
+            except OSError:
+                continue
+            if size:
+                self.db.execute(
+                    "UPDATE responses SET size = ? WHERE path = ? AND variant = ?",
+                    (size, path, variant),
+                )
+
+    def _entry_path(self, path: str, variant: str) -> str:
+        key = sha256(f"{variant}:{path}".encode()).hexdigest()
+        return os.path.join(self.store_dir, key[:2], key)
+
+    def put(self, path: str, headers: Dict[str, str], content: bytes, variant: str = "") -> None:
+        "Store the content and headers of a successful response for the path (and variant)."
+        writer = self.writer(path, headers, variant)
+        try:
+            writer.write(content)
+            writer.commit()
+        finally:
+            writer.close()
+
+    def writer(self, path: str, headers: Dict[str, str], variant: str = "") -> "StoreWriter":
+        "Store a response of which the body is written as it streams by. See `StoreWriter`."
+        return StoreWriter(self, path, headers, variant)
+
+    def _add_entry(self, path: str, headers: Dict[str, str], variant: str, size: int) -> None:
+        headers = {k: v for k, v in headers.items() if k.lower() not in _UNSTORED_HEADERS}
+        with self.db.transaction(immediate=True) as conn:
+            replaced = self._stored_size(conn, path, variant)
+            conn.execute(
+                "INSERT OR REPLACE INTO responses"
+                " (path, variant, headers, stored_at, size, used_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (path, variant, json.dumps(headers), datetime.now().isoformat(), size, time.time()),
+            )
+            self._add_size(size - replaced)
+        if self.max_size:
+            self.evict(self.max_size)
+
+    @staticmethod
+    def _stored_size(conn: sqlite3.Connection, path: str, variant: str) -> int:
+        row = conn.execute(
+            "SELECT size FROM responses WHERE path = ? AND variant = ?", (path, variant)
+        ).fetchone()
+        return row[0] if row else 0
+
+    def _add_size(self, delta: int) -> None:
+        # Only called within a transaction, which holds the lock of the database. A total of an
+        # older version is loaded again anyway.
+        if self._size is not None:
+            self._size += delta
+
+    def size(self) -> int:
+        "Bytes taken by the bodies in the store."
+        with self.db.transaction() as conn:
+            # The data version is per connection, and forked processes connect anew.
+            version = (os.getpid(), conn.execute("PRAGMA data_version").fetchone()[0])
+            if self._size is None or version != self._size_version:
+                self._size = conn.execute(
+                    "SELECT COALESCE(SUM(size), 0) FROM responses"
+                ).fetchone()[0]
+                self._size_version = version
+            return self._size
+
+    def evict(self, max_size: int) -> int:
+        """Remove the least recently used entries until the bodies take at most `max_size` bytes.
+        Returns the number of entries removed."""
+        excess = self.size() - max_size
+        removed = 0
+        while excess > 0:
+            rows = self.db.execute(
+                "SELECT path, variant, size FROM responses ORDER BY used_at LIMIT ?",
+                (_EVICT_BATCH,),
+            )
+            if not rows:
+                break
+            for path, variant, size in rows:
+                if excess <= 0:
+                    break
+                # Bodies opened meanwhile can still be read to the end. (Not on Windows, where the
+                # removal fails and the entry is left for a next eviction.)
+                self.remove(path, variant)
+                excess -= size
+                removed += 1
+        return removed
+
+    def _touch(self, path: str, variant: str) -> None:
+        now = time.time()
+        self.db.execute(
+            "UPDATE responses SET used_at = ? WHERE path = ? AND variant = ? AND used_at < ?",
+            (now, path, variant, now - _USED_AT_RESOLUTION),
+        )
+
+    def has(self, path: str, variant: str = "") -> bool:
+        "Is there a stored response for the path (and variant)?"
+        return bool(
+            self.db.execute(
+                "SELECT 1 FROM responses WHERE path = ? AND variant = ?", (path, variant)
+            )
+        )
+
+    def remove(self, path: str, variant: str = "") -> None:
+        "Remove the stored response of the path (and variant) if present."
+        with self.db.transaction(immediate=True) as conn:
+            removed = self._stored_size(conn, path, variant)
+            conn.execute("DELETE FROM responses WHERE path = ? AND variant = ?", (path, variant))
+            self._add_size(-removed)
+        try:
+            os.unlink(self._entry_path(path, variant))
+        except OSError:
+            pass
+
+    def get(self, path: str, variant: str = "") -> Union[StoredResponse, None]:
+        "Get the stored response of the path (and variant). None if not stored."
+        rows = self.db.execute(
+            "SELECT headers, stored_at FROM responses WHERE path = ? AND variant = ?",
+            (path, variant),
+        )
+        if not rows:
+            return None
+        try:
+            with open(self._entry_path(path, variant), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        headers, stored_at = rows[0]
+        self._touch(path, variant)
+        return StoredResponse(
+            path=path,
+            headers=json.loads(headers),
+            content=content,
+            stored_at=datetime.fromisoformat(stored_at),
+        )
+
+    def open(self, path: str, variant: str = "") -> Union[Tuple[Dict[str, str], BinaryIO], None]:
+        """Open the body of the stored response for reading, eg. to send it with sendfile.
+
+        Returns the stored headers and the opened body file. None if not stored."""
+        rows = self.db.execute(
+            "SELECT headers FROM responses WHERE path = ? AND variant = ?", (path, variant)
+        )
+        if not rows:
+            return None
+        try:
+            body = open(self._entry_path(path, variant), "rb")
+        except OSError:
+            return None
+        self._touch(path, variant)
+        return json.loads(rows[0][0]), body
+
+
+class StoreWriter:
+    """Writes the body of a response to a temporary file in the store, as it streams by. `commit`
+    renames it into place and adds the entry, `close` discards a body that was not committed (eg.
+    the upstream response broke off). Only a chunk at a time is held in memory.
+    """
+
+    def __init__(
+        self, store: LastKnownGoodStore, path: str, headers: Dict[str, str], variant: str = ""
+    ) -> None:
+        self.store, self.path, self.headers, self.variant = store, path, headers, variant
+        self._entry = store._entry_path(path, variant)
+        os.makedirs(os.path.dirname(self._entry), exist_ok=True)
+        fd, self._tmp = tempfile.mkstemp(dir=os.path.dirname(self._entry), prefix=".tmp-")
+        self._file = os.fdopen(fd, "wb")
+        self.size = 0
+        self.committed = False
+
+    def write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def commit(self) -> None:
+        "Add the entry with the body written so far."
+        self._file.close()
+        os.replace(self._tmp, self._entry)
+        self.committed = True
+        # Body first: the metadata marks the entry as complete.
+        self.store._add_entry(self.path, self.headers, self.variant, self.size)
+
+    def close(self) -> None:
+        if not self.committed:
+            self._file.close()
+            try:
+                os.unlink(self._tmp)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,430 @@
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import asdict, dataclass
+from threading import Lock
+from typing import Any, Dict, List, NamedTuple, Sequence, Tuple, Union
+from urllib.parse import urljoin, urlparse
+import logging
+import time
+
+import urllib3
+
+from .http2 import Http2Pool, h2_installed
+
+logger = logging.getLogger(__name__)
+
+# Canonical PyPI simple index. (pypi.python.org only redirects to this one.)
+DEFAULT_PYPI_URL = "https://pypi.org/simple"
+
+REDIRECT_STATUSES = {301, 302, 303, 307, 308}
+PERMANENT_REDIRECT_STATUSES = {301, 308}
+# Server side failures after which another mirror is tried.
+FAILOVER_STATUSES = {500, 502, 503, 504}
+
+# Time to wait for a connection and between bytes received. Can be configured per index.
+DEFAULT_TIMEOUT = urllib3.Timeout(connect=10.0, read=60.0)
+# Connection errors are retried once, read errors (eg. timeouts) are raised directly: the failover
+# logic decides what is tried next, not a retry on the same hung upstream.
+RETRIES = urllib3.Retry(total=1, read=False, redirect=False)
+
+
+class UpstreamError(Exception):
+    "None of the upstream urls could be reached."
+
+    pass
+
+
+class CircuitOpen(UpstreamError):
+    "The upstream urls are skipped (circuit breaker open) after repeated failures."
+
+    pass
+
+
+@dataclass
+class MirrorHealth:
+    "Health statistics of a single upstream (mirror) base url."
+
+    # Exponentially weighted moving average of the response latency in seconds.
+    latency: Union[float, None] = None
+    consecutive_failures: int = 0
+    # Monotonic timestamp until which the upstream is considered unhealthy.
+    unhealthy_until: float = 0.0
+    # A probe request of a half-open circuit is in flight.
+    probing: bool = False
+    # Counters, as reported in the stats.
+    requests: int = 0
+    failures: int = 0
+    timeouts: int = 0
+    skipped: int = 0
+    # Requests hedged to this upstream, and how many of those responded first.
+    hedged: int = 0
+    hedge_wins: int = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.unhealthy_until <= now
+
+    def circuit(self, now: float, failure_threshold: int) -> str:
+        "State of the circuit breaker: closed, open or half-open."
+        if self.consecutive_failures < failure_threshold:
+            return "closed"
+        return "open" if self.unhealthy_until > now else "half-open"
+
+
+class Attempt(NamedTuple):
+    "Outcome of a request to one upstream: either a response or an error."
+
+    base_url: str
+    resp: Union[urllib3.BaseHTTPResponse, None] = None
+    error: Union[Exception, None] = None
+
+    def succeeded(self) -> bool:
+        return self.resp is not None and self.resp.status not in FAILOVER_STATUSES
+
+
+class UpstreamPool:
+    """Pooled connections to the upstream indexes with redirect caching and mirror failover.
+
+    Redirects are followed by the pool itself. Permanent redirects (301/308) are cached so that
+    later requests go straight to the final location, eg. a fallback configured as
+    `https://pypi.python.org/simple` gets rewritten to `https://pypi.org/simple` after the first
+    request. Temporary redirects are cached for `redirect_ttl` seconds.
+
+    When a request is made with several candidate mirrors, the healthy mirror with the lowest
+    (average) latency is tried first. A mirror failing with a connection error, a timeout or a 5xx
+    response is marked unhealthy for `unhealthy_backoff` seconds (doubling on consecutive
+    failures) and the next mirror is tried.
+
+    Circuit breaker: after `failure_threshold` consecutive failures an upstream is skipped
+    altogether while it is unhealthy (open circuit). Once the backoff passed, a single probe
+    request is let through (half-open): on success the circuit closes, on failure it opens again.
+
+    Hedging: with `hedge_after` set, a request that got no response within that many seconds is
+    also sent to the next mirror. The first successful response is used, the other is discarded.
+
+    HTTP/2: with `http2` set, https upstreams that support it are requested over HTTP/2, with the
+    concurrent requests to an upstream multiplexed over a single connection. (See `http2.py`, it
+    needs the optional `h2` package.) Other upstreams are requested over HTTP/1.1.
+    """
+
+    latency_weight = 0.3
+    unhealthy_backoff = 30.0
+    max_unhealthy_backoff = 600.0
+    failure_threshold = 3
+    redirect_ttl = 300.0
+    max_redirects = 5
+
+    def __init__(
+        self, maxsize: int = 10, hedge_after: Union[float, None] = None, http2: bool = False
+    ) -> None:
+        self.pool_manager = urllib3.PoolManager(maxsize=maxsize, retries=RETRIES)
+        self.http2_pool: Union[Http2Pool, None] = None
+        if http2 and not h2_installed():
+            logger.warning("HTTP/2 needs the h2 package (pip install h2), using HTTP/1.1.")
+        elif http2:
+            self.http2_pool = Http2Pool()
+        self.hedge_after = hedge_after
+        self._hedge_executor = None
+        if hedge_after is not None:
+            self._hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+        self._lock = Lock()
+        self._health: Dict[str, MirrorHealth] = {}
+        # Exact url -> (target url, expiry time or None)
+        self._redirects: Dict[str, Tuple[str, Union[float, None]]] = {}
+        # Prefix rewrites learned from permanent redirects: old prefix -> new prefix
+        self._prefix_redirects: Dict[str, str] = {}
+
+    def reset_after_fork(self) -> None:
+        """Drop the connections and threads inherited from the parent process. (Health and
+        redirects are kept.)"""
+        self.pool_manager.clear()
+        if self.http2_pool is not None:
+            self.http2_pool.clear()
+        if self.hedge_after is not None:
+            self._hedge_executor = ThreadPoolExecutor(thread_name_prefix="hedge")
+
+    def health(self, base_url: str) -> MirrorHealth:
+        with self._lock:
+            return self._health.setdefault(base_url, MirrorHealth())
+
+    def order(self, base_urls: Sequence[str]) -> List[str]:
+        "Order the mirrors: healthy ones first by latency, then unhealthy by recovery time."
+        now = time.monotonic()
+
+        def key(base_url: str):
+            h = self.health(base_url)
+            if h.is_healthy(now):
+                # Unknown latency gets probed first.
+                return (0, h.latency or 0.0)
+            return (1, h.unhealthy_until)
+
+        return sorted(base_urls, key=key)
+
+    def record_success(self, base_url: str, latency: float) -> None:
+        h = self.health(base_url)
+        with self._lock:
+            if h.latency is None:
+                h.latency = latency
+            else:
+                h.latency = self.latency_weight * latency + (1 - self.latency_weight) * h.latency
+            h.consecutive_failures = 0
+            h.unhealthy_until = 0.0
+            h.probing = False
+
+    def record_failure(self, base_url: str, timeout: bool = False) -> None:
+        h = self.health(base_url)
+        with self._lock:
+            h.failures += 1
+            h.timeouts += timeout
+            h.consecutive_failures += 1
+            backoff = self.unhealthy_backoff * 2 ** (h.consecutive_failures - 1)
+            h.unhealthy_until = time.monotonic() + min(backoff, self.max_unhealthy_backoff)
+            h.probing = False
+
+    def allow(self, base_url: str) -> bool:
+        "May a request be sent to the upstream? (Claims the probe of a half-open circuit.)"
+        h = self.health(base_url)
+        with self._lock:
+            state = h.circuit(time.monotonic(), self.failure_threshold)
+            if state == "open" or (state == "half-open" and h.probing):
+                h.skipped += 1
+                return False
+            if state == "half-open":
+                h.probing = True
+            return True
+
+    def release_probe(self, base_url: str) -> None:
+        "Give up the probe claimed by `allow`, however the request ended."
+        h = self.health(base_url)
+        with self._lock:
+            h.probing = False
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        "Health, circuit state and counters per upstream base url."
+        now = time.monotonic()
+        with self._lock:
+            return {
+                base_url: dict(
+                    asdict(h),
+                    circuit=h.circuit(now, self.failure_threshold),
+                    unhealthy_for=max(h.unhealthy_until - now, 0.0),
+                )
+                for base_url, h in self._health.items()
+            }
+
+    def resolve(self, url: str) -> str:
+        "Apply the cached redirects to the url."
+        with self._lock:
+            if url in self._redirects:
+                target, expires = self._redirects[url]
+                if expires is None or expires > time.monotonic():
+                    return target
+                del self._redirects[url]
+            for old, new in self._prefix_redirects.items():
+                if url.startswith(old) and url[len(old) : len(old) + 1] in ("/", ""):
+                    return new + url[len(old) :]
+        return url
+
+    def _cache_redirect(self, url: str, target: str, permanent: bool) -> None:
+        with self._lock:
+            if not permanent:
+                self._redirects[url] = (target, time.monotonic() + self.redirect_ttl)
+                return
+            self._redirects[url] = (target, None)
+            # If only the start of the url changed (eg. the host), then remember the rewrite of
+            # that prefix so other paths below it also skip the redirect.
+            common = 0
+            while common < min(len(url), len(target)) and url[-1 - common] == target[-1 - common]:
+                common += 1
+            slash = url[len(url) - common :].find("/")
+            if slash == -1:
+                return
+            kept = common - slash
+            old_prefix, new_prefix = url[: len(url) - kept], target[: len(target) - kept]
+            if "://" in old_prefix and old_prefix != new_prefix:
+                self._prefix_redirects[old_prefix] = new_prefix
+
+    def request(
+        self, method: str, url: str, headers: Dict[str, str], **kwargs
+    ) -> urllib3.BaseHTTPResponse:
+        """Perform a request, following (and caching) redirects.
+
+        The `url` attribute of the response is set to the final url after redirects."""
+        url = self.resolve(url)
+        for _ in range(self.max_redirects + 1):
+            resp = None
+            if self.http2_pool is not None:
+                resp = self.http2_pool.request(method, url, headers=headers, **kwargs)
+            if resp is None:
+                resp = self.pool_manager.request(
+                    method, url, headers=headers, redirect=False, **kwargs
+                )
+            location = resp.headers.get("Location")
+            if resp.status not in REDIRECT_STATUSES or not location:
+                resp.url = url
+                return resp
+            resp.drain_conn()
+            resp.release_conn()
+            target = urljoin(url, location)
+            logger.debug(f"Redirect {resp.status}: {url} -> {target}")
+            if urlparse(target).netloc != urlparse(url).netloc:
+                # Never leak credentials of one host to another.
+                headers = {k: v for k, v in headers.items() if k.lower() != "authorization"}
+            if method in ("GET", "HEAD"):
+                self._cache_redirect(
+                    url, target, permanent=resp.status in PERMANENT_REDIRECT_STATUSES
+                )
+            url = target
+        raise UpstreamError(f"Too many redirects for {url}")
+
+    def request_mirrors(
+        self, method: str, candidates: Sequence[Tuple[str, str]], headers: Dict[str, str], **kwargs
+    ) -> Tuple[str, urllib3.BaseHTTPResponse]:
+        """Request the resource from the first healthy mirror that responds.
+
+        Arguments:
+        ----------
+        candidates: Sequence[Tuple[str, str]]
+            Pairs of (mirror base url, url of the resource on that mirror).
+
+        Returns:
+        --------
+        The mirror base url used and the response.
+        """
+        urls = dict(candidates)
+        remaining = self.order(list(urls))
+        last_error: Union[Exception, None] = None
+        attempted = False
+        # Last server error response, passed on if no mirror does better.
+        failed: Union[Tuple[str, urllib3.BaseHTTPResponse], None] = None
+        while remaining:
+            base_url = remaining.pop(0)
+            if not self.allow(base_url):
+                logger.warning(f"Skipping unhealthy upstream {base_url}")
+                continue
+            attempted = True
+            if self.hedge_after is not None and remaining:
+                attempt = self._hedged_attempt(method, base_url, remaining, urls, headers, kwargs)
+            else:
+                attempt = self._attempt(method, base_url, urls[base_url], headers, kwargs)
+            if attempt.resp is None:
+                last_error = attempt.error
+                continue
+            if failed:
+                failed[1].drain_conn()
+                failed = None
+            if not attempt.succeeded() and remaining:
+                failed = (attempt.base_url, attempt.resp)
+                continue
+            return attempt.base_url, attempt.resp
+
+        if failed:
+            return failed
+        if not attempted:
+            raise CircuitOpen(f"Skipping unhealthy upstream: {', '.join(urls)}")
+        raise UpstreamError(f"No upstream could be reached: {last_error}") from last_error
+
+    def probe(self, base_url: str, headers: Dict[str, str], **kwargs) -> Attempt:
+        """HEAD request of the base url, recording its health and learning its redirects.
+
+        Leaves an open connection to the upstream in the pool."""
+        attempt = self._attempt("HEAD", base_url, base_url.rstrip("/") + "/", headers, kwargs)
+        if attempt.resp is not None:
+            attempt.resp.drain_conn()
+            attempt.resp.release_conn()
+        return attempt
+
+    def _attempt(
+        self, method: str, base_url: str, url: str, headers: Dict[str, str], kwargs: Dict
+    ) -> Attempt:
+        "Request the url of a mirror, recording its health."
+        with self._lock:
+            self._health.setdefault(base_url, MirrorHealth()).requests += 1
+        start = time.monotonic()
+        try:
+            resp = self.request(method, url, headers, **kwargs)
+            if resp.status in FAILOVER_STATUSES:
+                logger.warning(f"Upstream {base_url} responded with {resp.status}")
+                self.record_failure(base_url)
+            else:
+                self.record_success(base_url, time.monotonic() - start)
+        except urllib3.exceptions.HTTPError as e:
+            logger.warning(f"Upstream {base_url} failed: {e}")
+            self.record_failure(base_url, timeout=is_timeout(e))
+            return Attempt(base_url, error=e)
+        finally:
+            # Also on unexpected errors: a probe left claimed would keep the circuit half-open.
+            self.release_probe(base_url)
+        return Attempt(base_url, resp=resp)
+
+    def _hedged_attempt(
+        self,
+        method: str,
+        base_url: str,
+        remaining: List[str],
+        urls: Dict[str, str],
+        headers: Dict[str, str],
+        kwargs: Dict,
+    ) -> Attempt:
+        """Request the url of a mirror, hedging to the next mirror if it is slow to respond.
+
+        The mirror hedged to is taken from `remaining`. Returns the first successful attempt, or
+        if none, the last one to complete."""
+        assert self._hedge_executor is not None and self.hedge_after is not None
+        futures = {
+            self._hedge_executor.submit(
+                self._attempt, method, base_url, urls[base_url], headers, kwargs
+            )
+        }
+        done, _ = wait(futures, timeout=self.hedge_after)
+        if not done:
+            hedge_url = next((b for b in remaining if self.allow(b)), None)
+            if hedge_url is not None:
+                remaining.remove(hedge_url)
+                logger.debug(f"Hedging the request of {base_url} to {hedge_url}")
+                with self._lock:
+                    self._health.setdefault(hedge_url, MirrorHealth()).hedged += 1
+                try:
+                    hedge = self._hedge_executor.submit(
+                        self._attempt, method, hedge_url, urls[hedge_url], headers, kwargs
+                    )
+                except BaseException:
+                    self.release_probe(hedge_url)
+                    raise
+                futures.add(hedge)
+
+        pending = set(futures)
+        result: Union[Attempt, None] = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                attempt = future.result()
+                if result is None or (attempt.succeeded() and not result.succeeded()):
+                    if result is not None:
+                        _discard(result)
+                    result = attempt
+                else:
+                    _discard(attempt)
+            if result is not None and result.succeeded():
+                break
+        for future in pending:
+            # Responding after the winner: discarded once complete.
+            future.add_done_callback(lambda f: _discard(f.result()))
+        assert result is not None
+        if len(futures) > 1 and result.succeeded() and result.base_url != base_url:
+            with self._lock:
+                self._health[result.base_url].hedge_wins += 1
+        return result
+
+
+def is_timeout(error: Exception) -> bool:
+    "Is the (urllib3) error a timeout?"
+    reason = getattr(error, "reason", None)
+    return isinstance(error, urllib3.exceptions.TimeoutError) or isinstance(
+        reason, urllib3.exceptions.TimeoutError
+    )
+
+
+def _discard(attempt: Attempt) -> None:
+    "Close the response of an attempt that is not used. (Its connection is not reused.)"
+    if attempt.resp is not None:
+        attempt.resp.close()
+        attempt.resp.release_conn()
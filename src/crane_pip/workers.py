@@ -0,0 +1,122 @@
+"""Pre-fork serving of the proxy by multiple worker processes.
+
+The listening socket is bound once by the supervisor (the parent process) and inherited by the
+forked workers, which all accept connections on it. This works for any port (including 0) and on
+every POSIX platform, unlike SO_REUSEPORT. The supervisor restarts workers that die.
+
+State shared by the workers lives on disk: the tokens and the metadata in the SQLite databases
+(which coordinate concurrent writers), the bodies in the store (written atomically). In-memory
+state, like the connection pools and the coalescing of requests, is per worker.
+"""
+
+import logging
+import os
+import signal
+import sys
+import time
+from socketserver import BaseServer
+from typing import Callable, Set, Union
+
+logger = logging.getLogger(__name__)
+
+
+class WorkerSupervisor:
+    """Fork `workers` processes serving the server and keep them running.
+
+    Arguments:
+    ----------
+    server: BaseServer
+        The bound (and listening) server. Each worker runs its `serve_forever`.
+    workers: int
+        Number of worker processes.
+    on_start: Callable[[], None] | None
+        Called in each worker before it starts serving. Eg. to drop state that can not be shared
+        with the supervisor, like open connections.
+    """
+
+    # Seconds to wait before restarting a dead worker, to not spin on workers dying at start up.
+    restart_delay = 1.0
+
+    def __init__(
+        self,
+        server: BaseServer,
+        workers: int,
+        on_start: Union[Callable[[], None], None] = None,
+    ) -> None:
+        if not hasattr(os, "fork"):
+            raise OSError("Multiple workers are not supported on this platform (no os.fork).")
+        self.server = server
+        self.workers = workers
+        self.on_start = on_start
+        self.pids: Set[int] = set()
+        self._stopping = False
+
+    def run(self) -> None:
+        """Start the workers and supervise them.
+
+        Returns on SIGINT (KeyboardInterrupt) or SIGTERM, after stopping the workers."""
+        previous = signal.signal(signal.SIGTERM, self._on_sigterm)
+        try:
+            for _ in range(self.workers):
+                self._spawn()
+            while True:
+                pid, status = os.wait()
+                if pid not in self.pids:
+                    continue
+                self.pids.discard(pid)
+                logger.warning(f"Worker {pid} died (status {status}), restarting it.")
+                time.sleep(self.restart_delay)
+                self._spawn()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._stopping = True
+            signal.signal(signal.SIGTERM, previous)
+            self.stop_workers()
+
+    def signal_workers(self, signum: int) -> None:
+        "Send the signal to the workers. Eg. SIGHUP for them to reload their configuration."
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop_workers(self) -> None:
+        "Terminate the workers and wait for them to exit."
+        self.signal_workers(signal.SIGTERM)
+        for pid in self.pids:
+            try:
+                os.waitpid(pid, 0)
+            except ChildProcessError:
+                pass
+        self.pids.clear()
+
+    def _on_sigterm(self, signum, frame) -> None:
+        if not self._stopping:
+            raise KeyboardInterrupt
+
+    def _spawn(self) -> None:
+        # Else buffered output is written by both processes.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            print(f"Started worker {pid}")
+            self.pids.add(pid)
+            return
+
+        # Worker: Ctrl-C is handled by the supervisor, which terminates the workers.
+        exit_code = 1
+        try:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if self.on_start:
+                self.on_start()
+            self.server.serve_forever()
+            exit_code = 0
+        except BaseException:
+            logger.exception("Worker failed")
+        finally:
+            # Never return into (or run the clean up of) the code of the supervisor.
+            os._exit(exit_code)
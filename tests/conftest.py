@@ -0,0 +1,196 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+from threading import Thread
+import time
+from hashlib import sha256
+import gzip
+from typing import List
+import zipfile
+from pytest import fixture
+from crane_pip.proxy import IndexProxy
+from crane_pip.store import LastKnownGoodStore
+
+PKG_SHA256 = sha256(b"file:/packages/pkg-1.0.tar.gz").hexdigest()
+# Files (with the attributes of their anchor) on the /simple/wheels/ page.
+WHEELS_PAGE = [
+    ("wheels-1.0-cp311-cp311-manylinux_2_17_x86_64.whl", ""),
+    ("wheels-1.0-cp311-cp311-win_amd64.whl", ""),
+    ("wheels-1.0-cp310-cp310-manylinux_2_17_x86_64.whl", ""),
+    ("wheels-1.0-py3-none-any.whl", ""),
+    ("wheels-1.0.tar.gz", ""),
+    ("wheels-2.0.tar.gz", ' data-requires-python="&gt;=3.12"'),
+]
+# Metadata of the wheels on the /simple/app/ and /simple/lib/ pages: app requires pkg and lib.
+METADATA = {
+    "app": (
+        b"Metadata-Version: 2.1\nName: app\nVersion: 1.0\n"
+        b"Requires-Dist: pkg>=1.0\nRequires-Dist: Lib\n"
+        b'Requires-Dist: pytest; extra == "test"\n'
+    ),
+    "lib": b"Metadata-Version: 2.1\nName: lib\nVersion: 1.0\n",
+}
+
+
+def wheel(name: str) -> bytes:
+    "A wheel of app or lib without modules, installable by pip."
+    body = io.BytesIO()
+    dist_info = f"{name}-1.0.dist-info"
+    with zipfile.ZipFile(body, "w") as f:
+        f.writestr(f"{dist_info}/METADATA", METADATA[name])
+        f.writestr(
+            f"{dist_info}/WHEEL",
+            "Wheel-Version: 1.0\nGenerator: conftest\nRoot-Is-Purelib: true\nTag: py3-none-any\n",
+        )
+        f.writestr(
+            f"{dist_info}/RECORD",
+            f"{dist_info}/METADATA,,\n{dist_info}/WHEEL,,\n{dist_info}/RECORD,,\n",
+        )
+    return body.getvalue()
+
+
+class StandInIndex(BaseHTTPRequestHandler):
+    """Stand-in upstream index under /simple, linking to files on another host (localhost).
+
+    The `files_url` is set by the fixture as the port is only known at runtime."""
+
+    files_url = ""
+    hits: List[str] = []
+    # Accept-Encoding and Authorization header of the last request.
+    accept_encoding = ""
+    authorization = ""
+    # Serial (and ETag) of /simple/serial/, which lists `serial` files.
+    serial = 1
+    # Answer every request with a 503, as an index that is down.
+    failing = False
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if StandInIndex.failing:
+            self.send_response(503)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        StandInIndex.accept_encoding = self.headers.get("Accept-Encoding", "")
+        StandInIndex.authorization = self.headers.get("Authorization", "")
+        if self.path == "/simple/big/":
+            # Large page, compressed if the client asks for it.
+            body = "".join(
+                f'<a href="/packages/big-{i}.tar.gz">big-{i}.tar.gz</a>\n' for i in range(200)
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            if "gzip" in StandInIndex.accept_encoding:
+                body = gzip.compress(body)
+                self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/simple/serial/":
+            etag = f'"{StandInIndex.serial}"'
+            if self.headers.get("If-None-Match") == etag:
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.end_headers()
+                return
+            body = "".join(
+                f'<a href="/packages/serial-{i}.tar.gz">serial-{i}.tar.gz</a>\n'
+                for i in range(StandInIndex.serial)
+            ).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("ETag", etag)
+            self.send_header("X-PyPI-Last-Serial", str(StandInIndex.serial))
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        if self.path == "/simple/wheels/":
+            body = "".join(
+                f'<a href="/packages/{name}"{attrs}>{name}</a>\n'
+                for name, attrs in WHEELS_PAGE
+            ).encode()
+            content_type = "text/html"
+        elif self.path == "/simple/pkg/":
+            body = (
+                "<html><body>"
+                f'<a href="{self.files_url}/packages/pkg-1.0.tar.gz#sha256={PKG_SHA256}">'
+                "pkg-1.0.tar.gz</a>"
+                '<a href="../../packages/pkg-1.1.tar.gz">pkg-1.1.tar.gz</a>'
+                "</body></html>"
+            ).encode()
+            content_type = "text/html"
+        elif self.path in ("/simple/app/", "/simple/lib/"):
+            # Wheels with their metadata (PEP 658), that of app requires pkg and lib.
+            name = f"{self.path.split('/')[2]}-1.0-py3-none-any.whl"
+            body = f'<a href="/packages/{name}" data-core-metadata="true">{name}</a>'.encode()
+            content_type = "text/html"
+        elif self.path.endswith(".whl.metadata"):
+            body = METADATA["lib" if self.path.startswith("/packages/lib-") else "app"]
+            content_type = "application/octet-stream"
+        elif self.path in (f"/packages/{name}-1.0-py3-none-any.whl" for name in METADATA):
+            body = wheel(self.path[len("/packages/") :].split("-")[0])
+            content_type = "application/octet-stream"
+        elif self.path.startswith("/packages/slow-"):
+            # Streamed in parts, giving concurrent requests the time to pile up. A Range header
+            # of the form "bytes=0-N" is honoured.
+            body = 2 * self.path.encode()
+            last = self.headers.get("Range", "").partition("bytes=0-")[2]
+            if last:
+                body = body[: int(last) + 1]
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes 0-{last}/{2 * len(self.path)}")
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            half = len(body) // 2
+            for part in (body[:half], body[half:]):
+                time.sleep(0.2)
+                self.wfile.write(part)
+                self.wfile.flush()
+            return
+        elif self.path.startswith("/packages/"):
+            body = b"file:" + self.path.encode()
+            content_type = "application/octet-stream"
+        else:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, *args):
+        pass
+
+
+@fixture
+def upstream_url():
+    StandInIndex.hits = []
+    StandInIndex.serial = 1
+    StandInIndex.failing = False
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInIndex)
+    StandInIndex.files_url = f"http://localhost:{server.server_port}"
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/simple"
+    server.shutdown()
+    server.server_close()
+
+
+@fixture
+def store(tmpdir) -> LastKnownGoodStore:
+    return LastKnownGoodStore(str(tmpdir))
+
+
+@fixture
+def proxy(upstream_url, store):
+    with IndexProxy(index_url=None, port=0, fallback_urls=[upstream_url], store=store) as p:
+        yield p
@@ -0,0 +1,129 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from threading import Thread
+import time
+from typing import Dict, List
+from urllib.parse import parse_qs
+
+from pytest import fixture, raises
+
+from crane_pip import auth
+from crane_pip.auth import MissingSecret, authenticate, get_access_token
+from crane_pip.cache import TokenCache
+from crane_pip.config import ServerConfig, ServerConfigs
+
+INDEX_URL = "https://crane.example.com/simple"
+
+
+class StandInTokenEndpoint(BaseHTTPRequestHandler):
+    "Token endpoint answering every grant with a short lived access token."
+
+    requests: List[Dict[str, str]] = []
+    delay = 0.0
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        form = {k: v[0] for k, v in parse_qs(body).items()}
+        self.requests.append(form)
+        time.sleep(self.delay)
+        content = json.dumps(
+            {"access_token": f"token-{len(self.requests)}", "expires_in": 300}
+        ).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@fixture
+def token_url():
+    StandInTokenEndpoint.requests = []
+    StandInTokenEndpoint.delay = 0.0
+    server = HTTPServer(("127.0.0.1", 0), StandInTokenEndpoint)
+    Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}/token"
+    server.shutdown()
+    server.server_close()
+
+
+@fixture
+def registry(tmpdir, monkeypatch) -> ServerConfigs:
+    "Fresh configs and token cache in a temporary database."
+    for cls in (ServerConfigs, TokenCache):
+        monkeypatch.setattr(cls, "db_file", os.path.join(tmpdir, "crane.db"))
+    monkeypatch.setattr(TokenCache, "token_cache_file", os.path.join(tmpdir, "tokens.json"))
+    monkeypatch.setattr(ServerConfigs, "server_config_file", os.path.join(tmpdir, "servers.json"))
+    configs = ServerConfigs()
+    monkeypatch.setattr(auth, "server_configs", configs)
+    monkeypatch.setattr(auth, "token_cache", TokenCache())
+    return configs
+
+
+def test_client_credentials_grant(registry, token_url, monkeypatch):
+    monkeypatch.setenv("CRANE_TEST_SECRET", "s3cret")
+    registry[INDEX_URL] = ServerConfig(
+        "client", token_url, "unused", grant="client_credentials", secret_env="CRANE_TEST_SECRET"
+    )
+
+    assert authenticate(INDEX_URL) == "token-1"
+    assert StandInTokenEndpoint.requests == [
+        {"grant_type": "client_credentials", "client_id": "client", "client_secret": "s3cret"}
+    ]
+    # Cached until it expires.
+    assert get_access_token(INDEX_URL) == "token-1"
+    assert len(StandInTokenEndpoint.requests) == 1
+
+
+def test_slow_token_request_leaves_database_writable(registry, token_url, monkeypatch):
+    monkeypatch.setenv("CRANE_TEST_SECRET", "s3cret")
+    registry[INDEX_URL] = ServerConfig(
+        "client", token_url, "unused", grant="client_credentials", secret_env="CRANE_TEST_SECRET"
+    )
+    StandInTokenEndpoint.delay = 1.0
+    tokens = []
+    fetch = Thread(target=lambda: tokens.append(get_access_token(INDEX_URL)))
+    fetch.start()
+    while not StandInTokenEndpoint.requests:
+        time.sleep(0.01)
+
+    # Another crane process writes while the token request is in flight.
+    start = time.monotonic()
+    ServerConfigs()["https://other.example.com/simple"] = ServerConfig(
+        "other", token_url, "unused", grant="client_credentials", secret_env="CRANE_TEST_SECRET"
+    )
+    assert time.monotonic() - start < 0.5
+
+    fetch.join()
+    assert tokens == ["token-1"]
+    assert TokenCache()[INDEX_URL].access_token == "token-1"
+
+
+def test_token_exchange_grant(registry, token_url, tmpdir):
+    secret_file = os.path.join(tmpdir, "oidc-token")
+    with open(secret_file, "w") as f:
+        f.write("job-jwt\n")
+    registry[INDEX_URL] = ServerConfig(
+        "client", token_url, "unused", grant="token_exchange", secret_file=secret_file
+    )
+
+    assert get_access_token(INDEX_URL) == "token-1"
+    request = StandInTokenEndpoint.requests[0]
+    assert request["grant_type"] == "urn:ietf:params:oauth:grant-type:token-exchange"
+    assert request["subject_token"] == "job-jwt"
+
+
+def test_external_token(registry, monkeypatch):
+    registry[INDEX_URL] = ServerConfig(
+        "client", "unused", "unused", grant="external", secret_env="CRANE_TEST_TOKEN"
+    )
+    monkeypatch.delenv("CRANE_TEST_TOKEN", raising=False)
+    with raises(MissingSecret):
+        authenticate(INDEX_URL)
+
+    monkeypatch.setenv("CRANE_TEST_TOKEN", "supplied")
+    assert authenticate(INDEX_URL) == "supplied"
@@ -4,14 +4,19 @@ import json
 from typing import Tuple
 from pytest import fixture
 from crane_pip.cache import CraneTokens, TokenCache
+from crane_pip.db import MetadataStore
 
 
 @fixture
 def tmp_token_cache_file(tmpdir) -> str:
-    "Make cache module save tokens in a temporary tokens.json file. This file is returned"
-    token_cache_file = os.path.join(tmpdir, "tokens.json")
-    TokenCache.token_cache_file = token_cache_file
-    return token_cache_file
+    "Make cache module save tokens in a temporary database file. This file is returned"
+    TokenCache.db_file = os.path.join(tmpdir, "crane.db")
+    TokenCache.token_cache_file = os.path.join(tmpdir, "tokens.json")
+    return TokenCache.db_file
+
+
+def read_disk(db_file: str) -> dict:
+    return MetadataStore(db_file).read_table("tokens")
 
 
 @fixture
@@ -43,8 +48,7 @@ def tmp_cache_prefilled(tmp_cache, tokens) -> TokenCache:
     tmp_cache["url1"] = tokens[0]
     tmp_cache["url2"] = tokens[1]
 
-    with open(tmp_cache.token_cache_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_cache.db_file)
 
     assert "url1" in stored_on_disk
     assert "url2" in stored_on_disk
@@ -86,8 +90,7 @@ def test_crane_tokens():
 def test_initial_cache(tmp_cache: TokenCache, tokens):
     assert len(tmp_cache) == 0, "starts empty"
 
-    with open(tmp_cache.token_cache_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_cache.db_file)
     assert stored_on_disk == {}
 
     tmp_cache["url1"] = tokens[0]
@@ -95,8 +98,7 @@ def test_initial_cache(tmp_cache: TokenCache, tokens):
     assert "url1" in tmp_cache, "tmp_cache acts as a dictionary"
     assert tmp_cache["url1"] == tokens[0], "tmp_cache acts as a dictionary"
 
-    with open(tmp_cache.token_cache_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_cache.db_file)
 
     assert "url1" in stored_on_disk, "Assigning also writes to disk"
     assert stored_on_disk["url1"] == tokens[0].to_json(), "Correct json is stored on disk"
@@ -117,8 +119,7 @@ def test_deletion_of_cache(tmp_cache_prefilled: TokenCache):
 
     assert len(cache) == 1 and "url2" in cache
 
-    with open(cache.token_cache_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(cache.db_file)
 
     assert len(stored_on_disk) == 1 and "url2" in stored_on_disk
     assert stored_on_disk["url2"] == cache["url2"].to_json()
@@ -132,8 +133,28 @@ def test_update_of_cache(tmp_cache_prefilled: TokenCache):
 
     assert cache["url1"].access_token == "token2"
 
-    with open(cache.token_cache_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(cache.db_file)
 
     assert len(stored_on_disk) == 2
     assert stored_on_disk["url1"] == cache["url2"].to_json()
+
+
+def test_import_legacy_json(tmp_token_cache_file, tokens):
+    with open(TokenCache.token_cache_file, "w") as f:
+        json.dump({"url1": tokens[0].to_json()}, f)
+
+    cache = TokenCache()
+    assert cache["url1"] == tokens[0], "tokens.json of older versions is imported"
+
+    del cache["url1"]
+    assert "url1" not in TokenCache(), "tokens.json is only imported once"
+
+
+def test_exclusive_reloads_tokens_of_other_processes(tmp_cache, tokens):
+    other = TokenCache()
+    other["url1"] = tokens[0]
+
+    with tmp_cache.exclusive() as cache:
+        assert cache["url1"] == tokens[0], "state written by others is reloaded"
+        cache["url1"] = tokens[1]
+    assert TokenCache()["url1"] == tokens[1]
@@ -0,0 +1,84 @@
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+import time
+import urllib3
+from pytest import raises
+from crane_pip.coalesce import Coalescer, FetchFailed, Spool
+from crane_pip.links import index_id
+from conftest import StandInIndex
+
+
+def test_followers_share_the_leaders_stream():
+    coalescer = Coalescer()
+    fetch, leader = coalescer.join("key")
+    assert leader
+    follower_fetch, leader = coalescer.join("key")
+    assert follower_fetch is fetch and not leader
+
+    received = []
+    follower = Thread(
+        target=lambda: (fetch.wait_head(), received.extend(follower_fetch.iter_body()))
+    )
+    follower.start()
+    stream = fetch.publish(200, {"Content-Length": "6"}, stream=iter([b"abc", b"def"]))
+    assert list(stream) == [b"abc", b"def"]
+    coalescer.release("key", fetch)
+    follower.join(timeout=5)
+    assert received == [b"abc", b"def"]
+
+    # After release a new fetch is started.
+    assert coalescer.join("key")[1]
+
+
+def test_large_bodies_spooled_to_file():
+    spool = Spool(max_memory=10)
+    spool.append(b"abcdef")
+    assert not spool.spooled_to_file() and spool.read(2) == b"cdef"
+    spool.append(b"ghijkl")
+    assert spool.spooled_to_file() and spool.size == 12
+    assert spool.read(4) == b"efghijkl"
+
+    # A follower joining once the leader is done still gets the whole body.
+    fetch, _ = Coalescer().join("key")
+    chunks = [bytes([i]) * 2**17 for i in range(20)]
+    assert list(fetch.publish(200, {}, stream=iter(chunks))) == chunks
+    assert b"".join(fetch.iter_body()) == b"".join(chunks)
+
+
+def test_failure_of_leader_is_propagated():
+    coalescer = Coalescer()
+    fetch, _ = coalescer.join("key")
+    fetch.fail(ValueError("upstream down"))
+    with raises(FetchFailed):
+        fetch.wait_head()
+
+
+def test_concurrent_downloads_are_coalesced(proxy, upstream_url):
+    port = upstream_url.split(":")[2].split("/")[0]
+    path = f"/files/{index_id(upstream_url)}/http/127.0.0.1:{port}/packages/slow-1.0.tar.gz"
+    StandInIndex.hits = []
+    url = proxy.proxy_address.url() + path
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        responses = list(executor.map(lambda _: urllib3.request("GET", url), range(4)))
+    assert all(r.status == 200 for r in responses)
+    assert all(r.data == 2 * b"/packages/slow-1.0.tar.gz" for r in responses)
+    assert StandInIndex.hits == ["/packages/slow-1.0.tar.gz"]
+
+
+def test_partial_and_conditional_requests_not_coalesced(proxy, upstream_url):
+    port = upstream_url.split(":")[2].split("/")[0]
+    path = f"/files/{index_id(upstream_url)}/http/127.0.0.1:{port}/packages/slow-1.0.tar.gz"
+    url = proxy.proxy_address.url() + path
+
+    def get(headers):
+        resp = urllib3.request("GET", url, headers=headers)
+        return resp.status, resp.data
+
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        partial = executor.submit(get, {"Range": "bytes=0-9"})
+        time.sleep(0.05)
+        conditional = executor.submit(get, {"If-None-Match": '"1"'})
+        plain = executor.submit(get, {})
+    assert partial.result() == (206, b"/packages/")
+    assert conditional.result()[0] == 200
+    assert plain.result() == (200, 2 * b"/packages/slow-1.0.tar.gz")
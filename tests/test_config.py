@@ -3,14 +3,19 @@ import json
 from typing import Tuple
 from pytest import fixture
 from crane_pip.config import ServerConfigs, ServerConfig
+from crane_pip.db import MetadataStore
 
 
 @fixture
 def tmp_server_config_file(tmpdir) -> str:
-    "Make config module save configs in a temporary configs.json file. This file is returned"
-    config_file = os.path.join(tmpdir, "configs.json")
-    ServerConfigs.server_config_file = config_file
-    return config_file
+    "Make config module save configs in a temporary database file. This file is returned"
+    ServerConfigs.db_file = os.path.join(tmpdir, "crane.db")
+    ServerConfigs.server_config_file = os.path.join(tmpdir, "servers.json")
+    return ServerConfigs.db_file
+
+
+def read_disk(db_file: str) -> dict:
+    return MetadataStore(db_file).read_table("servers")
 
 
 @fixture
@@ -32,8 +37,7 @@ def tmp_server_configs_prefilled(tmp_server_configs, configs) -> ServerConfigs:
     tmp_server_configs["url1"] = configs[0]
     tmp_server_configs["url2"] = configs[1]
 
-    with open(tmp_server_configs.server_config_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_server_configs.db_file)
 
     assert "url1" in stored_on_disk
     assert "url2" in stored_on_disk
@@ -60,8 +64,7 @@ def test_crane_configs():
 def test_initial_server_configs(tmp_server_configs: ServerConfigs, configs):
     assert len(tmp_server_configs) == 0, "starts empty"
 
-    with open(tmp_server_configs.server_config_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_server_configs.db_file)
     assert stored_on_disk == {}
 
     tmp_server_configs["url1"] = configs[0]
@@ -69,8 +72,7 @@ def test_initial_server_configs(tmp_server_configs: ServerConfigs, configs):
     assert "url1" in tmp_server_configs, "tmp_server_configs acts as a dictionary"
     assert tmp_server_configs["url1"] == configs[0], "tmp_server_configs acts as a dictionary"
 
-    with open(tmp_server_configs.server_config_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(tmp_server_configs.db_file)
 
     assert "url1" in stored_on_disk, "Assigning also writes to disk"
     assert stored_on_disk["url1"] == configs[0].to_json(), "Correct json is stored on disk"
@@ -95,8 +97,7 @@ def test_deletion_of_server_configs(tmp_server_configs_prefilled: ServerConfigs)
 
     assert len(server_configs) == 1 and "url2" in server_configs
 
-    with open(server_configs.server_config_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(server_configs.db_file)
 
     assert len(stored_on_disk) == 1 and "url2" in stored_on_disk
     assert stored_on_disk["url2"] == server_configs["url2"].to_json()
@@ -110,8 +111,15 @@ def test_update_of_server_configs(tmp_server_configs_prefilled: ServerConfigs):
 
     assert server_configs["url1"].client_id == "client2"
 
-    with open(server_configs.server_config_file, "r") as f:
-        stored_on_disk = json.load(f)
+    stored_on_disk = read_disk(server_configs.db_file)
 
     assert len(stored_on_disk) == 2
     assert stored_on_disk["url1"] == server_configs["url2"].to_json()
+
+
+def test_import_legacy_json(tmp_server_config_file, configs):
+    with open(ServerConfigs.server_config_file, "w") as f:
+        json.dump({"url1": configs[0].to_json()}, f)
+
+    server_configs = ServerConfigs()
+    assert server_configs["url1"] == configs[0], "servers.json of older versions is imported"
@@ -0,0 +1,201 @@
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler
+import shutil
+import socket
+import ssl
+import subprocess
+from threading import Lock, Thread
+import time
+from typing import List, Sequence, Tuple
+
+import pytest
+import urllib3
+
+from crane_pip.links import index_id
+from crane_pip.proxy import IndexProxy
+from crane_pip.upstream import UpstreamPool
+
+h2 = pytest.importorskip("h2")
+import h2.config  # noqa: E402
+import h2.connection  # noqa: E402
+import h2.events  # noqa: E402
+
+pytestmark = pytest.mark.skipif(not shutil.which("openssl"), reason="requires openssl")
+
+DELAY = 0.3
+
+
+def stand_in_response(path: str) -> Tuple[int, List[Tuple[str, str]], bytes]:
+    "Status, headers and body of the stand-in index. /slow/* is answered after DELAY seconds."
+    if path.startswith("/slow/"):
+        time.sleep(DELAY)
+        return 200, [("content-type", "text/plain")], path.encode()
+    if path == "/simple/pkg/":
+        page = '<a href="/packages/pkg-1.0.tar.gz">pkg-1.0.tar.gz</a>'
+        return 200, [("content-type", "text/html")], page.encode()
+    if path.startswith("/packages/"):
+        return 200, [("content-type", "application/octet-stream")], b"file:" + path.encode()
+    return 404, [], b""
+
+
+class Http1Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        status, headers, body = stand_in_response(self.path)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInTlsIndex:
+    "TLS stand-in index serving HTTP/2 or HTTP/1.1, as negotiated with ALPN."
+
+    def __init__(self, cert_file: str, key_file: str, protocols: Sequence[str]) -> None:
+        self.context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.context.load_cert_chain(cert_file, key_file)
+        self.context.set_alpn_protocols(list(protocols))
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.url = f"https://127.0.0.1:{self.listener.getsockname()[1]}"
+        # Negotiated protocol per accepted connection.
+        self.connections: List[str] = []
+        Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self) -> None:
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except OSError:
+                return
+            Thread(target=self._serve, args=(sock, address), daemon=True).start()
+
+    def _serve(self, sock: socket.socket, address) -> None:
+        try:
+            tls = self.context.wrap_socket(sock, server_side=True)
+        except OSError:
+            return
+        protocol = tls.selected_alpn_protocol() or "http/1.1"
+        self.connections.append(protocol)
+        try:
+            if protocol == "h2":
+                self._serve_h2(tls)
+            else:
+                Http1Handler(tls, address, None)
+        except OSError:
+            pass
+        finally:
+            tls.close()
+
+    def _serve_h2(self, tls: ssl.SSLSocket) -> None:
+        conn = h2.connection.H2Connection(
+            h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        lock = Lock()
+        conn.initiate_connection()
+        tls.sendall(conn.data_to_send())
+
+        def respond(stream_id: int, method: str, path: str) -> None:
+            status, headers, body = stand_in_response(path)
+            headers = [(":status", str(status)), ("content-length", str(len(body)))] + headers
+            with lock:
+                conn.send_headers(stream_id, headers, end_stream=method == "HEAD" or not body)
+                if method != "HEAD" and body:
+                    conn.send_data(stream_id, body, end_stream=True)
+                tls.sendall(conn.data_to_send())
+
+        while True:
+            data = tls.recv(65536)
+            if not data:
+                return
+            with lock:
+                events = conn.receive_data(data)
+                tls.sendall(conn.data_to_send())
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    headers = dict(event.headers)
+                    args = (event.stream_id, headers[":method"], headers[":path"])
+                    Thread(target=respond, args=args, daemon=True).start()
+
+    def close(self) -> None:
+        self.listener.close()
+
+
+@pytest.fixture(scope="module")
+def certificate(tmp_path_factory) -> Tuple[str, str]:
+    "Self-signed certificate for 127.0.0.1."
+    path = tmp_path_factory.mktemp("tls")
+    cert_file, key_file = str(path / "cert.pem"), str(path / "key.pem")
+    subprocess.run(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1"]
+        + ["-keyout", key_file, "-out", cert_file, "-subj", "/CN=127.0.0.1"]
+        + ["-addext", "subjectAltName=IP:127.0.0.1"],
+        check=True,
+        capture_output=True,
+    )
+    return cert_file, key_file
+
+
+@pytest.fixture
+def tls_index(certificate, monkeypatch):
+    "Factory of stand-in indexes, of which the certificate is trusted."
+    monkeypatch.setenv("SSL_CERT_FILE", certificate[0])
+    servers = []
+
+    def start(protocols: Sequence[str] = ("h2", "http/1.1")) -> StandInTlsIndex:
+        servers.append(StandInTlsIndex(*certificate, protocols))
+        return servers[-1]
+
+    yield start
+    for server in servers:
+        server.close()
+
+
+def test_concurrent_requests_are_multiplexed(tls_index):
+    index = tls_index()
+    pool = UpstreamPool(http2=True)
+    urls = [f"{index.url}/slow/{i}" for i in range(8)]
+    start = time.monotonic()
+    with ThreadPoolExecutor(8) as executor:
+        responses = list(executor.map(lambda url: pool.request("GET", url, headers={}), urls))
+    elapsed = time.monotonic() - start
+
+    assert [r.data for r in responses] == [f"/slow/{i}".encode() for i in range(8)]
+    assert all(r.version == 20 for r in responses)
+    assert index.connections == ["h2"]
+    assert elapsed < 4 * DELAY, "requests were handled concurrently"
+
+    # The connection is reused afterwards, also when a response was not read.
+    pool.request("GET", f"{index.url}/packages/a", headers={}, preload_content=False).close()
+    assert pool.request("GET", f"{index.url}/packages/b", headers={}).data == b"file:/packages/b"
+    assert pool.http2_pool.connections_opened == 1
+
+
+def test_fallback_to_http1(tls_index):
+    index = tls_index(protocols=["http/1.1"])
+    pool = UpstreamPool(http2=True)
+    resp = pool.request("GET", f"{index.url}/packages/a", headers={})
+    assert resp.data == b"file:/packages/a"
+    assert resp.version == 11
+    assert pool.http2_pool.protocols() == {index.url[len("https://") :]: "HTTP/1.1"}
+
+
+def test_proxy_over_http2(tls_index):
+    index = tls_index()
+    with IndexProxy(
+        index_url=None, port=0, fallback_urls=[f"{index.url}/simple"], http2=True
+    ) as proxy:
+        resp = urllib3.request("GET", proxy.proxy_address.url() + "/pkg/")
+        assert resp.status == 200
+        host = index.url[len("https://") :]
+        file_path = f"/files/{index_id(index.url + '/simple')}/https/{host}/packages/pkg-1.0.tar.gz"
+        assert f'href="{file_path}"' in resp.data.decode()
+
+        resp = urllib3.request("GET", proxy.proxy_address.url() + file_path)
+        assert resp.data == b"file:/packages/pkg-1.0.tar.gz"
+    assert index.connections == ["h2"]
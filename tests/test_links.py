@@ -0,0 +1,68 @@
+import json
+from pytest import raises
+from crane_pip.links import (
+    InvalidProxyPath,
+    from_proxy_path,
+    index_id,
+    rewrite_html,
+    rewrite_json,
+    to_proxy_path,
+)
+
+INDEX_URL = "https://pypi.org/simple"
+ID = index_id(INDEX_URL)
+
+
+def test_proxy_path_round_trip():
+    url = "https://files.pythonhosted.org/packages/ab/cd/pkg-1.0.tar.gz#sha256=abc"
+    path = to_proxy_path(url, ID, INDEX_URL)
+    assert path == f"/files/{ID}/https/files.pythonhosted.org/packages/ab/cd/pkg-1.0.tar.gz#sha256=abc"
+    assert from_proxy_path(path.split("#")[0]) == (ID, url.split("#")[0])
+
+    # The host as quoted by pip.
+    quoted = from_proxy_path(f"/files/{ID}/http/127.0.0.1%3A8080/packages/pkg-1.0.tar.gz")
+    assert quoted == (ID, "http://127.0.0.1:8080/packages/pkg-1.0.tar.gz")
+
+    # Pages of the index itself stay relative to the proxy root.
+    assert to_proxy_path("https://pypi.org/simple/numpy/", ID, INDEX_URL) == "/numpy/"
+
+    for invalid in ("/numpy/", f"/files/{ID}", f"/files/{ID}/ftp/host/x", f"/files/{ID}/https/"):
+        with raises(InvalidProxyPath):
+            from_proxy_path(invalid)
+
+
+def test_rewrite_html():
+    page = """<html><body>
+    <a href="https://files.pythonhosted.org/packages/pkg-1.0.tar.gz#sha256=abc">pkg-1.0.tar.gz</a>
+    <a data-requires-python="&gt;=3.8" href='../../packages/pkg-1.1.tar.gz?a=1&amp;b=2'>pkg-1.1</a>
+    <a href="/simple/other/">other</a>
+    </body></html>"""
+    rewritten = rewrite_html(page, "https://pypi.org/simple/pkg/", ID, INDEX_URL)
+    assert f'href="/files/{ID}/https/files.pythonhosted.org/packages/pkg-1.0.tar.gz#sha256=abc"' in rewritten
+    assert f"href='/files/{ID}/https/pypi.org/packages/pkg-1.1.tar.gz?a=1&amp;b=2'" in rewritten
+    assert 'href="/other/"' in rewritten
+    assert 'data-requires-python="&gt;=3.8"' in rewritten
+
+
+def test_rewrite_json():
+    page = {
+        "meta": {"api-version": "1.0"},
+        "name": "pkg",
+        "files": [{"filename": "pkg-1.0.tar.gz", "url": "../../packages/pkg-1.0.tar.gz"}],
+    }
+    rewritten = json.loads(
+        rewrite_json(json.dumps(page), "https://pypi.org/simple/pkg/", ID, INDEX_URL)
+    )
+    assert rewritten["files"][0]["url"] == f"/files/{ID}/https/pypi.org/packages/pkg-1.0.tar.gz"
+    assert rewritten["meta"] == page["meta"]
+
+
+def test_rewrite_html_memoizes_links():
+    page = '<a href="/packages/a-1.0.tar.gz">a</a><a href="/packages/a-1.1.tar.gz">a</a>'
+    links = {}
+    rewritten = rewrite_html(page, INDEX_URL + "/a/", ID, INDEX_URL, links)
+    assert len(links) == 2
+    assert rewrite_html(page, INDEX_URL + "/a/", ID, INDEX_URL) == rewritten
+
+    links['/packages/a-1.0.tar.gz'] = "/memoized"
+    assert '"/memoized"' in rewrite_html(page, INDEX_URL + "/a/", ID, INDEX_URL, links)
@@ -0,0 +1,127 @@
+import os
+from pytest import fixture
+from crane_pip.lockfiles import PinnedPackage, read_lock_file
+
+
+@fixture
+def write(tmpdir):
+    def write(name: str, content: str) -> str:
+        path = os.path.join(tmpdir, name)
+        with open(path, "w") as f:
+            f.write(content)
+        return path
+
+    return write
+
+
+def test_requirements(write):
+    write("other.txt", "six==1.16.0\n")
+    path = write(
+        "requirements.txt",
+        """# comment
+--index-url https://example.com/simple
+-r other.txt
+Requests[socks]==2.32.3 ; python_version >= "3.8" \\
+    --hash=sha256:aaa \\
+    --hash=sha256:bbb
+numpy>=1.0  # not pinned
+""",
+    )
+    assert read_lock_file(path) == [
+        PinnedPackage(name="six", version="1.16.0"),
+        PinnedPackage(
+            name="requests", version="2.32.3", hashes=frozenset({"sha256:aaa", "sha256:bbb"})
+        ),
+    ]
+
+
+def test_poetry_lock(write):
+    path = write(
+        "poetry.lock",
+        """
+[[package]]
+name = "Six"
+version = "1.16.0"
+files = [
+    {file = "six-1.16.0-py2.py3-none-any.whl", hash = "sha256:aaa"},
+    {file = "six-1.16.0.tar.gz", hash = "sha256:bbb"},
+]
+
+[[package]]
+name = "local"
+version = "0.1.0"
+files = []
+[package.source]
+type = "directory"
+url = "../local"
+""",
+    )
+    assert read_lock_file(path) == [
+        PinnedPackage(
+            name="six",
+            version="1.16.0",
+            filenames=frozenset({"six-1.16.0-py2.py3-none-any.whl", "six-1.16.0.tar.gz"}),
+            hashes=frozenset({"sha256:aaa", "sha256:bbb"}),
+        )
+    ]
+
+
+def test_uv_lock(write):
+    path = write(
+        "uv.lock",
+        """
+version = 1
+
+[[package]]
+name = "six"
+version = "1.16.0"
+source = { registry = "https://pypi.org/simple" }
+sdist = { url = "https://files.example.com/six-1.16.0.tar.gz", hash = "sha256:bbb", size = 1 }
+wheels = [
+    { url = "https://files.example.com/six-1.16.0-py2.py3-none-any.whl", hash = "sha256:aaa" },
+]
+
+[[package]]
+name = "project"
+version = "0.1.0"
+source = { editable = "." }
+""",
+    )
+    assert read_lock_file(path) == [
+        PinnedPackage(
+            name="six",
+            version="1.16.0",
+            filenames=frozenset({"six-1.16.0-py2.py3-none-any.whl", "six-1.16.0.tar.gz"}),
+            hashes=frozenset({"sha256:aaa", "sha256:bbb"}),
+        )
+    ]
+
+
+def test_pylock(write):
+    path = write(
+        "pylock.toml",
+        """
+lock-version = "1.0"
+created-by = "test"
+
+[[packages]]
+name = "six"
+version = "1.16.0"
+sdist = { name = "six-1.16.0.tar.gz", url = "https://x/six-1.16.0.tar.gz", hashes = { sha256 = "bbb" } }
+wheels = [
+    { url = "https://x/six-1.16.0-py2.py3-none-any.whl", hashes = { sha256 = "aaa" } },
+]
+
+[[packages]]
+name = "project"
+directory = { path = "." }
+""",
+    )
+    assert read_lock_file(path) == [
+        PinnedPackage(
+            name="six",
+            version="1.16.0",
+            filenames=frozenset({"six-1.16.0-py2.py3-none-any.whl", "six-1.16.0.tar.gz"}),
+            hashes=frozenset({"sha256:aaa", "sha256:bbb"}),
+        )
+    ]
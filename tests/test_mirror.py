@@ -0,0 +1,64 @@
+import json
+import os
+
+from pytest import raises
+
+from crane_pip.cmd_mirror import MirrorError, mirror
+from crane_pip.lockfiles import PinnedPackage
+from conftest import PKG_SHA256, StandInIndex
+
+PKG_1_0 = PinnedPackage(name="pkg", version="1.0")
+PKG_1_1 = PinnedPackage(name="pkg", version="1.1")
+
+
+def test_mirror_is_updated_incrementally(proxy, tmpdir):
+    directory = os.path.join(tmpdir, "mirror")
+    result = mirror([PKG_1_0], proxy.proxy_address, directory, jobs=2)
+    assert result.updated and result.downloaded == 1 and result.rewritten == 1
+
+    with open(os.path.join(directory, "files", "pkg-1.0.tar.gz"), "rb") as f:
+        assert f.read() == b"file:/packages/pkg-1.0.tar.gz"
+    with open(os.path.join(directory, "simple", "pkg", "index.html")) as f:
+        assert f'href="../../files/pkg-1.0.tar.gz#sha256={PKG_SHA256}"' in f.read()
+    with open(os.path.join(directory, "simple", "pkg", "index.json")) as f:
+        page = json.load(f)
+    assert page["versions"] == ["1.0"]
+    assert page["files"][0]["hashes"] == {"sha256": PKG_SHA256}
+    with open(os.path.join(directory, "simple", "index.html")) as f:
+        assert 'href="pkg/"' in f.read()
+
+    # Nothing changed: nothing downloaded nor written, the previous files are kept.
+    inodes = {
+        path: os.stat(os.path.join(directory, path)).st_ino
+        for path in ("files/pkg-1.0.tar.gz", "simple/pkg/index.html")
+    }
+    StandInIndex.hits = []
+    result = mirror([PKG_1_0], proxy.proxy_address, directory, jobs=2)
+    assert result.updated and result.unchanged == 1
+    assert result.downloaded == 0 and result.rewritten == 0
+    assert not [hit for hit in StandInIndex.hits if hit.startswith("/packages/")]
+    for path, inode in inodes.items():
+        assert os.stat(os.path.join(directory, path)).st_ino == inode
+
+    # Only the new file is downloaded.
+    result = mirror([PKG_1_0, PKG_1_1], proxy.proxy_address, directory, jobs=2)
+    assert (result.downloaded, result.unchanged, result.rewritten) == (1, 1, 1)
+    assert sorted(os.listdir(os.path.join(directory, "files"))) == [
+        "pkg-1.0.tar.gz",
+        "pkg-1.1.tar.gz",
+    ]
+
+
+def test_failed_update_keeps_mirror(proxy, tmpdir):
+    parent = os.path.join(tmpdir, "mirrors")
+    directory = os.path.join(parent, "mirror")
+    mirror([PKG_1_0], proxy.proxy_address, directory)
+    missing = PinnedPackage(name="missing", version="1")
+    result = mirror([PKG_1_1, missing], proxy.proxy_address, directory)
+    assert not result.updated and result.failed == 1
+    assert os.listdir(os.path.join(directory, "files")) == ["pkg-1.0.tar.gz"]
+    assert os.listdir(parent) == ["mirror"]
+
+    os.makedirs(os.path.join(parent, "other", "data"))
+    with raises(MirrorError):
+        mirror([PKG_1_0], proxy.proxy_address, os.path.join(parent, "other"))
@@ -0,0 +1,53 @@
+import urllib3
+from pip._vendor.packaging.tags import Tag
+from crane_pip.cmd_prefetch import prefetch, select_files
+from crane_pip.lockfiles import PinnedPackage
+from crane_pip.simple import SimpleFile
+from conftest import StandInIndex
+
+
+def file(filename: str, sha256: str = "") -> SimpleFile:
+    return SimpleFile(filename=filename, url=f"/files/{filename}", hashes={"sha256": sha256})
+
+
+def test_select_files():
+    files = [
+        file("pkg-1.0.tar.gz", "a"),
+        file("pkg-1.0-py3-none-any.whl", "b"),
+        file("pkg-1.0-cp311-cp311-manylinux_2_17_x86_64.whl", "c"),
+        file("pkg-1.1-py3-none-any.whl", "d"),
+    ]
+    tags = [Tag("cp311", "cp311", "manylinux_2_17_x86_64"), Tag("py3", "none", "any")]
+    pinned = PinnedPackage(name="pkg", version="1.0")
+
+    assert [f.filename for f in select_files(files, pinned, None)] == [
+        "pkg-1.0.tar.gz",
+        "pkg-1.0-py3-none-any.whl",
+        "pkg-1.0-cp311-cp311-manylinux_2_17_x86_64.whl",
+    ]
+    assert [f.filename for f in select_files(files, pinned, tags)] == [
+        "pkg-1.0-cp311-cp311-manylinux_2_17_x86_64.whl"
+    ]
+    # No compatible wheel: fall back to the sdist.
+    assert [f.filename for f in select_files(files, pinned, tags[:0])] == ["pkg-1.0.tar.gz"]
+    # Hashes of the lock file restrict the choice.
+    hashed = pinned._replace(hashes=frozenset({"sha256:b"}))
+    assert [f.filename for f in select_files(files, hashed, tags)] == ["pkg-1.0-py3-none-any.whl"]
+
+
+def test_prefetch_into_store(proxy, store):
+    packages = [PinnedPackage(name="pkg", version="1.0"), PinnedPackage(name="missing", version="1")]
+    result = prefetch(packages, proxy.proxy_address, store, jobs=2, supported_tags=None)
+    assert result.downloaded == 1 and result.failed == 1
+
+    result = prefetch(packages[:1], proxy.proxy_address, store, jobs=2, supported_tags=None)
+    assert result.downloaded == 0 and result.already_stored == 1
+
+    # The proxy now serves the file from its store.
+    page = urllib3.request("GET", proxy.proxy_address.url() + "/pkg/").data.decode()
+    path = page.split('href="')[1].split("#")[0]
+    StandInIndex.hits = []
+    resp = urllib3.request("GET", proxy.proxy_address.url() + path)
+    assert resp.data == b"file:/packages/pkg-1.0.tar.gz"
+    assert resp.headers["X-Crane-Cache"] == "hit"
+    assert StandInIndex.hits == []
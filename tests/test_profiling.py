@@ -0,0 +1,45 @@
+import os
+import pstats
+
+import urllib3
+from pytest import mark
+
+from crane_pip.proxy import IndexProxy, profile_endpoint
+
+
+def test_profile_endpoint():
+    assert profile_endpoint("GET", "/pkg/") == "GET /<project>/"
+    assert profile_endpoint("GET", "/") == "GET /"
+    assert profile_endpoint("HEAD", "/files/abc/packages/pkg.tar.gz") == "HEAD /files/"
+    assert profile_endpoint("GET", "/_crane/stats") == "GET /_crane/stats"
+    assert profile_endpoint("GET", "/_crane/select/python=3.11/pkg/") == "GET selected /<project>/"
+
+
+@mark.parametrize("mode", ["cprofile", "sample"])
+def test_profiles_written_on_stop(mode, upstream_url, tmpdir):
+    directory = os.path.join(tmpdir, "profiles")
+    http = urllib3.PoolManager()
+    with IndexProxy(
+        index_url=None, port=0, fallback_urls=[upstream_url], profile=mode, profile_dir=directory
+    ) as proxy:
+        base_url = proxy.proxy_address.url()
+        for _ in range(5):
+            assert http.request("GET", f"{base_url}/pkg/").status == 200
+        assert http.request("GET", f"{base_url}/_crane/stats").status == 200
+        http.clear()
+
+    prefix = os.path.join(directory, f"crane-profile-{os.getpid()}")
+    with open(f"{prefix}.txt") as f:
+        summary = f.read()
+    assert "GET /<project>/" in summary and "GET /_crane/stats" in summary
+    if mode == "cprofile":
+        stats = pstats.Stats(f"{prefix}-GET_project.pstats")
+        assert any(func[2] == "_handle_request" for func in stats.stats)  # type: ignore
+    else:
+        with open(f"{prefix}.collapsed") as f:
+            stacks = f.read().splitlines()
+        # Whether the sampler catches requests this short is up to chance.
+        for line in stacks:
+            stack, _, count = line.rpartition(" ")
+            assert stack.split(";")[0] in ("GET /<project>/", "GET /_crane/stats")
+            assert int(count) > 0
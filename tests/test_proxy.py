@@ -0,0 +1,412 @@
+from base64 import b64encode
+import gzip
+import os
+import platform
+import socket
+import time
+from typing import List, Tuple
+from urllib.parse import quote
+import urllib3
+from crane_pip import pages as pages_module
+from crane_pip.artifacts import ArtifactIndex
+from crane_pip.links import index_id
+from crane_pip.proxy import (
+    IndexProxy,
+    ProxyHTTPRequestHandler,
+    ProxyMode,
+    client_token,
+    send_buffers,
+    store_scope,
+)
+from crane_pip.simple import FileSelector, SimpleFile
+from crane_pip.store import LastKnownGoodStore
+from conftest import PKG_SHA256, WHEELS_PAGE, StandInIndex
+
+
+def test_page_links_are_rewritten(proxy, upstream_url):
+    id_ = index_id(upstream_url)
+    port = upstream_url.split(":")[2].split("/")[0]
+    resp = urllib3.request("GET", proxy.proxy_address.url() + "/pkg/")
+    assert resp.status == 200
+    page = resp.data.decode()
+    file_path = f"/files/{id_}/http/localhost:{port}/packages/pkg-1.0.tar.gz"
+    assert f'href="{file_path}#sha256={PKG_SHA256}"' in page
+    assert f'href="/files/{id_}/http/127.0.0.1:{port}/packages/pkg-1.1.tar.gz"' in page
+    assert int(resp.headers["Content-Length"]) == len(resp.data)
+
+
+def test_files_are_downloaded_through_proxy(proxy, upstream_url):
+    id_ = index_id(upstream_url)
+    port = upstream_url.split(":")[2].split("/")[0]
+    url = f"{proxy.proxy_address.url()}/files/{id_}/http/localhost:{port}/packages/pkg-1.0.tar.gz"
+    resp = urllib3.request("GET", url)
+    assert resp.status == 200
+    assert resp.data == b"file:/packages/pkg-1.0.tar.gz"
+
+    resp = urllib3.request("GET", f"{proxy.proxy_address.url()}/files/unknown/http/x/y.tar.gz")
+    assert resp.status == 404
+
+
+def test_not_found(proxy):
+    resp = urllib3.request("GET", proxy.proxy_address.url() + "/missing/")
+    assert resp.status == 404
+
+
+def test_offline_serves_from_store(proxy, upstream_url, store):
+    online = urllib3.request("GET", proxy.proxy_address.url() + "/pkg/")
+    proxy.stop()
+
+    StandInIndex.hits = []
+    with IndexProxy(
+        index_url=None, port=0, fallback_urls=[upstream_url], mode=ProxyMode.OFFLINE, store=store
+    ) as offline_proxy:
+        resp = urllib3.request("GET", offline_proxy.proxy_address.url() + "/pkg/")
+        assert resp.status == 200
+        assert resp.data == online.data
+        assert resp.headers["X-Crane-Stale"].startswith("offline; stored-at=")
+
+        resp = urllib3.request("GET", offline_proxy.proxy_address.url() + "/other/")
+        assert resp.status == 504
+    assert StandInIndex.hits == []
+
+
+def test_store_writer_adds_only_complete_bodies(store):
+    writer = store.writer("/files/x/a.whl", {"Content-Type": "application/zip"})
+    writer.write(b"part")
+    writer.close()
+    assert not store.has("/files/x/a.whl")
+
+    writer = store.writer("/files/x/a.whl", {"Content-Type": "application/zip"})
+    for chunk in (b"ab", b"cd"):
+        writer.write(chunk)
+    writer.commit()
+    writer.close()
+    stored = store.get("/files/x/a.whl")
+    assert stored and stored.content == b"abcd"
+    assert not [f for _, _, files in os.walk(store.store_dir) for f in files if ".tmp-" in f]
+
+
+def test_store_evicts_least_recently_used(store):
+    store.max_size = 10
+    for name in ("a", "b", "c"):
+        store.put(f"/files/x/{name}.whl", {}, b"1234")
+    assert store.size() == 8 and not store.has("/files/x/a.whl")
+    # Reading an entry marks it as used.
+    store.db.execute("UPDATE responses SET used_at = 0 WHERE path = '/files/x/b.whl'")
+    assert store.get("/files/x/b.whl")
+    store.put("/files/x/d.whl", {}, b"1234")
+    assert store.has("/files/x/b.whl") and not store.has("/files/x/c.whl")
+
+
+def test_store_size_kept_up_to_date(store):
+    store.max_size = 0
+    store.put("/files/x/a.whl", {}, b"1234")
+    store.put("/files/x/a.whl", {}, b"12")
+    store.put("/files/x/b.whl", {}, b"123")
+    assert store.size() == 5
+    # Changed by another process.
+    other = LastKnownGoodStore(store.store_dir, max_size=0)
+    other.put("/files/x/c.whl", {}, b"1234")
+    other.remove("/files/x/a.whl")
+    assert store.size() == 7
+    store.remove("/files/x/b.whl")
+    assert store.size() == 4 == other.size()
+
+
+def test_stale_if_error(upstream_url, store):
+    dead_url = "http://127.0.0.1:1/simple"
+    mirrors = [upstream_url, dead_url]
+    with IndexProxy(index_url=None, port=0, fallback_urls=mirrors, store=store) as p:
+        online = urllib3.request("GET", p.proxy_address.url() + "/pkg/")
+        assert "X-Crane-Stale" not in online.headers
+    scope = store_scope(ProxyHTTPRequestHandler.indexes)
+    assert store.has(f"/_indexes/{scope}/pkg/", variant="html")
+
+    StandInIndex.failing = True
+    # Pages are stored per index: the same mirrors (in any order) share them, other indexes not.
+    for fallback_urls, status in ((mirrors[::-1], 200), ([dead_url], 502)):
+        with IndexProxy(
+            index_url=None,
+            port=0,
+            fallback_urls=fallback_urls,
+            mode=ProxyMode.STALE_IF_ERROR,
+            store=store,
+        ) as p:
+            resp = urllib3.request("GET", p.proxy_address.url() + "/pkg/")
+            assert resp.status == status
+            if status == 200:
+                assert resp.data == online.data
+                assert resp.headers["X-Crane-Stale"].startswith("error;")
+
+                resp = urllib3.request("GET", p.proxy_address.url() + "/other/")
+                assert resp.status == 503
+
+
+def raw_get(proxy: IndexProxy, path: str) -> Tuple[List[str], bytes]:
+    "The status and header lines and the body of a response, exactly as sent by the proxy."
+    with socket.create_connection(("127.0.0.1", proxy.proxy_address.port)) as sock:
+        headers = "Host: x\r\nAccept: text/html\r\nConnection: close\r\n"
+        sock.sendall(f"GET {path} HTTP/1.1\r\n{headers}\r\n".encode())
+        received = b""
+        while True:
+            data = sock.recv(2**16)
+            if not data:
+                break
+            received += data
+    head, _, body = received.partition(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    assert [line.partition(":")[0] for line in lines[1:3]] == ["Server", "Date"]
+    return [lines[0]] + lines[3:], body
+
+
+def test_send_buffers_partial_writes():
+    class Socket:
+        "Takes at most 3 bytes per call."
+
+        def __init__(self):
+            self.sent: List[bytes] = []
+
+        def sendmsg(self, buffers):
+            self.sent.append(b"".join(buffers)[:3])
+            return len(self.sent[-1])
+
+    sock = Socket()
+    send_buffers(sock, [b"head", b"", b"body-of-response"])
+    assert b"".join(sock.sent) == b"headbody-of-response"
+    assert max(map(len, sock.sent)) == 3
+
+
+def test_stored_file_sent_with_sendfile(proxy, upstream_url, store, monkeypatch):
+    port = upstream_url.split(":")[2].split("/")[0]
+    path = f"/files/{index_id(upstream_url)}/http/localhost:{port}/packages/stored-1.0.tar.gz"
+    body = bytes(range(256)) * 4096
+    store.put(path, {"Content-Type": "application/x-tar", "ETag": '"1"'}, body)
+    sendfile = socket.socket.sendfile
+    sent_files = []
+
+    def counting_sendfile(self, file, *args, **kwargs):
+        sent_files.append(file.name)
+        return sendfile(self, file, *args, **kwargs)
+
+    monkeypatch.setattr(socket.socket, "sendfile", counting_sendfile)
+    lines, received = raw_get(proxy, path)
+    assert lines == [
+        "HTTP/1.1 200 OK",
+        "Content-Type: application/x-tar",
+        'ETag: "1"',
+        "X-Crane-Cache: hit",
+        f"Content-Length: {len(body)}",
+        "Connection: close",
+    ]
+    assert received == body
+    assert len(sent_files) == 1 and StandInIndex.hits == []
+
+
+def test_page_sent_with_partial_sendmsg_writes(proxy, monkeypatch):
+    expected_lines, expected = raw_get(proxy, "/pkg/")
+    assert expected_lines == [
+        "HTTP/1.1 200 OK",
+        "Content-Type: text/html",
+        "Vary: Accept-Encoding",
+        f"Content-Length: {len(expected)}",
+        "Connection: close",
+    ]
+    assert expected.startswith(b'<html><body><a href="/files/')
+    assert expected.endswith(b"</body></html>")
+
+    sendmsg = socket.socket.sendmsg
+    calls = []
+
+    def partial_sendmsg(self, buffers, *args):
+        # At most 7 bytes per call, as a socket with a full send buffer takes.
+        calls.append(len(buffers))
+        return sendmsg(self, [b"".join(buffers)[:7]], *args)
+
+    monkeypatch.setattr(socket.socket, "sendmsg", partial_sendmsg)
+    lines, body = raw_get(proxy, "/pkg/")
+    assert lines == expected_lines and body == expected
+    # The head and the page went in one vectored write, continued where the last one stopped.
+    assert calls[0] == 2 and len(calls) > len(expected) // 7
+
+
+def test_compression_negotiation(proxy, monkeypatch):
+    url = proxy.proxy_address.url() + "/big/"
+    plain = urllib3.request(
+        "GET", url, headers={"Accept-Encoding": "identity"}, decode_content=False
+    )
+    assert "Content-Encoding" not in plain.headers
+    assert plain.headers["Vary"] == "Accept-Encoding"
+    # The proxy asks the upstream for a compressed page regardless of the client.
+    assert "gzip" in StandInIndex.accept_encoding
+    assert plain.data.count(b'href="/files/') == 200
+
+    compressed = urllib3.request(
+        "GET", url, headers={"Accept-Encoding": "gzip"}, decode_content=False
+    )
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in compressed.headers["Vary"]
+    assert int(compressed.headers["Content-Length"]) == len(compressed.data) < len(plain.data)
+    assert gzip.decompress(compressed.data) == plain.data
+
+    # The compressed page is kept with the page.
+    compressions = []
+    monkeypatch.setattr(pages_module, "compress", lambda *args: compressions.append(args))
+    again = urllib3.request("GET", url, headers={"Accept-Encoding": "gzip"}, decode_content=False)
+    assert again.data == compressed.data and compressions == []
+
+
+def test_head_and_404_answered_from_artifact_index(proxy, upstream_url):
+    port = upstream_url.split(":")[2].split("/")[0]
+    path = f"/files/{index_id(upstream_url)}/http/127.0.0.1:{port}/packages/pkg-1.1.tar.gz"
+    urllib3.request("GET", proxy.proxy_address.url() + "/pkg/")
+    urllib3.request("GET", proxy.proxy_address.url() + path)
+    urllib3.request("GET", proxy.proxy_address.url() + "/missing/")
+
+    StandInIndex.hits = []
+    resp = urllib3.request("HEAD", proxy.proxy_address.url() + path)
+    assert resp.status == 200
+    assert resp.headers["Content-Length"] == str(len(b"file:/packages/pkg-1.1.tar.gz"))
+    assert resp.headers["X-Crane-Cache"] == "index"
+    resp = urllib3.request("GET", proxy.proxy_address.url() + "/missing/")
+    assert resp.status == 404
+    assert StandInIndex.hits == []
+
+
+def test_artifact_records_are_persisted(store):
+    file = SimpleFile("pkg-1.0.tar.gz", "/files/x/pkg-1.0.tar.gz", {"sha256": PKG_SHA256}, size=3)
+    ArtifactIndex(store.db).record_page([file])
+
+    record = ArtifactIndex(store.db).get(file.url)
+    assert record is not None
+    assert record.hashes == {"sha256": PKG_SHA256} and record.size == 3
+
+
+def test_artifact_index_is_bounded(monkeypatch):
+    artifacts = ArtifactIndex()
+    artifacts.max_records, artifacts.max_not_found = 2, 2
+    files = [SimpleFile(f"pkg-{i}.tar.gz", f"/files/x/pkg-{i}.tar.gz", {}) for i in range(3)]
+    artifacts.record_page(files[:2])
+    assert artifacts.get(files[0].url)
+    artifacts.record_page(files[2:])
+    # The least recently used record is dropped.
+    assert artifacts.get(files[0].url) and not artifacts.get(files[1].url)
+
+    for path in ("/a/", "/b/", "/c/"):
+        artifacts.record_not_found("index", path)
+    assert [artifacts.is_not_found("index", p) for p in ("/a/", "/b/", "/c/")] == [
+        False, True, True,
+    ]
+    now = time.monotonic()
+    monkeypatch.setattr(time, "monotonic", lambda: now + artifacts.not_found_ttl + 1)
+    artifacts.record_not_found("index", "/d/")
+    assert list(artifacts._not_found) == [("index", "/d/")]
+
+
+def test_client_token():
+    assert client_token("Bearer tok") == "tok"
+    assert client_token("Basic " + b64encode(b"__token__:tok").decode()) == "tok"
+    assert client_token("Basic !!") is None
+    assert client_token(None) is None
+
+
+def test_shared_proxy_uses_client_credentials(upstream_url, store):
+    # The crane index on another origin than the public (fallback) index.
+    private_url = upstream_url.replace("127.0.0.1", "localhost")
+    port = upstream_url.split(":")[2].split("/")[0]
+    with IndexProxy(
+        index_url=private_url, port=0, fallback_urls=[upstream_url], store=store, shared=True
+    ) as p:
+        resp = urllib3.request("GET", p.proxy_address.url() + "/pkg/")
+        assert resp.status == 401 and "Basic" in resp.headers["WWW-Authenticate"]
+
+        basic = urllib3.util.make_headers(basic_auth="__token__:tok")
+        resp = urllib3.request("GET", p.proxy_address.url() + "/pkg/", headers=basic)
+        assert resp.status == 200
+        assert StandInIndex.authorization == "Bearer tok"
+
+        # Public files are shared: no client credentials upstream, and stored.
+        path = f"/files/{index_id(upstream_url)}/http/localhost:{port}/packages/pkg-1.0.tar.gz"
+        resp = urllib3.request("GET", p.proxy_address.url() + path, headers=basic)
+        assert resp.status == 200
+        assert StandInIndex.authorization == ""
+        assert store.has(path)
+        pages = store.db.execute("SELECT path FROM responses WHERE variant = 'html'")
+        assert not pages, "pages of the crane index are not shared"
+
+
+def test_unreachable_index_is_skipped(upstream_url):
+    dead_url = "http://127.0.0.1:1/simple"
+    with IndexProxy(index_url=dead_url, port=0, fallback_urls=[upstream_url], shared=True) as p:
+        basic = urllib3.util.make_headers(basic_auth="__token__:tok")
+        resp = urllib3.request("GET", p.proxy_address.url() + "/pkg/", headers=basic)
+        assert resp.status == 200
+        assert dead_url in resp.headers["Warning"]
+        # Not found in the reachable index: the unreachable one might have it.
+        resp = urllib3.request("GET", p.proxy_address.url() + "/missing/", headers=basic)
+        assert resp.status == 502
+
+        stats = urllib3.request("GET", p.proxy_address.url() + "/_crane/stats").json()
+        assert stats["upstreams"][dead_url]["failures"] == 2
+        assert stats["upstreams"][upstream_url]["circuit"] == "closed"
+
+
+def test_pages_are_updated_incrementally(proxy):
+    url = proxy.proxy_address.url()
+    first = urllib3.request("GET", url + "/serial/")
+    assert first.status == 200 and first.data.count(b"<a ") == 1
+
+    # Unchanged: upstream answers the conditional request with a 304.
+    again = urllib3.request("GET", url + "/serial/")
+    assert again.status == 200 and again.data == first.data
+    # Unchanged without validators: same content.
+    urllib3.request("GET", url + "/pkg/")
+    urllib3.request("GET", url + "/pkg/")
+
+    StandInIndex.serial = 2
+    changed = urllib3.request("GET", url + "/serial/")
+    assert changed.data.count(b"<a ") == 2 and changed.data.startswith(first.data)
+    new_file = changed.data.split(b'"')[3].decode()
+    assert ProxyHTTPRequestHandler.artifacts.get(new_file) is not None
+
+    stats = urllib3.request("GET", url + "/_crane/stats").json()["pages"]
+    assert (stats["revalidated"], stats["unchanged"], stats["changed"]) == (1, 1, 1)
+
+
+
+def test_pages_select_compatible_files(proxy):
+    url = proxy.proxy_address.url()
+    full = urllib3.request("GET", url + "/wheels/")
+    assert full.data.count(b"<a ") == len(WHEELS_PAGE)
+
+    query = "python=3.11.4&platform=manylinux*_x86_64"
+    for path in (f"/wheels/?{query}", f"/_crane/select/{quote(query, safe='')}/wheels/"):
+        selected = urllib3.request("GET", url + path)
+        assert selected.status == 200
+        names = [name for name, _ in WHEELS_PAGE if f">{name}<".encode() in selected.data]
+        assert names == [
+            "wheels-1.0-cp311-cp311-manylinux_2_17_x86_64.whl",
+            "wheels-1.0-py3-none-any.whl",
+            "wheels-1.0.tar.gz",
+        ]
+
+    resp = urllib3.request("GET", url + "/wheels/?python=latest")
+    assert resp.status == 400
+
+
+def test_selector_of_pre_release_interpreter(monkeypatch):
+    monkeypatch.setattr(platform, "python_version", lambda: "3.14.0rc2")
+    selector = FileSelector.for_interpreter()
+    assert FileSelector.from_query(selector.to_query()) == selector
+
+
+def test_warm_up(upstream_url, store):
+    with IndexProxy(index_url=None, port=0, fallback_urls=[upstream_url], store=store) as p:
+        report = p.warm_up(["pkg", "missing"])
+        # The stand-in has no root page: still a connection is opened.
+        assert report.upstreams == {upstream_url: "404"}
+        assert (report.pages, report.failed_pages) == (1, 1)
+        assert StandInIndex.hits[0] == "/simple/"
+        assert store.has(f"/_indexes/{index_id(upstream_url)}/pkg/", variant="html")
+
+        stats = urllib3.request("GET", p.proxy_address.url() + "/_crane/stats").json()
+        assert stats["upstreams"][upstream_url]["latency"] is not None
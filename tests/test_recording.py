@@ -0,0 +1,30 @@
+import os
+
+import urllib3
+
+from crane_pip.proxy import IndexProxy
+from crane_pip.recording import read_recording
+
+
+def test_requests_recorded(upstream_url, tmpdir):
+    file = os.path.join(tmpdir, "recording.jsonl")
+    http = urllib3.PoolManager()
+    with IndexProxy(index_url=None, port=0, fallback_urls=[upstream_url], record=file) as proxy:
+        base_url = proxy.proxy_address.url()
+        headers = {"Accept": "text/html", "Authorization": "Basic dXNlcjpzZWNyZXQ="}
+        page = http.request("GET", f"{base_url}/pkg/", headers=headers).data.decode()
+        file_path = page.split('href="')[1].split("#")[0]
+        assert http.request("GET", f"{base_url}{file_path}?X-Signature=secret").status == 200
+        assert http.request("HEAD", f"{base_url}/missing/").status == 404
+    with open(file, "a") as f:
+        f.write('{"t": 1, "cut sh')
+
+    records = read_recording(file)
+    assert [(r.method, r.status) for r in records] == [("GET", 200), ("GET", 200), ("HEAD", 404)]
+    assert records[0].path == "/pkg/" and records[0].accept == "text/html"
+    assert records[0].size == len(page) and records[0].duration > 0
+    assert records[1].path == file_path
+    assert len({r.connection for r in records}) == 1
+    with open(file) as f:
+        recording = f.read()
+    assert "secret" not in recording and "dXNlcjpzZWNyZXQ=" not in recording
@@ -0,0 +1,75 @@
+from datetime import datetime, timedelta
+import os
+import time
+
+import urllib3
+from pytest import fixture
+
+from crane_pip import auth, proxy as proxy_module
+from crane_pip.auth import get_access_token
+from crane_pip.cache import CraneTokens, TokenCache
+from crane_pip.config import ServerConfig, ServerConfigs
+from crane_pip.links import index_id
+from crane_pip.proxy import IndexProxy, ProxyHTTPRequestHandler
+
+
+@fixture
+def registry(tmpdir, monkeypatch) -> ServerConfigs:
+    "Fresh configs and token cache in a temporary database, as seen by the proxy."
+    for cls in (ServerConfigs, TokenCache):
+        monkeypatch.setattr(cls, "db_file", os.path.join(tmpdir, "crane.db"))
+    monkeypatch.setattr(TokenCache, "token_cache_file", os.path.join(tmpdir, "tokens.json"))
+    monkeypatch.setattr(ServerConfigs, "server_config_file", os.path.join(tmpdir, "servers.json"))
+    configs = ServerConfigs()
+    monkeypatch.setattr(auth, "server_configs", configs)
+    monkeypatch.setattr(proxy_module, "server_configs", configs)
+    monkeypatch.setattr(auth, "token_cache", TokenCache())
+    return configs
+
+
+def test_reload_swaps_indexes(registry, upstream_url, monkeypatch):
+    monkeypatch.setenv("CRANE_TEST_TOKEN", "token")
+    unreachable = "http://127.0.0.1:1/simple"
+    registry[upstream_url] = ServerConfig(
+        "client", "unused", "unused", "external", "CRANE_TEST_TOKEN", fallback_urls=[unreachable]
+    )
+    with IndexProxy(index_url=upstream_url, port=0) as proxy:
+        page_url = f"{proxy.proxy_address.url()}/pkg/"
+        assert urllib3.request("GET", page_url).status == 200
+        pages = ProxyHTTPRequestHandler.pages
+
+        # Registered anew by another crane process.
+        ServerConfigs()[upstream_url] = ServerConfig(
+            "client",
+            "unused",
+            "unused",
+            "external",
+            "CRANE_TEST_TOKEN",
+            fallback_urls=["http://127.0.0.1:2/simple", "http://127.0.0.1:3/simple"],
+            read_timeout=5.0,
+        )
+        proxy.reload()
+
+        registered, fallback = ProxyHTTPRequestHandler.indexes
+        assert registered.url == upstream_url and registered.timeout.read_timeout == 5.0
+        assert fallback.url == "http://127.0.0.1:2/simple"
+        assert fallback.mirrors == ("http://127.0.0.1:3/simple",)
+        # Links of pages served before still resolve, the caches are kept.
+        assert index_id(unreachable) in ProxyHTTPRequestHandler.indexes_by_id
+        assert ProxyHTTPRequestHandler.pages is pages
+        assert urllib3.request("GET", page_url).status == 200
+
+
+def test_tokens_of_login_picked_up(registry, upstream_url):
+    registry[upstream_url] = ServerConfig("client", "unused", "unused")
+    expires = datetime.now() + timedelta(hours=1)
+    auth.token_cache[upstream_url] = CraneTokens("revoked", expires, "refresh", None)
+    with IndexProxy(index_url=upstream_url, port=0, reload_interval=0.05):
+        assert get_access_token(upstream_url) == "revoked"
+
+        # Eg. `crane index login` in another process.
+        TokenCache()[upstream_url] = CraneTokens("new", expires, "refresh", None)
+        deadline = time.monotonic() + 5
+        while get_access_token(upstream_url) != "new" and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert get_access_token(upstream_url) == "new"
@@ -0,0 +1,108 @@
+import io
+import time
+from urllib.parse import urljoin
+import zipfile
+
+import urllib3
+from pip._vendor.packaging.specifiers import SpecifierSet
+from pip._vendor.packaging.tags import sys_tags
+
+from crane_pip.proxy import IndexProxy, ProxyHTTPRequestHandler
+from crane_pip.simple import FileSelector, SimpleFile
+from crane_pip.speculate import best_file, requires_dist, wheel_metadata
+from conftest import StandInIndex
+
+HEADERS = {"Accept": "text/html", "Accept-Encoding": "gzip"}
+
+
+def test_requires_dist():
+    wheel = io.BytesIO()
+    with zipfile.ZipFile(wheel, "w") as f:
+        f.writestr("app/__init__.py", "")
+        f.writestr(
+            "app-1.0.dist-info/METADATA",
+            "Name: app\nRequires-Dist: numpy (>=1.0)\nRequires-Dist: colorama; os_name == 'nt'"
+            "\nRequires-Dist: pytest; extra == 'test'\nRequires-Dist: not valid!\n",
+        )
+    metadata = wheel_metadata(wheel.getvalue())
+    assert metadata and [str(r) for r in requires_dist(metadata)] in (
+        ["numpy>=1.0"],
+        ["numpy>=1.0", 'colorama; os_name == "nt"'],
+    )
+
+
+def test_best_file():
+    files = [
+        SimpleFile(name, f"/files/x/{name}", {})
+        for name in (
+            "pkg-2.0-py3-none-any.whl",
+            "pkg-2.0.tar.gz",
+            "pkg-1.5-py3-none-any.whl",
+            "pkg-1.0.tar.gz",
+            "pkg-3.0a1-py3-none-any.whl",
+            "pkg-9.0-cp27-cp27m-win32.whl",
+        )
+    ]
+    selector = FileSelector(python="3.11")
+    ranking = {tag: i for i, tag in enumerate(sys_tags())}
+    best = best_file(files, SpecifierSet(""), ranking, selector)
+    assert best and best.filename == "pkg-2.0-py3-none-any.whl"
+    best = best_file(files, SpecifierSet("<2"), ranking, selector)
+    assert best and best.filename == "pkg-1.5-py3-none-any.whl"
+    assert best_file(files, SpecifierSet(">9"), ranking, selector) is None
+
+
+def test_dependencies_prefetched(upstream_url):
+    http = urllib3.PoolManager()
+    with IndexProxy(
+        index_url=None, port=0, fallback_urls=[upstream_url], speculate="pages"
+    ) as proxy:
+        base_url = proxy.proxy_address.url()
+        page = http.request("GET", f"{base_url}/app/", headers=HEADERS).data.decode()
+        metadata_url = urljoin(f"{base_url}/app/", page.split('href="')[1].split('"')[0])
+        metadata_url += ".metadata"
+        http.request("GET", metadata_url)
+
+        # The pages of pkg and lib, and the metadata of lib are prefetched. Not pytest (an extra).
+        speculator = ProxyHTTPRequestHandler.speculator
+        assert speculator
+        deadline = time.monotonic() + 5
+        while speculator.stats()["held"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert speculator.stats()["held"] == 3
+        assert "/simple/pytest/" not in StandInIndex.hits
+
+        StandInIndex.hits = []
+        resp = http.request("GET", f"{base_url}/pkg/", headers=HEADERS)
+        assert resp.status == 200 and resp.headers["X-Crane-Cache"] == "speculative"
+        assert b"pkg-1.0.tar.gz" in resp.data
+        lib_metadata = metadata_url.replace("app-", "lib-")
+        resp = http.request("GET", lib_metadata)
+        assert resp.headers["X-Crane-Cache"] == "speculative"
+        assert resp.data.startswith(b"Metadata-Version")
+        assert StandInIndex.hits == []
+
+        # Served once, then from the indexes again.
+        resp = http.request("GET", f"{base_url}/pkg/", headers=HEADERS)
+        assert resp.status == 200 and "X-Crane-Cache" not in resp.headers
+        assert speculator.stats()["hits"] == 2
+
+
+def test_dependencies_of_streamed_wheel_read_from_store(upstream_url, store):
+    http = urllib3.PoolManager()
+    with IndexProxy(
+        index_url=None, port=0, fallback_urls=[upstream_url], store=store, speculate="pages"
+    ) as proxy:
+        base_url = proxy.proxy_address.url()
+        page = http.request("GET", f"{base_url}/app/", headers=HEADERS).data.decode()
+        wheel_url = urljoin(f"{base_url}/app/", page.split('href="')[1].split('"')[0])
+        resp = http.request("GET", wheel_url)
+        assert zipfile.is_zipfile(io.BytesIO(resp.data))
+
+        speculator = ProxyHTTPRequestHandler.speculator
+        assert speculator
+        deadline = time.monotonic() + 5
+        while speculator.stats()["held"] < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert speculator.stats()["held"] == 3
+        assert "/simple/lib/" in StandInIndex.hits
@@ -0,0 +1,142 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+import time
+from typing import List
+from pytest import fixture, raises
+import urllib3
+from crane_pip.upstream import CircuitOpen, UpstreamError, UpstreamPool
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    "Stand-in upstream: /old/* permanently redirects to /new/*, /broken/* fails, /slow/* is slow."
+
+    hits: List[str] = []
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path.startswith("/old/"):
+            self.send_response(301)
+            self.send_header("Location", "/new/" + self.path[len("/old/") :])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.path.startswith("/slow/"):
+            time.sleep(0.5)
+        status = 503 if self.path.startswith("/broken/") else 200
+        body = self.path.encode()
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@fixture
+def upstream_url():
+    StandInHandler.hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    thread = Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+
+
+def test_permanent_redirect_is_cached(upstream_url):
+    pool = UpstreamPool()
+    resp = pool.request("GET", f"{upstream_url}/old/simple/numpy/", headers={})
+    assert resp.status == 200
+    assert resp.data == b"/new/simple/numpy/"
+    assert StandInHandler.hits == ["/old/simple/numpy/", "/new/simple/numpy/"]
+
+    # Other paths below the redirected prefix skip the redirect.
+    assert pool.resolve(f"{upstream_url}/old/simple/scipy/") == f"{upstream_url}/new/simple/scipy/"
+    assert pool.resolve(f"{upstream_url}/older/") == f"{upstream_url}/older/"
+    resp = pool.request("GET", f"{upstream_url}/old/simple/scipy/", headers={})
+    assert resp.data == b"/new/simple/scipy/"
+    assert StandInHandler.hits[-1] == "/new/simple/scipy/"
+    assert len(StandInHandler.hits) == 3
+
+
+def test_failover_to_healthy_mirror(upstream_url):
+    pool = UpstreamPool()
+    broken, healthy = f"{upstream_url}/broken", f"{upstream_url}/ok"
+    candidates = [(broken, broken + "/numpy/"), (healthy, healthy + "/numpy/")]
+
+    base_url, resp = pool.request_mirrors("GET", candidates, headers={})
+    assert base_url == healthy and resp.status == 200
+    assert pool.health(broken).consecutive_failures == 1
+
+    # The broken mirror is now skipped.
+    assert pool.order([broken, healthy]) == [healthy, broken]
+    StandInHandler.hits = []
+    pool.request_mirrors("GET", candidates, headers={})
+    assert StandInHandler.hits == ["/ok/numpy/"]
+
+
+def test_unreachable_mirror_is_skipped(upstream_url):
+    pool = UpstreamPool()
+    dead = "http://127.0.0.1:1"
+    candidates = [(dead, dead + "/numpy/"), (upstream_url, upstream_url + "/numpy/")]
+    base_url, resp = pool.request_mirrors("GET", candidates, headers={}, retries=False)
+    assert base_url == upstream_url and resp.url == upstream_url + "/numpy/"
+    assert pool.health(dead).consecutive_failures == 1
+
+
+def test_circuit_breaker(upstream_url):
+    pool = UpstreamPool()
+    broken = f"{upstream_url}/broken"
+    candidates = [(broken, broken + "/numpy/")]
+    for _ in range(pool.failure_threshold):
+        _, resp = pool.request_mirrors("GET", candidates, headers={})
+        assert resp.status == 503
+
+    # Open: the upstream is not contacted anymore.
+    StandInHandler.hits = []
+    with raises(CircuitOpen):
+        pool.request_mirrors("GET", candidates, headers={})
+    assert StandInHandler.hits == []
+    assert pool.stats()[broken]["circuit"] == "open"
+
+    # Half-open after the backoff: a single probe is let through.
+    pool.health(broken).unhealthy_until = 0.0
+    assert pool.stats()[broken]["circuit"] == "half-open"
+    assert pool.allow(broken) and not pool.allow(broken)
+
+
+def test_probe_released_on_unexpected_errors(upstream_url, monkeypatch):
+    pool = UpstreamPool()
+    pool.health(upstream_url).consecutive_failures = pool.failure_threshold
+    assert pool.stats()[upstream_url]["circuit"] == "half-open"
+
+    def fail(*args, **kwargs):
+        raise ValueError("unexpected")
+
+    monkeypatch.setattr(pool, "request", fail)
+    with raises(ValueError):
+        pool.request_mirrors("GET", [(upstream_url, upstream_url + "/numpy/")], headers={})
+    # The next request gets to probe.
+    assert not pool.health(upstream_url).probing and pool.allow(upstream_url)
+
+
+def test_read_timeout(upstream_url):
+    pool = UpstreamPool()
+    slow = f"{upstream_url}/slow"
+    with raises(UpstreamError):
+        pool.request_mirrors(
+            "GET", [(slow, slow + "/numpy/")], headers={}, timeout=urllib3.Timeout(read=0.1)
+        )
+    assert pool.stats()[slow]["timeouts"] == 1
+
+
+def test_hedged_request(upstream_url):
+    pool = UpstreamPool(hedge_after=0.1)
+    slow, fast = f"{upstream_url}/slow", f"{upstream_url}/ok"
+    candidates = [(slow, slow + "/numpy/"), (fast, fast + "/numpy/")]
+    start = time.monotonic()
+    base_url, resp = pool.request_mirrors("GET", candidates, headers={})
+    assert base_url == fast and resp.status == 200
+    assert time.monotonic() - start < 0.4, "the slow mirror is not waited for"
+    stats = pool.stats()
+    assert stats[fast]["hedged"] == 1 and stats[fast]["hedge_wins"] == 1
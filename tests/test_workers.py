@@ -0,0 +1,66 @@
+import os
+import signal
+import socket
+import subprocess
+import sys
+
+import pytest
+import urllib3
+
+pytestmark = pytest.mark.skipif(not hasattr(os, "fork"), reason="requires os.fork")
+
+SCRIPT = """
+import sys
+from crane_pip.proxy import IndexProxy
+from crane_pip.workers import WorkerSupervisor
+
+WorkerSupervisor.restart_delay = 0.1
+proxy = IndexProxy(
+    index_url=None, port=int(sys.argv[2]), fallback_urls=[sys.argv[1]], warm_up_projects=["pkg"]
+)
+proxy.start_workers(2)
+"""
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def next_worker(proc: subprocess.Popen) -> int:
+    "Read the output of the supervisor until a worker is started. Returns its pid."
+    for line in proc.stdout:
+        if line.startswith("Started worker"):
+            return int(line.split()[-1])
+    raise AssertionError("Supervisor exited")
+
+
+def test_workers_are_supervised(upstream_url):
+    port = free_port()
+    proc = subprocess.Popen(
+        [sys.executable, "-u", "-c", SCRIPT, upstream_url, str(port)],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        workers = {next_worker(proc), next_worker(proc)}
+        url = f"http://127.0.0.1:{port}/pkg/"
+        assert urllib3.request("GET", url).status == 200
+
+        # A dead worker gets replaced.
+        dead = workers.pop()
+        os.kill(dead, signal.SIGKILL)
+        workers.add(next_worker(proc))
+        assert dead not in workers and len(workers) == 2
+        for _ in range(4):
+            assert urllib3.request("GET", url).status == 200
+
+        proc.send_signal(signal.SIGTERM)
+        assert proc.wait(timeout=10) == 0
+        for pid in workers:
+            with pytest.raises(ProcessLookupError):
+                os.kill(pid, 0)
+    finally:
+        proc.kill()
+        proc.wait()